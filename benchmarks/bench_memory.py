@@ -0,0 +1,104 @@
+"""
+/***************************************************************************
+                              -------------------
+        git sha              : :%H$
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Memory used by a ProjectTopping layertree kept in memory.
+
+The tree model (with __slots__ and the styles dict created on demand) is compared to a replica of the previous model with an instance dict and a styles dict per item.
+The previous model additionally created a temporary directory per item constructed without one, what is not measured here.
+
+Run with:
+    python benchmarks/bench_memory.py [number of nodes]
+"""
+import sys
+import tracemalloc
+
+from toppingmaker import ProjectTopping
+
+GROUP_SIZE = 100
+
+
+class DictTreeItemProperties:
+    def __init__(self):
+        self.group = False
+        self.checked = True
+        self.expanded = True
+        self.featurecount = False
+        self.mutually_exclusive = False
+        self.mutually_exclusive_child = -1
+        self.provider = None
+        self.uri = None
+        self.qmlstylefile = None
+        self.definitionfile = None
+        self.tablename = None
+        self.geometrycolumn = None
+        self.styles = {}
+
+
+class DictLayerTreeItem:
+    def __init__(self, temporary_toppingfile_dir=None):
+        self.items = []
+        self.name = None
+        self.properties = DictTreeItemProperties()
+        self.temporary_toppingfile_dir = temporary_toppingfile_dir
+
+
+def build_tree(item_class, node_count):
+    """
+    Builds a tree of groups with GROUP_SIZE layers each (like parse_project fills it).
+    """
+    root = item_class("/tmp/toppingmaker_bench")
+    for index in range(node_count):
+        if index % GROUP_SIZE == 0:
+            group = item_class(root.temporary_toppingfile_dir)
+            group.name = "group {}".format(index // GROUP_SIZE)
+            group.properties.group = True
+            root.items.append(group)
+        item = item_class(root.temporary_toppingfile_dir)
+        item.name = "layer {}".format(index)
+        item.properties.tablename = "table_{}".format(index)
+        group.items.append(item)
+    return root
+
+
+def measure(item_class, node_count):
+    tracemalloc.start()
+    tree = build_tree(item_class, node_count)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del tree
+    return current, peak
+
+
+def main(node_count):
+    results = {
+        "dict (previous)": measure(DictLayerTreeItem, node_count),
+        "slots": measure(ProjectTopping.LayerTreeItem, node_count),
+    }
+    print("{} nodes".format(node_count))
+    for name, (current, peak) in results.items():
+        print(
+            "{:>16}: {:>8.1f} MiB ({:>5.0f} bytes per node), peak {:>8.1f} MiB".format(
+                name,
+                current / 1024 / 1024,
+                current / node_count,
+                peak / 1024 / 1024,
+            )
+        )
+    previous = results["dict (previous)"][0]
+    print("reduction: {:.0%}".format(1 - results["slots"][0] / previous))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,190 @@
+"""
+/***************************************************************************
+                              -------------------
+        git sha              : :%H$
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Throughput and peak memory of parse_project, _projecttopping_dict and generate_files on a synthetic project (see synthetic_project.py).
+
+The time is the best of the repeated runs, the peak memory is the one allocated by Python (tracemalloc) in an additional run - the memory allocated by QGIS itself is not included.
+
+The results can be stored as baseline and later runs compared to it. A run is a regression when the time or the peak memory of a benchmark exceeds the baseline by more than the tolerance. Baselines are only comparable when made on the same machine with the same project size.
+
+Run with:
+    python benchmarks/bench_toppingmaker.py --layers 1000 --save-baseline main
+    python benchmarks/bench_toppingmaker.py --layers 1000 --compare main
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from qgis.core import Qgis
+from qgis.testing import start_app
+from synthetic_project import make_export_settings, make_project
+
+from toppingmaker import ProjectTopping, Target
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+
+
+def measure(function, repeat: int) -> dict:
+    """
+    Returns the best time of the runs and the peak of the memory allocated by Python in one more run.
+    """
+    seconds = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        run_seconds = time.perf_counter() - start_time
+        seconds = run_seconds if seconds is None else min(seconds, run_seconds)
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": seconds, "peak_bytes": peak}
+
+
+def run(config: dict, repeat: int) -> dict:
+    project = make_project(**config)
+    export_settings = make_export_settings(project)
+    output_dir = tempfile.mkdtemp(prefix="toppingmaker_bench_")
+
+    def parse():
+        ProjectTopping().parse_project(project, export_settings)
+
+    project_topping = ProjectTopping()
+    project_topping.parse_project(project, export_settings)
+
+    def projecttopping_dict():
+        project_topping._projecttopping_dict(
+            Target("bench", os.path.join(output_dir, "dict"))
+        )
+
+    def generate():
+        project_topping.generate_files(
+            Target("bench", os.path.join(output_dir, "generate"))
+        )
+
+    results = {}
+    for name, function in [
+        ("parse_project", parse),
+        ("_projecttopping_dict", projecttopping_dict),
+        ("generate_files", generate),
+    ]:
+        results[name] = measure(function, repeat)
+        results[name]["layers_per_second"] = config["layers"] / max(
+            results[name]["seconds"], 1e-9
+        )
+    shutil.rmtree(output_dir, ignore_errors=True)
+
+    return {
+        "config": config,
+        "qgis": Qgis.QGIS_VERSION,
+        "python": platform.python_version(),
+        "results": results,
+    }
+
+
+def compare(run_result: dict, baseline: dict, tolerance: float) -> bool:
+    """
+    Prints the changes to the baseline and returns False if there is a regression.
+    """
+    if run_result["config"] != baseline["config"]:
+        print(
+            "The baseline has been made with another configuration: {}".format(
+                baseline["config"]
+            )
+        )
+        return False
+    passed = True
+    for name, result in run_result["results"].items():
+        baseline_result = baseline["results"].get(name)
+        if not baseline_result:
+            continue
+        for key in ["seconds", "peak_bytes"]:
+            ratio = result[key] / max(baseline_result[key], 1e-9)
+            regression = ratio > 1 + tolerance
+            passed = passed and not regression
+            print(
+                "{:>22} {:>10}: {:>+7.1%}{}".format(
+                    name, key, ratio - 1, "  REGRESSION" if regression else ""
+                )
+            )
+    return passed
+
+
+def print_results(run_result: dict):
+    print("{} (QGIS {})".format(run_result["config"], run_result["qgis"]))
+    for name, result in run_result["results"].items():
+        print(
+            "{:>22}: {:>9.3f} s {:>10.0f} layers/s, peak {:>8.1f} MiB".format(
+                name,
+                result["seconds"],
+                result["layers_per_second"],
+                result["peak_bytes"] / 1024 / 1024,
+            )
+        )
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the ProjectTopping on a synthetic project."
+    )
+    parser.add_argument("--layers", type=int, default=1000)
+    parser.add_argument("--group-size", type=int, default=50)
+    parser.add_argument("--depth", type=int, default=2)
+    parser.add_argument("--styles", type=int, default=2)
+    parser.add_argument("--mapthemes", type=int, default=5)
+    parser.add_argument("--layouts", type=int, default=2)
+    parser.add_argument("--variables", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save-baseline", metavar="NAME")
+    parser.add_argument("--compare", metavar="NAME")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    start_app()
+    config = {
+        "layers": args.layers,
+        "group_size": args.group_size,
+        "depth": args.depth,
+        "styles": args.styles,
+        "mapthemes": args.mapthemes,
+        "layouts": args.layouts,
+        "variables": args.variables,
+    }
+    run_result = run(config, args.repeat)
+    print_results(run_result)
+
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        path = os.path.join(BASELINE_DIR, "{}.json".format(args.save_baseline))
+        with open(path, "w") as file:
+            json.dump(run_result, file, indent=2)
+        print("Baseline stored in {}".format(path))
+
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR, "{}.json".format(args.compare))) as file:
+            baseline = json.load(file)
+        if not compare(run_result, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
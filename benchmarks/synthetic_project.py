@@ -0,0 +1,132 @@
+"""
+/***************************************************************************
+                              -------------------
+        git sha              : :%H$
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Synthesizes QGIS projects of a configurable size to benchmark the ProjectTopping.
+"""
+from qgis.core import (
+    QgsExpressionContextUtils,
+    QgsMapThemeCollection,
+    QgsPrintLayout,
+    QgsProject,
+    QgsVectorLayer,
+)
+
+from toppingmaker import ExportSettings
+
+GEOMETRY_TYPES = ["point", "linestring", "polygon"]
+
+
+def make_project(
+    layers: int = 1000,
+    group_size: int = 50,
+    depth: int = 2,
+    styles: int = 2,
+    mapthemes: int = 5,
+    layouts: int = 2,
+    variables: int = 10,
+) -> QgsProject:
+    """
+    Makes a project with memory layers in nested groups.
+
+    :param int layers: the number of layers.
+    :param int group_size: the number of layers per group.
+    :param int depth: the depth of the nested groups the layers are in. The groups contain group_size groups of the level below (and the groups of the last level group_size layers).
+    :param int styles: the number of named styles per layer (additionally to the default style).
+    :param int mapthemes: the number of map themes (every one with all layers using another named style and every other layer unchecked).
+    :param int layouts: the number of print layouts.
+    :param int variables: the number of custom project variables.
+    """
+    project = QgsProject()
+
+    layer_list = []
+    for index in range(layers):
+        layer = QgsVectorLayer(
+            "{}?crs=epsg:2056&field=id:integer&field=name:string".format(
+                GEOMETRY_TYPES[index % len(GEOMETRY_TYPES)]
+            ),
+            "layer {}".format(index),
+            "memory",
+        )
+        style_manager = layer.styleManager()
+        for style_index in range(styles):
+            layer.setDisplayExpression("'style {}: '||name".format(style_index))
+            style_manager.addStyleFromLayer("style {}".format(style_index))
+        style_manager.setCurrentStyle("default")
+        layer_list.append(layer)
+    project.addMapLayers(layer_list, False)
+
+    # the groups by their path of indices (the index of the group on every level of the tree)
+    groups = {(): project.layerTreeRoot()}
+    for index, layer in enumerate(layer_list):
+        group_index = index // group_size
+        path = tuple(
+            group_index // group_size ** (depth - 1 - level) for level in range(depth)
+        )
+        _group(groups, path).addLayer(layer)
+
+    theme_collection = project.mapThemeCollection()
+    for theme_index in range(mapthemes):
+        map_theme_record = QgsMapThemeCollection.MapThemeRecord()
+        for index, layer in enumerate(layer_list):
+            map_theme_layer_record = QgsMapThemeCollection.MapThemeLayerRecord()
+            map_theme_layer_record.setLayer(layer)
+            if styles:
+                map_theme_layer_record.usingCurrentStyle = True
+                map_theme_layer_record.currentStyle = "style {}".format(
+                    theme_index % styles
+                )
+            map_theme_layer_record.isVisible = (index + theme_index) % 2 == 0
+            map_theme_record.addLayerRecord(map_theme_layer_record)
+        theme_collection.insert("theme {}".format(theme_index), map_theme_record)
+
+    for index in range(variables):
+        QgsExpressionContextUtils.setProjectVariable(
+            project, "variable {}".format(index), "value {}".format(index)
+        )
+
+    for index in range(layouts):
+        layout = QgsPrintLayout(project)
+        layout.initializeDefaults()
+        layout.setName("layout {}".format(index))
+        project.layoutManager().addLayout(layout)
+
+    return project
+
+
+def make_export_settings(project: QgsProject) -> ExportSettings:
+    """
+    Makes the export settings exporting the default and the named styles of all layers, the source of the memory layers, all map themes, variables and layouts of the project.
+    """
+    export_settings = ExportSettings()
+    export_settings.add_rule(ExportSettings.ToppingType.QMLSTYLE)
+    export_settings.add_rule(ExportSettings.ToppingType.QMLSTYLE, style_name="*")
+    export_settings.add_rule(ExportSettings.ToppingType.SOURCE, provider="memory")
+    export_settings.mapthemes = project.mapThemeCollection().mapThemes()
+    export_settings.variables = list(project.customVariables().keys())
+    export_settings.layouts = [
+        layout.name() for layout in project.layoutManager().printLayouts()
+    ]
+    return export_settings
+
+
+def _group(groups: dict, path: tuple):
+    # gets the group of the path and creates it (and the missing parents) if needed
+    group = groups.get(path)
+    if group is None:
+        group = _group(groups, path[:-1]).addGroup(
+            "group {}".format(".".join(str(index) for index in path))
+        )
+        groups[path] = group
+    return group
@@ -18,22 +18,55 @@
 """
 
 import datetime
+import hashlib
+import io
+import json
 import logging
 import os
+import sys
+import tarfile
 import tempfile
+import zipfile
+from unittest import mock
 
 import yaml
 from qgis.core import (
     Qgis,
     QgsExpressionContextUtils,
+    QgsFeedback,
+    QgsLayerTreeGroup,
+    QgsMapLayer,
     QgsMapThemeCollection,
+    QgsMeshLayer,
     QgsPrintLayout,
     QgsProject,
     QgsVectorLayer,
+    QgsVectorTileLayer,
 )
 from qgis.testing import start_app, unittest
 
-from toppingmaker import ExportSettings, ProjectTopping, Target
+try:
+    # QGIS >= 3.18
+    from qgis.core import QgsPointCloudLayer
+except ImportError:
+    QgsPointCloudLayer = None
+
+from toppingmaker import (
+    ArchiveTarget,
+    DocumentCache,
+    ExportCache,
+    ExportSettings,
+    MemoryTarget,
+    Metrics,
+    ProjectGenerator,
+    ProjectTopping,
+    ProjectToppingTask,
+    Target,
+    ToppingDiff,
+    providers,
+)
+from toppingmaker.exportpool import DeferredToppingfile, ExportPool
+from toppingmaker.target import LinkedToppingfile
 
 start_app()
 
@@ -167,6 +200,56 @@ class ToppingMakerTest(unittest.TestCase):
         # "Layout Two" is in the project but not in the export_settings
         assert "Layout Two" not in layouts
 
+    def test_delta_encoded_mapthemes(self):
+        """
+        The map themes are written as the differences to the common base state.
+        """
+        project, export_settings = self._make_project_and_export_settings()
+        # a second robot theme with layer three unchecked
+        layer_three = project.mapLayersByName("Layer Three")[0]
+        maptheme_collection = project.mapThemeCollection()
+        map_theme_record = maptheme_collection.mapThemeState("Robot Theme")
+        map_theme_record.removeLayerRecord(layer_three)
+        map_theme_layer_record = QgsMapThemeCollection.MapThemeLayerRecord()
+        map_theme_layer_record.setLayer(layer_three)
+        map_theme_layer_record.usingCurrentStyle = True
+        map_theme_layer_record.currentStyle = "robot 3"
+        map_theme_layer_record.isVisible = False
+        map_theme_record.addLayerRecord(map_theme_layer_record)
+        maptheme_collection.insert("Second Robot Theme", map_theme_record)
+        export_settings.mapthemes.append("Second Robot Theme")
+        export_settings.mapthemes_delta = True
+
+        project_topping = ProjectTopping()
+        project_topping.parse_project(project, export_settings)
+        mapthemes = project_topping.mapthemes
+
+        base, deltas = mapthemes.delta_encoded()
+        # the states of the robot themes
+        assert set(base.keys()) == {"Layer One", "Big Group", "Small Group"}
+        assert base["Layer One"]["style"] == "robot 1"
+        assert set(deltas["Robot Theme"].keys()) == {"Layer Three"}
+        assert deltas["Robot Theme"]["Layer Three"]["visible"]
+        assert set(deltas["Second Robot Theme"].keys()) == {"Layer Three"}
+        assert not deltas["Second Robot Theme"]["Layer Three"]["visible"]
+        assert deltas["French Theme"]["Layer One"]["style"] == "french 1"
+        assert deltas["French Theme"]["Big Group"] is None
+        assert deltas["French Theme"]["Small Group"] is None
+
+        # the expanded deltas are the complete map themes
+        assert ProjectTopping.MapThemes.expanded(deltas, base) == dict(mapthemes)
+
+        maindir = os.path.join(self.projecttopping_test_path, "freddys_repository")
+        target = Target("freddys", maindir, "freddys_projects/delta_project")
+        projecttopping_dict = project_topping._projecttopping_dict(target)
+        assert projecttopping_dict["mapthemes-base"] == base
+        assert projecttopping_dict["mapthemes"] == deltas
+
+        stream = io.StringIO()
+        target = Target("freddys", maindir, "freddys_projects/delta_project")
+        project_topping._write_projecttopping(stream, target)
+        assert yaml.safe_load(stream.getvalue()) == projecttopping_dict
+
     def test_generate_files(self):
         """
         Generate projecttopping file with layertree, map themes, variables and layouts.
@@ -602,6 +685,1431 @@ class ToppingMakerTest(unittest.TestCase):
 
         assert countchecked == 6
 
+    def test_parse_project_with_export_pool(self):
+        """
+        Parse it once serial and once with a pool of workers writing the toppingfiles.
+        The generated files need to be identical.
+        """
+        project, export_settings = self._make_project_and_export_settings()
+        subdir = "freddys_projects/this_specific_project"
+
+        generated_files = []
+        for repository, max_workers in [
+            ("serial_repository", None),
+            ("pool_repository", 4),
+        ]:
+            project_topping = ProjectTopping()
+            project_topping.parse_project(project, export_settings, max_workers)
+            maindir = os.path.join(self.projecttopping_test_path, repository)
+            target = Target("freddys", maindir, subdir)
+            project_topping.generate_files(target)
+
+            files = {}
+            for toppingfileinfo in target.toppingfileinfo_list:
+                with open(os.path.join(maindir, toppingfileinfo["path"])) as file:
+                    files[toppingfileinfo["path"]] = file.read()
+            generated_files.append(files)
+
+        serial_files, pool_files = generated_files
+        # the yaml, 6 qml, 3 qlr, 2 qpt and the generic file
+        assert len(serial_files) == 13
+        assert serial_files == pool_files
+
+        # toppingfiles that could not be written are reported and the parsing fails
+        def failing_serializer():
+            raise ValueError("Serialization failed")
+
+        export_pool = ExportPool(4)
+        path = os.path.join(tempfile.mkdtemp(), "failing.qml")
+        export_pool.write(path, failing_serializer)
+        assert not export_pool.close()
+        assert export_pool.failures == {path: "Serialization failed"}
+        assert not os.path.exists(path)
+
+        write = ExportPool.write
+        for max_workers in [None, 4]:
+            project_topping = ProjectTopping()
+            messages = []
+            project_topping.stdout.connect(
+                lambda text, level: messages.append((text, level))
+            )
+            with mock.patch.object(
+                ExportPool,
+                "write",
+                lambda export_pool, path, serializer, fingerprint=None: write(
+                    export_pool, path, failing_serializer, fingerprint
+                ),
+            ):
+                assert not project_topping.parse_project(
+                    project, export_settings, max_workers
+                )
+            warnings = [text for text, level in messages if level == Qgis.Warning]
+            assert warnings
+            assert all("Serialization failed" in text for text in warnings)
+
+    def test_parse_project_lazy(self):
+        """
+        Parsed lazy the toppingfiles are exported when generating the files.
+        The generated files need to be identical to the ones parsed eagerly.
+        """
+        project, export_settings = self._make_project_and_export_settings()
+        subdir = "freddys_projects/this_specific_project"
+
+        lazy_project_topping = ProjectTopping()
+        lazy_project_topping.parse_project(
+            project, export_settings, max_workers=4, lazy=True
+        )
+        layer_one_item = lazy_project_topping.layertree.items[0].items[0]
+        qmlstylefile = layer_one_item.properties.qmlstylefile
+        assert isinstance(qmlstylefile, DeferredToppingfile)
+        assert not qmlstylefile.is_realized()
+        assert not os.path.exists(qmlstylefile.path)
+        for style_item in layer_one_item.properties.styles.values():
+            assert not style_item.qmlstylefile.is_realized()
+        for layout_item in lazy_project_topping.layouts.values():
+            assert not layout_item["templatefile"].is_realized()
+
+        # a realized file waits only for its own write, the others are still written by the pool
+        export_pool = lazy_project_topping._deferred_export_pool
+        templatefiles = [
+            layout_item["templatefile"]
+            for layout_item in lazy_project_topping.layouts.values()
+        ]
+        for templatefile in templatefiles:
+            assert os.path.exists(templatefile.realize())
+        assert len(export_pool._futures) == len(templatefiles)
+
+        generated_files = []
+        for repository, project_topping in [
+            ("eager_repository", None),
+            ("lazy_repository", lazy_project_topping),
+        ]:
+            if not project_topping:
+                project_topping = ProjectTopping()
+                project_topping.parse_project(project, export_settings)
+            maindir = os.path.join(self.projecttopping_test_path, repository)
+            target = Target("freddys", maindir, subdir)
+            project_topping.generate_files(target)
+
+            files = {}
+            for toppingfileinfo in target.toppingfileinfo_list:
+                with open(os.path.join(maindir, toppingfileinfo["path"])) as file:
+                    files[toppingfileinfo["path"]] = file.read()
+            generated_files.append(files)
+
+        eager_files, lazy_files = generated_files
+        assert len(eager_files) == 13
+        assert eager_files == lazy_files
+        assert qmlstylefile.is_realized()
+        # the current styles of the layers are kept
+        for layer in project.mapLayers().values():
+            assert layer.styleManager().currentStyle() == "default"
+
+        # the workers of the export pool are shut down when the generating is canceled
+        canceled_project_topping = ProjectTopping()
+        canceled_project_topping.parse_project(
+            project, export_settings, max_workers=4, lazy=True
+        )
+        feedback = QgsFeedback()
+        feedback.cancel()
+        maindir = os.path.join(
+            self.projecttopping_test_path, "canceled_lazy_repository"
+        )
+        assert (
+            canceled_project_topping.generate_files(
+                Target("freddys", maindir, subdir), feedback=feedback
+            )
+            is None
+        )
+        assert canceled_project_topping._deferred_export_pool._executor is None
+        canceled_project_topping.close()
+        assert not os.path.exists(canceled_project_topping.temporary_toppingfile_dir)
+
+        # and when the ProjectTopping is closed without generating the files
+        with ProjectTopping() as closed_project_topping:
+            closed_project_topping.parse_project(
+                project, export_settings, max_workers=4, lazy=True
+            )
+            export_pool = closed_project_topping._deferred_export_pool
+            assert export_pool._executor is not None
+        assert export_pool._executor is None
+        assert closed_project_topping._deferred_export_pool is None
+        assert not os.path.exists(closed_project_topping.temporary_toppingfile_dir)
+
+    def test_export_named_styles_without_switching(self):
+        """
+        The named styles are exported from the style manager without notifying about style switches.
+        """
+        project, export_settings = self._make_project_and_export_settings()
+        # the robot style of layer one with the symbology only (needs to be applied to export it)
+        export_settings.set_setting_values(
+            ExportSettings.ToppingType.QMLSTYLE,
+            None,
+            "Layer One",
+            True,
+            QgsMapLayer.StyleCategory.Symbology,
+            "robot 1",
+        )
+
+        emitted_signals = []
+        for layer in project.mapLayers().values():
+            layer.styleChanged.connect(
+                lambda layer=layer: emitted_signals.append(layer.name())
+            )
+            layer.styleManager().currentStyleChanged.connect(emitted_signals.append)
+
+        project_topping = ProjectTopping()
+        project_topping.parse_project(project, export_settings)
+
+        assert emitted_signals == []
+        for layer in project.mapLayers().values():
+            assert layer.styleManager().currentStyle() == "default"
+
+        layer_one_item = project_topping.layertree.items[0].items[0]
+        with open(layer_one_item.properties.styles["french 1"].qmlstylefile) as file:
+            french_qml = file.read()
+        assert french_qml.startswith("<!DOCTYPE qgis")
+        assert "'French:'||'un'" in french_qml
+        with open(layer_one_item.properties.qmlstylefile) as file:
+            assert "'French:'||'un'" not in file.read()
+
+    def test_layout_timings(self):
+        """
+        The layout templates are exported by the pool and timed per layout.
+        """
+        project, export_settings = self._make_project_and_export_settings()
+        project_topping = ProjectTopping()
+        project_topping.parse_project(project, export_settings, max_workers=4)
+
+        layouts = project_topping.layouts
+        assert set(layouts.timings.keys()) == {"Layout One", "Layout Three"}
+        for layout_name, timing in layouts.timings.items():
+            assert timing > 0
+            with open(layouts[layout_name]["templatefile"]) as file:
+                assert file.read().startswith("<Layout")
+
+    def test_content_addressed_target(self):
+        """
+        Generate the files into a content addressed target.
+        Every file is stored once by the digest of its content and the links point to it.
+        """
+        project_topping = ProjectTopping()
+        project, export_settings = self._make_project_and_export_settings()
+        project_topping.parse_project(project, export_settings)
+
+        maindir = os.path.join(self.projecttopping_test_path, "freddys_repository")
+        subdir = "freddys_projects/content_addressed_project"
+
+        target = Target("freddys", maindir, subdir, content_addressed=True)
+        projecttopping_file_path = os.path.join(
+            target.main_dir, project_topping.generate_files(target)
+        )
+
+        # every file is listed only once (before it have been 22)
+        paths = [
+            toppingfileinfo["path"] for toppingfileinfo in target.toppingfileinfo_list
+        ]
+        assert len(paths) == len(set(paths))
+        assert len(paths) <= 13
+
+        for toppingfileinfo in target.toppingfileinfo_list:
+            if toppingfileinfo["type"] == ProjectTopping.PROJECTTOPPING_TYPE:
+                continue
+            path = os.path.join(target.main_dir, toppingfileinfo["path"])
+            with open(path, "rb") as file:
+                digest = hashlib.sha256(file.read()).hexdigest()
+            assert os.path.splitext(os.path.basename(path))[0] == digest
+
+        # both nodes of "Layer One" link the same style file
+        with open(projecttopping_file_path) as yamlfile:
+            projecttopping_data = yaml.safe_load(yamlfile)
+            layer_one_stylefiles = set()
+            for node in projecttopping_data["layertree"]:
+                for childnode in list(node.values())[0]["child-nodes"]:
+                    if "Layer One" in childnode:
+                        layer_one_stylefiles.add(childnode["Layer One"]["qmlstylefile"])
+            assert len(layer_one_stylefiles) == 1
+
+    def test_archive_target(self):
+        """
+        The files in the zip and tar archives are the same as in the directories of the target.
+        """
+        project, export_settings = self._make_project_and_export_settings()
+        project_topping = ProjectTopping()
+        project_topping.parse_project(project, export_settings)
+        subdir = "freddys_projects/this_specific_project"
+
+        maindir = os.path.join(self.projecttopping_test_path, "directory_repository")
+        target = Target("freddys", maindir, subdir)
+        projecttopping_link = project_topping.generate_files(target)
+        files = {}
+        for toppingfileinfo in target.toppingfileinfo_list:
+            with open(os.path.join(maindir, toppingfileinfo["path"]), "rb") as file:
+                files[toppingfileinfo["path"]] = file.read()
+
+        for archive_name, compression in [
+            ("freddys.zip", "deflated"),
+            ("freddys.tar.gz", "gz"),
+        ]:
+            archive_path = os.path.join(self.basetestpath, archive_name)
+            with ArchiveTarget(
+                "freddys", archive_path, subdir, compression=compression
+            ) as archive_target:
+                archive_link = project_topping.generate_files(archive_target)
+            assert archive_link == projecttopping_link
+            assert archive_target.toppingfileinfo_list == target.toppingfileinfo_list
+
+            if archive_target.archive_format == "zip":
+                with zipfile.ZipFile(archive_path) as archive:
+                    archived_files = {
+                        name: archive.read(name) for name in archive.namelist()
+                    }
+            else:
+                with tarfile.open(archive_path) as archive:
+                    archived_files = {
+                        member.name: archive.extractfile(member).read()
+                        for member in archive.getmembers()
+                    }
+            index = yaml.safe_load(archived_files.pop(ArchiveTarget.INDEX_FILENAME))
+            assert archived_files == files
+            assert {file["path"] for file in index["files"]} == set(files.keys())
+            for file in index["files"]:
+                assert file["sha256"] == hashlib.sha256(files[file["path"]]).hexdigest()
+
+    def test_memory_target(self):
+        """
+        The files in memory are the same as in the directories of the target.
+        """
+        project, export_settings = self._make_project_and_export_settings()
+        project_topping = ProjectTopping()
+        project_topping.parse_project(project, export_settings)
+        subdir = "freddys_projects/this_specific_project"
+
+        maindir = os.path.join(self.projecttopping_test_path, "memory_repository")
+        target = Target("freddys", maindir, subdir)
+        projecttopping_link = project_topping.generate_files(target)
+
+        memory_target = MemoryTarget("freddys", subdir)
+        assert project_topping.generate_files(memory_target) == projecttopping_link
+        assert memory_target.toppingfileinfo_list == target.toppingfileinfo_list
+        for toppingfileinfo in target.toppingfileinfo_list:
+            with open(os.path.join(maindir, toppingfileinfo["path"]), "rb") as file:
+                assert memory_target.file(toppingfileinfo["path"]) == file.read()
+        assert yaml.safe_load(memory_target.file(projecttopping_link))["layertree"]
+
+        stream = io.BytesIO()
+        memory_target.write_archive(stream)
+        with zipfile.ZipFile(stream) as archive:
+            for name, data in memory_target.files.items():
+                assert archive.read(name) == data
+
+        # parsed into the memory target the exported files are received directly (nothing written to the temporary directory)
+        for lazy in [False, True]:
+            project_topping = ProjectTopping()
+            received_target = MemoryTarget("freddys", subdir)
+            assert project_topping.parse_project(
+                project,
+                export_settings,
+                max_workers=4,
+                target=received_target,
+                lazy=lazy,
+            )
+            assert not os.listdir(project_topping.temporary_toppingfile_dir)
+            assert (
+                project_topping.generate_files(received_target) == projecttopping_link
+            )
+            assert received_target.files == memory_target.files
+            # the unused temporary directory is removed
+            assert not os.path.exists(project_topping.temporary_toppingfile_dir)
+
+    def test_progress_and_cancel(self):
+        """
+        The progress is reported while parsing and generating and both can be canceled by the feedback.
+        The task parses the project read from the file in its own thread.
+        """
+        project, export_settings = self._make_project_and_export_settings()
+        subdir = "freddys_projects/this_specific_project"
+
+        project_topping = ProjectTopping()
+        progress = []
+        project_topping.progress.connect(
+            lambda phase, done, total: progress.append((phase, done, total))
+        )
+        feedback = QgsFeedback()
+        assert project_topping.parse_project(
+            project, export_settings, feedback=feedback
+        )
+        maindir = os.path.join(self.projecttopping_test_path, "progress_repository")
+        assert project_topping.generate_files(
+            Target("freddys", maindir, subdir), feedback=feedback
+        )
+        for phase in ["parse", "generate"]:
+            phase_progress = [
+                (done, total) for name, done, total in progress if name == phase
+            ]
+            assert phase_progress == sorted(phase_progress)
+            assert phase_progress[-1][0] == phase_progress[-1][1]
+        assert feedback.progress() == 100
+
+        # canceled after the first reported progress
+        feedback = QgsFeedback()
+        project_topping = ProjectTopping()
+        project_topping.progress.connect(lambda *args: feedback.cancel())
+        assert not project_topping.parse_project(
+            project, export_settings, feedback=feedback
+        )
+        project_topping = ProjectTopping()
+        project_topping.parse_project(project, export_settings)
+        feedback = QgsFeedback()
+        project_topping.progress.connect(lambda *args: feedback.cancel())
+        canceled_dir = os.path.join(
+            self.projecttopping_test_path, "canceled_repository"
+        )
+        assert (
+            project_topping.generate_files(
+                Target("freddys", canceled_dir, subdir), feedback=feedback
+            )
+            is None
+        )
+        assert not os.listdir(os.path.join(canceled_dir, subdir, "projecttopping"))
+
+        # canceled the previous projecttopping is kept
+        yaml_dir = os.path.join(maindir, subdir, "projecttopping")
+        with open(os.path.join(yaml_dir, "freddys.yaml")) as file:
+            previous_yaml = file.read()
+        canceling_feedback = QgsFeedback()
+        project_topping.progress.connect(lambda *args: canceling_feedback.cancel())
+        assert (
+            project_topping.generate_files(
+                Target("freddys", maindir, subdir), feedback=canceling_feedback
+            )
+            is None
+        )
+        assert os.listdir(yaml_dir) == ["freddys.yaml"]
+        with open(os.path.join(yaml_dir, "freddys.yaml")) as file:
+            assert file.read() == previous_yaml
+
+        project_file = os.path.join(self.projecttopping_test_path, "progress.qgz")
+        assert project.write(project_file)
+        task_dir = os.path.join(self.projecttopping_test_path, "task_repository")
+        task = ProjectToppingTask(
+            "Export topping",
+            ProjectTopping(),
+            Target("freddys", task_dir, subdir),
+            project_file,
+            export_settings,
+        )
+        assert task.run()
+        assert task.projecttopping_link
+        assert os.path.exists(os.path.join(task_dir, task.projecttopping_link))
+        assert task.progress() == 100
+
+        # the settings of the nodes are used with the nodes of the project read by the task
+        layer_three_node = project.layerTreeRoot().findLayer(
+            project.mapLayersByName("Layer Three")[0]
+        )
+        node_export_settings = ExportSettings()
+        node_export_settings.set_setting_values(
+            ExportSettings.ToppingType.QMLSTYLE, layer_three_node
+        )
+        node_export_settings.set_setting_values(
+            ExportSettings.ToppingType.DEFINITION, layer_three_node
+        )
+        task_project_topping = ProjectTopping()
+        task = ProjectToppingTask(
+            "Export topping",
+            task_project_topping,
+            Target("freddys", task_dir, subdir),
+            project_file,
+            node_export_settings,
+        )
+        assert task.run()
+        small_group_item = task_project_topping.layertree.items[0].items[1].items[1]
+        assert small_group_item.name == "Small Group"
+        layer_three_item = small_group_item.items[0]
+        assert layer_three_item.name == "Layer Three"
+        assert layer_three_item.properties.qmlstylefile
+        assert layer_three_item.properties.definitionfile
+        # the other node of the layer is not concerned
+        all_of_em_layer_three_item = task_project_topping.layertree.items[1].items[2]
+        assert all_of_em_layer_three_item.name == "Layer Three"
+        assert not all_of_em_layer_three_item.properties.qmlstylefile
+        assert not all_of_em_layer_three_item.properties.definitionfile
+
+        # a node not in the project
+        node_export_settings.set_setting_values(
+            ExportSettings.ToppingType.QMLSTYLE, QgsLayerTreeGroup("Detached Group")
+        )
+        task = ProjectToppingTask(
+            "Export topping",
+            ProjectTopping(),
+            Target("freddys", task_dir, subdir),
+            project_file,
+            node_export_settings,
+        )
+        assert not task.run()
+        assert "Detached Group" in task.error
+
+    def test_metrics(self):
+        """
+        The timings of the phases and the layers and the counters are collected when the metrics are set.
+        """
+        project, export_settings = self._make_project_and_export_settings()
+        project_topping = ProjectTopping()
+        project_topping.metrics = Metrics()
+        project_topping.parse_project(project, export_settings)
+        maindir = os.path.join(self.projecttopping_test_path, "metrics_repository")
+        target = Target("freddys", maindir, "freddys_projects")
+        project_topping.generate_files(target)
+        # only set on the target while generating
+        assert target.metrics is None
+
+        metrics = project_topping.metrics
+        for phase in [
+            "layertree",
+            "layerorder",
+            "mapthemes",
+            "variables",
+            "layouts",
+            "properties",
+            "export",
+            "yaml_write",
+            "file_linking",
+        ]:
+            assert metrics.phases[phase] >= 0
+        assert metrics.counters["written_files"] > 0
+        assert metrics.counters["written_bytes"] > 0
+        # the projecttopping file is not linked
+        assert metrics.counters["linked_files"] == len(target.toppingfileinfo_list) - 1
+        slowest_layers = metrics.slowest_layers(3)
+        assert len(slowest_layers) == 3
+        assert slowest_layers[0][1] >= slowest_layers[-1][1]
+
+        metrics_dict = json.loads(metrics.to_json(top=3))
+        assert metrics_dict["slowest_layers"][0]["name"] == slowest_layers[0][0]
+        assert metrics_dict["counters"] == metrics.counters
+
+        # the metrics of the target itself are kept
+        target_metrics = Metrics()
+        target.metrics = target_metrics
+        project_topping.generate_files(target)
+        assert target.metrics is target_metrics
+        assert not target_metrics.counters
+
+        # disabled by default
+        assert ProjectTopping().metrics is None
+
+    def test_load_files(self):
+        """
+        The loaded ProjectTopping is the same as the generated one and generates the same files again.
+        The linked toppingfiles are read only when needed.
+        """
+        project, export_settings = self._make_project_and_export_settings()
+        export_settings.mapthemes_delta = True
+        project_topping = ProjectTopping()
+        project_topping.parse_project(project, export_settings)
+        subdir = "freddys_projects/this_specific_project"
+
+        maindir = os.path.join(self.projecttopping_test_path, "loaded_repository")
+        projecttopping_link = project_topping.generate_files(
+            Target("freddys", maindir, subdir)
+        )
+
+        loaded_project_topping = ProjectTopping()
+        assert loaded_project_topping.load_files(Target("freddys", maindir, subdir))
+        assert not ProjectTopping().load_files(Target("nobody", maindir, subdir))
+
+        # the map themes are expanded
+        assert loaded_project_topping.mapthemes == project_topping.mapthemes
+        assert loaded_project_topping.mapthemes.delta
+        assert loaded_project_topping.layerorder == project_topping.layerorder
+        assert loaded_project_topping.properties == project_topping.properties
+        assert (
+            loaded_project_topping.layertree.item_count()
+            == project_topping.layertree.item_count()
+        )
+        layer_one_item = loaded_project_topping.layertree.items[0].items[0]
+        qmlstylefile = layer_one_item.properties.qmlstylefile
+        assert isinstance(qmlstylefile, LinkedToppingfile)
+        assert qmlstylefile._path is None
+        with open(os.path.join(maindir, qmlstylefile.link), "rb") as file:
+            assert qmlstylefile.read() == file.read()
+        for layout_item in loaded_project_topping.layouts.values():
+            assert isinstance(layout_item["templatefile"], LinkedToppingfile)
+        # the path variable links the file again
+        path_variable_item = loaded_project_topping.variables[
+            "Validation Path Variable"
+        ]
+        assert path_variable_item["ispath"]
+        assert isinstance(path_variable_item["value"], LinkedToppingfile)
+        assert loaded_project_topping.variables["First Variable"] == {
+            "value": "This is a test value."
+        }
+
+        # generated again it's the same
+        regenerated_maindir = os.path.join(
+            self.projecttopping_test_path, "reloaded_repository"
+        )
+        regenerated_target = Target("freddys", regenerated_maindir, subdir)
+        assert (
+            loaded_project_topping.generate_files(regenerated_target)
+            == projecttopping_link
+        )
+        assert os.path.join(subdir, "generic", "freddys_validConfig.ini") in [
+            toppingfileinfo["path"]
+            for toppingfileinfo in regenerated_target.toppingfileinfo_list
+        ]
+        for toppingfileinfo in regenerated_target.toppingfileinfo_list:
+            with open(os.path.join(maindir, toppingfileinfo["path"])) as file, open(
+                os.path.join(regenerated_maindir, toppingfileinfo["path"])
+            ) as regenerated_file:
+                assert file.read() == regenerated_file.read()
+
+        # from memory
+        memory_target = MemoryTarget("freddys", subdir)
+        project_topping.generate_files(memory_target)
+        memory_project_topping = ProjectTopping()
+        assert memory_project_topping.load_files(memory_target)
+        memory_qmlstylefile = (
+            memory_project_topping.layertree.items[0].items[0].properties.qmlstylefile
+        )
+        assert memory_qmlstylefile.read() == qmlstylefile.read()
+        with open(memory_qmlstylefile, "rb") as file:
+            assert file.read() == qmlstylefile.read()
+
+    def test_load_files_from_archive(self):
+        """
+        The ProjectTopping loaded from the zip and tar archives is the same as the one loaded from the directories and generates the same files again.
+        """
+        project, export_settings = self._make_project_and_export_settings()
+        project_topping = ProjectTopping()
+        project_topping.parse_project(project, export_settings)
+        subdir = "freddys_projects/this_specific_project"
+
+        maindir = os.path.join(self.projecttopping_test_path, "archived_repository")
+        target = Target("freddys", maindir, subdir)
+        project_topping.generate_files(target)
+        loaded_project_topping = ProjectTopping()
+        assert loaded_project_topping.load_files(target)
+
+        for archive_name in ["loaded.zip", "loaded.tar.gz"]:
+            archive_path = os.path.join(self.basetestpath, archive_name)
+            with ArchiveTarget("freddys", archive_path, subdir) as archive_target:
+                project_topping.generate_files(archive_target)
+
+            with ArchiveTarget("freddys", archive_path, subdir) as archive_target:
+                archived_project_topping = ProjectTopping()
+                assert archived_project_topping.load_files(archive_target)
+                assert ToppingDiff(
+                    loaded_project_topping, archived_project_topping
+                ).is_empty()
+
+                # generated again from the archive it's the same
+                regenerated_maindir = os.path.join(
+                    self.projecttopping_test_path, "unarchived_repository"
+                )
+                regenerated_target = Target("freddys", regenerated_maindir, subdir)
+                archived_project_topping.generate_files(regenerated_target)
+                # the linked files are written to one temporary directory of the archive target
+                temporary_dir = archive_target._temporary_dir
+                assert os.listdir(
+                    os.path.join(temporary_dir, ProjectTopping.LAYERSTYLE_TYPE)
+                )
+            # and removed when it's closed
+            assert not os.path.exists(temporary_dir)
+            for toppingfileinfo in regenerated_target.toppingfileinfo_list:
+                with open(
+                    os.path.join(maindir, toppingfileinfo["path"]), "rb"
+                ) as file, open(
+                    os.path.join(regenerated_maindir, toppingfileinfo["path"]), "rb"
+                ) as regenerated_file:
+                    assert file.read() == regenerated_file.read()
+
+            # only read, the archive is kept as it is
+            with ArchiveTarget("freddys", archive_path, subdir) as archive_target:
+                assert ToppingDiff.from_targets(target, archive_target).is_empty()
+            assert ProjectTopping().load_files(
+                ArchiveTarget("freddys", archive_path, subdir)
+            )
+
+        # not an archive
+        assert not ProjectTopping().load_files(
+            ArchiveTarget("freddys", os.path.join(maindir, subdir), subdir)
+        )
+
+    def test_generate_project(self):
+        """
+        A project generated from the parsed and from the loaded ProjectTopping contains the layertree, the styles, the map themes, the variables and the layouts.
+        The layers multiple times in the tree are created once.
+        """
+        project, export_settings = self._make_project_and_export_settings()
+        project_topping = ProjectTopping()
+        project_topping.parse_project(project, export_settings)
+        subdir = "freddys_projects/this_specific_project"
+        maindir = os.path.join(self.projecttopping_test_path, "generated_repository")
+        project_topping.generate_files(Target("freddys", maindir, subdir))
+
+        for generated_project in [
+            project_topping.generate_project(),
+            ProjectTopping().generate_project(Target("freddys", maindir, subdir)),
+        ]:
+            assert len(generated_project.mapLayers()) == 5
+            root = generated_project.layerTreeRoot()
+            assert [node.name() for node in root.children()] == [
+                "Big Group",
+                "All of em",
+            ]
+            allofemgroup = root.findGroup("All of em")
+            assert [node.name() for node in allofemgroup.children()] == [
+                "Layer One",
+                "Layer Two",
+                "Layer Three",
+                "Layer Four",
+                "Layer Five",
+            ]
+            assert [
+                node.itemVisibilityChecked() for node in allofemgroup.children()
+            ] == [False, True, False, True, True]
+            assert root.findGroup("Small Group").parent().name() == "Medium Group"
+
+            layer_one = generated_project.mapLayersByName("Layer One")[0]
+            assert {"french 1", "robot 1"} <= set(layer_one.styleManager().styles())
+            assert set(generated_project.mapThemeCollection().mapThemes()) == {
+                "French Theme",
+                "Robot Theme",
+            }
+            assert (
+                generated_project.customVariables()["First Variable"]
+                == "This is a test value."
+            )
+            assert {
+                layout.name()
+                for layout in generated_project.layoutManager().printLayouts()
+            } == {"Layout One", "Layout Three"}
+
+    def test_generate_project_concurrently(self):
+        """
+        The layers with a source are created by worker threads, the failed ones are reported.
+        """
+        project, export_settings = self._make_project_and_export_settings()
+        project_topping = ProjectTopping()
+        project_topping.parse_project(project, export_settings)
+        broken_item = ProjectTopping.LayerTreeItem()
+        broken_item.name = "Broken Layer"
+        broken_item.properties.provider = "ogr"
+        broken_item.properties.uri = os.path.join(
+            self.projecttopping_test_path, "nowhere.gpkg|layername=nothing"
+        )
+        project_topping.layertree.items.append(broken_item)
+
+        project_generator = ProjectGenerator(project_topping, max_workers=4, timeout=60)
+        generated_project = project_generator.generate()
+        # the invalid layer is added anyway
+        assert len(generated_project.mapLayers()) == 6
+        assert list(project_generator.failures.keys()) == ["Broken Layer"]
+        for layer in generated_project.mapLayers().values():
+            # moved to the main thread
+            assert layer.thread() == generated_project.thread()
+        layer_one = generated_project.mapLayersByName("Layer One")[0]
+        assert layer_one.isValid()
+        assert {"french 1", "robot 1"} <= set(layer_one.styleManager().styles())
+
+        # the layers are created by the class of their provider (one after the other and concurrently)
+        layer_classes = {
+            "mdal": QgsMeshLayer,
+            "xyzvectortiles": QgsVectorTileLayer,
+            "unknown": QgsVectorLayer,
+        }
+        if QgsPointCloudLayer is not None:
+            layer_classes["pdal"] = QgsPointCloudLayer
+        for provider in layer_classes.keys():
+            provider_item = ProjectTopping.LayerTreeItem()
+            provider_item.name = f"{provider} Layer"
+            provider_item.properties.provider = provider
+            provider_item.properties.uri = (
+                "type=xyz&url=file:///nowhere/{z}/{x}/{y}.pbf"
+                if provider == "xyzvectortiles"
+                else os.path.join(self.projecttopping_test_path, "nowhere.file")
+            )
+            project_topping.layertree.items.append(provider_item)
+        for max_workers in [None, 4]:
+            project_generator = ProjectGenerator(
+                project_topping, max_workers=max_workers, timeout=60
+            )
+            project_generator.generate()
+            for provider, layer_class in layer_classes.items():
+                assert isinstance(
+                    project_generator.layers[f"{provider} Layer"], layer_class
+                )
+            # not valid and reported
+            assert "unknown Layer" in project_generator.failures
+
+    def test_generate_project_with_document_cache(self):
+        """
+        Every distinct style, definition and template is parsed once, also when shared between generations.
+        """
+        project, export_settings = self._make_project_and_export_settings()
+        project_topping = ProjectTopping()
+        project_topping.parse_project(project, export_settings)
+
+        document_cache = DocumentCache()
+        project_topping.generate_project(document_cache=document_cache)
+        misses = document_cache.misses
+        # qml (default, french 1, robot 1, default, french 3, default), qlr (three, four, five) and qpt (two)
+        assert 0 < misses <= 11
+        assert document_cache.evictions == 0
+
+        generated_project = project_topping.generate_project(
+            document_cache=document_cache
+        )
+        assert document_cache.misses == misses
+        assert document_cache.hits >= misses
+        assert len(generated_project.mapLayers()) == 5
+
+        # the shared documents are not changed by applying them (only clones of them)
+        # layer one in the big group
+        qmlstylefile = (
+            project_topping.layertree.items[0].items[0].properties.qmlstylefile
+        )
+        assert (
+            document_cache.document(os.fspath(qmlstylefile)).toString()
+            == DocumentCache().document(os.fspath(qmlstylefile)).toString()
+        )
+
+        # with a size of one the documents are evicted
+        small_document_cache = DocumentCache(max_size=1)
+        project_topping.generate_project(document_cache=small_document_cache)
+        assert small_document_cache.statistics()["documents"] == 1
+        assert small_document_cache.evictions == small_document_cache.misses - 1
+
+        # a file that cannot be parsed is reported (with its line) and not cached
+        broken_qmlstylefile = os.path.join(self.projecttopping_test_path, "broken.qml")
+        with open(broken_qmlstylefile, "w") as file:
+            file.write("<!DOCTYPE qgis>\n<qgis>\n<renderer-v2>\n</qgis>\n")
+        documents = document_cache.statistics()["documents"]
+        with self.assertRaises(DocumentCache.ParseError) as context:
+            document_cache.document(broken_qmlstylefile)
+        assert context.exception.line == 4
+        assert document_cache.statistics()["documents"] == documents
+
+        project_topping.layertree.items[0].items[
+            0
+        ].properties.qmlstylefile = broken_qmlstylefile
+        messages = []
+        project_topping.stdout.connect(
+            lambda text, level: messages.append((text, level))
+        )
+        generated_project = project_topping.generate_project(
+            document_cache=document_cache
+        )
+        assert len(generated_project.mapLayers()) == 5
+        assert any(
+            "Could not parse" in text and level == Qgis.Warning
+            for text, level in messages
+        )
+        assert document_cache.statistics()["documents"] == documents
+
+    def test_topping_diff(self):
+        """
+        The diff of the topping files generated before and after changing the project contains the moved and removed nodes, the changed style and variable.
+        Applied to the old ProjectTopping the patch brings it to the new one.
+        """
+        project, export_settings = self._make_project_and_export_settings()
+        project_topping = ProjectTopping()
+        project_topping.parse_project(project, export_settings)
+        subdir = "freddys_projects/this_specific_project"
+        old_target = Target(
+            "freddys",
+            os.path.join(self.projecttopping_test_path, "old_repository"),
+            subdir,
+        )
+        project_topping.generate_files(old_target)
+
+        # move layer five to the big group, remove layer four from all of em, change the default style of layer one and a variable
+        root = project.layerTreeRoot()
+        layer_five = project.mapLayersByName("Layer Five")[0]
+        medium_group = root.findGroup("Medium Group")
+        layer_five_node = medium_group.findLayer(layer_five)
+        root.findGroup("Big Group").addChildNode(layer_five_node.clone())
+        medium_group.removeChildNode(layer_five_node)
+        root.findGroup("All of em").removeLayer(
+            project.mapLayersByName("Layer Four")[0]
+        )
+        project.mapLayersByName("Layer One")[0].setDisplayExpression("'changed'")
+        QgsExpressionContextUtils.setProjectVariable(
+            project, "First Variable", "This is a changed value."
+        )
+
+        project_topping = ProjectTopping()
+        project_topping.parse_project(project, export_settings)
+        new_target = Target(
+            "freddys",
+            os.path.join(self.projecttopping_test_path, "new_repository"),
+            subdir,
+        )
+        project_topping.generate_files(new_target)
+
+        assert ToppingDiff.from_targets(old_target, old_target).is_empty()
+        topping_diff = ToppingDiff.from_targets(old_target, new_target)
+        summary = topping_diff.summary()
+        assert summary["layertree"]["move"] == 1
+        assert summary["layertree"]["remove"] == 1
+        # the default style of both layer one nodes
+        assert summary["layertree"]["change"] == 2
+        assert summary["variables"] == {"change": 1}
+        assert "mapthemes" not in summary
+        assert "layouts" not in summary
+
+        # only the changed style is shipped
+        patch = json.loads(json.dumps(topping_diff.patch()))
+        assert len(patch["files"]) == 1
+
+        old_project_topping = ProjectTopping()
+        assert old_project_topping.load_files(old_target)
+        ToppingDiff.apply_patch(old_project_topping, patch)
+        new_project_topping = ProjectTopping()
+        assert new_project_topping.load_files(new_target)
+        assert ToppingDiff(old_project_topping, new_project_topping).is_empty()
+
+        with self.assertRaises(ValueError):
+            ToppingDiff.apply_patch(old_project_topping, {"format": "unknown"})
+
+    def test_topping_diff_layertree(self):
+        """
+        The layertree operations of ToppingDiff on ProjectToppings made in memory: moves, nodes with the same name, removed groups and reordering.
+        Applied to the old ProjectTopping the patch brings it to the new one.
+        """
+
+        def assert_patch_applies(old_project_topping, new_project_topping):
+            patch = json.loads(
+                json.dumps(
+                    ToppingDiff(old_project_topping, new_project_topping).patch()
+                )
+            )
+            ToppingDiff.apply_patch(old_project_topping, patch)
+            assert ToppingDiff(old_project_topping, new_project_topping).is_empty()
+
+        old_layertree = [
+            ("Big Group", [("Layer One", None), ("Layer Two", None)]),
+            ("Medium Group", [("Layer Three", None), ("Layer Four", None)]),
+        ]
+
+        # move layer four to the big group
+        new_layertree = [
+            (
+                "Big Group",
+                [("Layer One", None), ("Layer Two", None), ("Layer Four", None)],
+            ),
+            ("Medium Group", [("Layer Three", None)]),
+        ]
+        topping_diff = ToppingDiff(
+            self._make_layertree_topping(old_layertree),
+            self._make_layertree_topping(new_layertree),
+        )
+        assert topping_diff.summary() == {"layertree": {"move": 1}}
+        assert topping_diff.operations[0]["path"] == ["Medium Group", "Layer Four"]
+        assert topping_diff.operations[0]["to"] == ["Big Group", "Layer Four"]
+        assert_patch_applies(
+            self._make_layertree_topping(old_layertree),
+            self._make_layertree_topping(new_layertree),
+        )
+
+        # nodes with the same name are identified by their occurrence
+        new_layertree = [
+            (
+                "Big Group",
+                [
+                    ("Layer One", None),
+                    ("Layer Two", None),
+                    ("Layer Two", None),
+                    ("Layer Two", None, {"checked": False}),
+                ],
+            ),
+            ("Medium Group", [("Layer Three", None), ("Layer Four", None)]),
+        ]
+        topping_diff = ToppingDiff(
+            self._make_layertree_topping(old_layertree),
+            self._make_layertree_topping(new_layertree),
+        )
+        assert topping_diff.summary() == {"layertree": {"add": 2}}
+        assert [operation["path"] for operation in topping_diff.operations] == [
+            ["Big Group", "Layer Two[2]"],
+            ["Big Group", "Layer Two[3]"],
+        ]
+        assert topping_diff.operations[1]["state"] == {"checked": False}
+        assert_patch_applies(
+            self._make_layertree_topping(old_layertree),
+            self._make_layertree_topping(new_layertree),
+        )
+        topping_diff = ToppingDiff(
+            self._make_layertree_topping(new_layertree),
+            self._make_layertree_topping(old_layertree),
+        )
+        # removed in reversed order, so the occurrence of the others does not change
+        assert topping_diff.summary() == {"layertree": {"remove": 2}}
+        assert [operation["path"] for operation in topping_diff.operations] == [
+            ["Big Group", "Layer Two[3]"],
+            ["Big Group", "Layer Two[2]"],
+        ]
+        assert_patch_applies(
+            self._make_layertree_topping(new_layertree),
+            self._make_layertree_topping(old_layertree),
+        )
+
+        # a removed group is removed with its children in one operation
+        new_layertree = [
+            ("Big Group", [("Layer One", None), ("Layer Two", None)]),
+        ]
+        topping_diff = ToppingDiff(
+            self._make_layertree_topping(old_layertree),
+            self._make_layertree_topping(new_layertree),
+        )
+        assert topping_diff.operations == [
+            {"op": "remove", "section": "layertree", "path": ["Medium Group"]}
+        ]
+        assert_patch_applies(
+            self._make_layertree_topping(old_layertree),
+            self._make_layertree_topping(new_layertree),
+        )
+
+        # reordering the groups and the layers of a group
+        new_layertree = [
+            ("Medium Group", [("Layer Four", None), ("Layer Three", None)]),
+            ("Big Group", [("Layer One", None), ("Layer Two", None)]),
+        ]
+        topping_diff = ToppingDiff(
+            self._make_layertree_topping(old_layertree),
+            self._make_layertree_topping(new_layertree),
+        )
+        assert topping_diff.summary() == {"layertree": {"order": 2}}
+        assert {
+            tuple(operation["path"]): operation["children"]
+            for operation in topping_diff.operations
+        } == {
+            (): ["Medium Group", "Big Group"],
+            ("Medium Group",): ["Layer Four", "Layer Three"],
+        }
+        assert_patch_applies(
+            self._make_layertree_topping(old_layertree),
+            self._make_layertree_topping(new_layertree),
+        )
+
+    def test_parse_project_with_export_cache(self):
+        """
+        Parse it twice with the same export cache.
+        On the second run the (unchanged) styles are taken from the cache.
+        """
+        project, export_settings = self._make_project_and_export_settings()
+        cache_dir = os.path.join(
+            self.projecttopping_test_path, "freddys_repository", ".toppingmaker_cache"
+        )
+
+        export_cache = ExportCache(cache_dir)
+        project_topping = ProjectTopping()
+        project_topping.parse_project(
+            project, export_settings, export_cache=export_cache
+        )
+        assert export_cache.hits == 0
+        assert export_cache.unchanged == 0
+        exported_files = export_cache.misses
+        assert os.path.exists(os.path.join(cache_dir, ExportCache.MANIFEST_FILENAME))
+
+        export_cache = ExportCache(cache_dir)
+        cached_project_topping = ProjectTopping()
+        cached_project_topping.metrics = Metrics()
+        cached_project_topping.parse_project(
+            project, export_settings, export_cache=export_cache
+        )
+        # 2 x 6 qml files (the layers are multiple times in the tree)
+        assert export_cache.hits >= 12
+        # only the files taken from the cache are hits
+        assert (
+            export_cache.hits == cached_project_topping.metrics.counters["cached_files"]
+        )
+        # the definition and layout template files are exported again and only compared
+        assert export_cache.unchanged >= 2
+        assert (
+            export_cache.hits + export_cache.unchanged + export_cache.misses
+            == exported_files
+        )
+        assert export_cache.statistics() == {
+            "hits": export_cache.hits,
+            "unchanged": export_cache.unchanged,
+            "misses": export_cache.misses,
+        }
+
+        # the toppingfiles are cached by their filename relative to their type
+        with open(os.path.join(cache_dir, ExportCache.MANIFEST_FILENAME)) as file:
+            manifest = json.load(file)
+        assert {key.split("/")[0] for key in manifest} == {
+            ProjectTopping.LAYERSTYLE_TYPE,
+            ProjectTopping.LAYERDEFINITION_TYPE,
+            ProjectTopping.LAYOUTTEMPLATE_TYPE,
+        }
+        # so files with the same name of different types (or in different temporary directories) are not mixed up
+        same_name_cache_dir = os.path.join(self.basetestpath, "same_name_cache")
+        for run in range(2):
+            export_pool = ExportPool(None, ExportCache(same_name_cache_dir))
+            for type in [
+                ProjectTopping.LAYERSTYLE_TYPE,
+                ProjectTopping.LAYERDEFINITION_TYPE,
+            ]:
+                path = export_pool.toppingfile_path(
+                    type, tempfile.mkdtemp(), "same_name.xml"
+                )
+                if not export_pool.fetch(path, type):
+                    assert run == 0
+                    export_pool.write(path, lambda: type, type)
+                with open(path) as file:
+                    assert file.read() == type
+            export_pool.close()
+            export_pool.export_cache.save()
+
+        for item, cached_item in zip(
+            project_topping.layertree.items[0].items,
+            cached_project_topping.layertree.items[0].items,
+        ):
+            if item.properties.qmlstylefile:
+                with open(item.properties.qmlstylefile) as file, open(
+                    cached_item.properties.qmlstylefile
+                ) as cached_file:
+                    assert file.read() == cached_file.read()
+
+    def test_parse_project_into_target(self):
+        """
+        Parse it with the target known up front. The toppingfiles are written directly into place.
+        """
+        project, export_settings = self._make_project_and_export_settings()
+        maindir = os.path.join(self.projecttopping_test_path, "freddys_repository")
+        subdir = "freddys_projects/direct_project"
+        target = Target("freddys", maindir, subdir)
+
+        project_topping = ProjectTopping()
+        project_topping.parse_project(project, export_settings, target=target)
+
+        # the style is already in the target after parsing
+        for item in project_topping.layertree.items[0].items:
+            if item.name == "Layer One":
+                assert item.properties.qmlstylefile == os.path.join(
+                    maindir, subdir, "layerstyle", "freddys_layer_one.qml"
+                )
+                assert os.path.exists(item.properties.qmlstylefile)
+
+        project_topping.generate_files(target)
+        assert len(target.toppingfileinfo_list) == 22
+        linked_paths = set()
+        for toppingfileinfo in target.toppingfileinfo_list:
+            assert os.path.exists(os.path.join(maindir, toppingfileinfo["path"]))
+            assert "freddys_freddys_" not in toppingfileinfo["path"]
+            linked_paths.add(toppingfileinfo["path"])
+        assert (
+            os.path.join(subdir, "layerstyle", "freddys_layer_one.qml") in linked_paths
+        )
+        assert (
+            os.path.join(subdir, "layerdefinition", "freddys_layer_three.qlr")
+            in linked_paths
+        )
+
+        # the files written into place are linked as they are (not copied again)
+        stored_paths = set()
+        for dirpath, _, filenames in os.walk(os.path.join(maindir, subdir)):
+            for filename in filenames:
+                stored_paths.add(
+                    os.path.relpath(os.path.join(dirpath, filename), maindir)
+                )
+        assert stored_paths == linked_paths
+
+    def test_streamed_projecttopping(self):
+        """
+        The streamed YAML is the same as the dumped projecttopping dict.
+        """
+        project_topping = ProjectTopping()
+        project, export_settings = self._make_project_and_export_settings()
+        project_topping.parse_project(project, export_settings)
+
+        maindir = os.path.join(self.projecttopping_test_path, "freddys_repository")
+        subdir = "freddys_projects/streamed_project"
+
+        stream = io.StringIO()
+        target = Target("freddys", maindir, subdir)
+        project_topping._write_projecttopping(stream, target)
+
+        dict_target = Target("freddys", maindir, subdir)
+        projecttopping_dict = project_topping._projecttopping_dict(dict_target)
+
+        assert yaml.safe_load(stream.getvalue()) == projecttopping_dict
+        # byte for byte like the projecttopping file written with yaml.dump before
+        assert stream.getvalue() == yaml.dump(projecttopping_dict)
+        assert target.toppingfileinfo_list == dict_target.toppingfileinfo_list
+
+    def test_deep_layertree(self):
+        """
+        Layertrees nested deeper than the recursion limit are parsed and written.
+        """
+        depth = sys.getrecursionlimit() + 500
+        project = QgsProject()
+        layer = QgsVectorLayer(
+            "point?crs=epsg:4326&field=id:integer", "Deep Layer", "memory"
+        )
+        project.addMapLayer(layer, False)
+        group = project.layerTreeRoot()
+        for level in range(depth):
+            group = group.addGroup("Group {}".format(level))
+        group.addLayer(layer)
+
+        export_settings = ExportSettings()
+        export_settings.set_setting_values(
+            ExportSettings.ToppingType.QMLSTYLE, None, "Deep Layer", True
+        )
+        project_topping = ProjectTopping()
+        project_topping.parse_project(project, export_settings)
+
+        item = project_topping.layertree
+        for level in range(depth):
+            assert len(item.items) == 1
+            item = item.items[0]
+            assert item.name == "Group {}".format(level)
+        assert item.items[0].name == "Deep Layer"
+        assert item.items[0].properties.qmlstylefile
+
+        maindir = os.path.join(self.projecttopping_test_path, "freddys_repository")
+        target = Target("freddys", maindir, "freddys_projects/deep_project")
+        item_dict = project_topping.layertree.item_dict(target)
+        # the root and the groups
+        for level in range(depth + 1):
+            item_dict = item_dict[next(iter(item_dict))]["child-nodes"][0]
+        assert "qmlstylefile" in item_dict["Deep Layer"]
+
+        stream = io.StringIO()
+        target = Target("freddys", maindir, "freddys_projects/deep_project")
+        project_topping._write_projecttopping(stream, target)
+        assert "Group {}:".format(depth - 1) in stream.getvalue()
+        assert "Deep Layer:" in stream.getvalue()
+
+    def test_paths_of_the_parsed_project(self):
+        """
+        The sources are written relative to the parsed project (not to the QgsProject instance).
+        """
+        project_dir = os.path.join(self.projecttopping_test_path, "relative_project")
+        os.makedirs(project_dir, exist_ok=True)
+        source_path = os.path.join(project_dir, "points.geojson")
+        with open(source_path, "w") as file:
+            file.write('{"type": "FeatureCollection", "features": []}')
+        project = QgsProject()
+        project.setFileName(os.path.join(project_dir, "project.qgz"))
+        layer = QgsVectorLayer(source_path, "Json Layer", "ogr")
+        project.addMapLayer(layer)
+
+        export_settings = ExportSettings()
+        export_settings.set_setting_values(
+            ExportSettings.ToppingType.SOURCE, None, "Json Layer", True
+        )
+        project_topping = ProjectTopping()
+        project_topping.parse_project(project, export_settings)
+        assert project_topping.layertree.items[0].properties.uri.startswith(
+            "./points.geojson"
+        )
+
+    def test_export_plan(self):
+        """
+        The settings resolved once in the export plan are the same as the looked up ones.
+        """
+        project, export_settings = self._make_project_and_export_settings()
+        export_plan = export_settings.export_plan(project)
+
+        nodes = project.layerTreeRoot().findLayers()
+        # every layer node and the four groups
+        assert len(export_plan.node_plans) == len(nodes) + 4
+        for node in nodes:
+            for type in ExportSettings.ToppingType:
+                assert export_plan.get_setting(
+                    type, node, node.name()
+                ) == export_settings.get_setting(type, node, node.name())
+            for style_name in node.layer().styleManager().styles():
+                assert export_plan.node_plan(node).qmlstyle(
+                    style_name
+                ) == export_settings.get_setting(
+                    ExportSettings.ToppingType.QMLSTYLE,
+                    node,
+                    node.name(),
+                    style_name,
+                )
+            if node.name() == "Layer One":
+                assert export_plan.node_plan(node).qmlstyle("french 1")["export"]
+                assert export_plan.node_plan(node).source["export"]
+                assert not export_plan.node_plan(node).definition
+
+    def test_export_settings_rules(self):
+        """
+        Settings defined by rules instead of listing the nodes.
+        """
+        project, export_settings = self._make_project_and_export_settings()
+
+        # all memory layers export the source
+        export_settings.add_rule(ExportSettings.ToppingType.SOURCE, provider="memory")
+        # point layers in the medium group (and below) export the robot styles with symbology only
+        export_settings.add_rule(
+            ExportSettings.ToppingType.QMLSTYLE,
+            categories=QgsMapLayer.StyleCategory.Symbology,
+            style_name="robot*",
+            group_path="Big Group/Medium Group*",
+            geometry_type="Point",
+        )
+        # but not layer five (regex with a higher priority)
+        export_settings.add_rule(
+            ExportSettings.ToppingType.QMLSTYLE,
+            export=False,
+            style_name=".*",
+            name="^Layer F(ive|our)$",
+            regex=True,
+            priority=1,
+        )
+
+        for node in project.layerTreeRoot().findLayers():
+            source_setting = export_settings.get_setting(
+                ExportSettings.ToppingType.SOURCE, node, node.name()
+            )
+            # the rule and the settings by name
+            assert source_setting["export"]
+
+            robot_setting = export_settings.get_setting(
+                ExportSettings.ToppingType.QMLSTYLE, node, node.name(), "robot 3"
+            )
+            if node.name() == "Layer Three":
+                if node.parent().name() == "Small Group":
+                    assert robot_setting["export"]
+                    assert (
+                        robot_setting["categories"]
+                        == QgsMapLayer.StyleCategory.Symbology
+                    )
+                else:
+                    # "All of em" is not in the medium group
+                    assert not robot_setting
+            if node.name() == "Layer Five":
+                assert not robot_setting["export"]
+
+            # the default style is not concerned by the rules with style_name
+            if node.name() == "Layer Four":
+                assert not export_settings.get_setting(
+                    ExportSettings.ToppingType.QMLSTYLE, node, node.name()
+                )
+
+        # the settings of the nodes are preferred to the rules
+        assert export_settings.get_setting(
+            ExportSettings.ToppingType.QMLSTYLE, None, "Layer Five"
+        )["export"]
+
+        # the facts of the nodes are not kept by the settings (only per export plan)
+        layer_three = [
+            node
+            for node in project.layerTreeRoot().findLayers()
+            if node.name() == "Layer Three" and node.parent().name() == "Small Group"
+        ][0]
+        assert (
+            export_settings.export_plan(project)
+            .node_plan(layer_three)
+            .qmlstyle("robot 3")["export"]
+        )
+        layer_three.parent().parent().setName("Renamed Group")
+        assert not export_settings.get_setting(
+            ExportSettings.ToppingType.QMLSTYLE,
+            layer_three,
+            layer_three.name(),
+            "robot 3",
+        )
+        assert (
+            not export_settings.export_plan(project)
+            .node_plan(layer_three)
+            .qmlstyle("robot 3")
+        )
+
+    def test_layer_index(self):
+        """
+        The layers are looked up by id first, so layers with the same name are not mixed up.
+        """
+        project = QgsProject()
+        first = QgsVectorLayer(
+            "point?crs=epsg:4326&field=id:integer", "Same Name", "memory"
+        )
+        second = QgsVectorLayer(
+            "linestring?crs=epsg:4326&field=id:integer", "Same Name", "memory"
+        )
+        project.addMapLayer(first)
+        project.addMapLayer(second)
+
+        layer_index = ProjectTopping.LayerIndex(project)
+        assert layer_index.layer(first.id(), "Same Name") == first
+        assert layer_index.layer(second.id(), "Same Name") == second
+        # unknown id falls back to the (first) layer with the name
+        assert layer_index.layer("unknown", "Same Name") in [first, second]
+        assert layer_index.layer(None, "Other Name") is None
+
+        for node in project.layerTreeRoot().findLayers():
+            item = ProjectTopping.LayerTreeItem()
+            assert item._layer_of_node(layer_index, node) == node.layer()
+
+    def test_provider_extractors(self):
+        """
+        The tablename and geometry column are extracted once per data source.
+        """
+        assert providers.database_table_extractor(
+            'dbname=\'bakery\' host=localhost port=5432 table="croissant"."dough" (geometry)',
+            "PostgreSQL database with PostGIS extension",
+        ) == ("dough", "geometry")
+        assert providers.ogr_extractor(
+            '/home/fred/bakery.gpkg|layername=dough|subset="id" > 1', "GPKG"
+        ) == ("dough", None)
+        assert providers.ogr_extractor("/home/fred/dough.shp", "ESRI Shapefile") == (
+            None,
+            None,
+        )
+        assert providers.wfs_extractor(
+            "typename='bakery:dough' url='https://bakery.ch/wfs' version='auto'", ""
+        ) == ("bakery:dough", None)
+
+        calls = []
+
+        def memory_extractor(uri, storage_type):
+            calls.append(uri)
+            return "table_of_{}".format(len(calls)), None
+
+        providers.provider_extractors.register("memory", memory_extractor)
+        try:
+            project, _ = self._make_project_and_export_settings()
+            project_topping = ProjectTopping()
+            project_topping.parse_project(project, ExportSettings())
+        finally:
+            providers.provider_extractors.unregister("memory")
+
+        # every layer is twice in the tree but parsed once
+        assert len(calls) == 5
+        tablenames = set()
+        for group_item in project_topping.layertree.items:
+            for item in group_item.items:
+                if not item.properties.group:
+                    tablenames.add(item.properties.tablename)
+        assert None not in tablenames
+
+    def test_compact_tree_model(self):
+        """
+        The items have no instance dicts and create the temporary directory and the styles only when needed.
+        """
+        item = ProjectTopping.LayerTreeItem()
+        assert not hasattr(item, "__dict__")
+        assert not hasattr(item.properties, "__dict__")
+        assert item._temporary_toppingfile_dir is None
+        assert not item.properties.has_styles()
+        assert item.properties._styles is None
+
+        project, export_settings = self._make_project_and_export_settings()
+        project_topping = ProjectTopping()
+        project_topping.parse_project(project, export_settings)
+        layer_one_item = project_topping.layertree.items[0].items[0]
+        assert layer_one_item.name == "Layer One"
+        assert layer_one_item.properties.has_styles()
+        assert set(layer_one_item.properties.styles.keys()) == {"french 1", "robot 1"}
+        assert os.path.isdir(project_topping.layertree.temporary_toppingfile_dir)
+
     def _make_project_and_export_settings(self):
         # ---
         # make the project
@@ -829,6 +2337,26 @@ class ToppingMakerTest(unittest.TestCase):
         self.print_info(f" Map Themes to export: {export_settings.mapthemes}")
         return project, export_settings
 
+    def _make_layertree_topping(self, layertree: list) -> ProjectTopping:
+        """
+        Returns a ProjectTopping with the layertree made of tuples (name, children or None for a layer and optionally a dict of properties).
+        """
+        project_topping = ProjectTopping()
+        # explicit stack instead of recursion like the parsing
+        stack = [(project_topping.layertree, layertree)]
+        while stack:
+            item, nodes = stack.pop()
+            for node in nodes:
+                child_item = ProjectTopping.LayerTreeItem()
+                child_item.name = node[0]
+                child_item.properties.group = node[1] is not None
+                for attribute, value in (node[2] if len(node) > 2 else {}).items():
+                    setattr(child_item.properties, attribute, value)
+                item.items.append(child_item)
+                if node[1] is not None:
+                    stack.append((child_item, node[1]))
+        return project_topping
+
     def print_info(self, text):
         logging.info(text)
 
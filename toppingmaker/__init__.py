@@ -16,6 +16,15 @@
  *                                                                         *
  ***************************************************************************/
 """
+from .archivetarget import ArchiveTarget
+from .documentcache import DocumentCache
+from .exportcache import ExportCache
 from .exportsettings import ExportSettings
+from .memorytarget import MemoryTarget
+from .metrics import Metrics
+from .projectgenerator import ProjectGenerator
 from .projecttopping import ProjectTopping
+from .providers import ProviderExtractors, provider_extractors
 from .target import Target
+from .toppingdiff import ToppingDiff
+from .toppingtask import ProjectToppingTask
@@ -0,0 +1,268 @@
+"""
+/***************************************************************************
+                              -------------------
+        git sha              : :%H$
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import contextlib
+import hashlib
+import io
+import logging
+import os
+import tarfile
+import zipfile
+
+import yaml
+
+from .target import Target
+from .utils import file_digest
+
+
+class ArchiveTarget(Target):
+    """
+    A target storing the toppingfiles in one zip or tar archive instead of a directory tree.
+    The archive has the same structure as the directories of the Target (with the sub_dir) and additionally an index.yaml listing the stored files with their size and sha256 digest:
+    <archive>
+    ├── index.yaml
+    └── <subdir>
+       ├── projecttopping
+       │  └── <projectname>.yaml
+       ├── layerstyle
+       │  └── <projectname>_<layername>.qml
+       └── layerdefinition
+          └── <projectname>_<layername>.qlr
+
+    The files are appended one after the other while they are linked. The projecttopping YAML is buffered until it's complete and appended then.
+    The links (and the path_resolver) are the same as with the Target.
+    Since a file cannot be overwritten in an archive, a file linked again with the same name is stored only once (the first one).
+
+    The archive is written to the path or the (binary) file object and completed by `close` (or on leaving the context):
+
+    ```py
+    with ArchiveTarget("freddys", "/home/fred/freddys_topping.zip", "freddys_projects") as target:
+        project_topping.generate_files(target)
+    ```
+
+    A completed archive can be read (see `ProjectTopping.load_files`). An archive that is only read is kept as it is on `close`:
+
+    ```py
+    with ArchiveTarget("freddys", "/home/fred/freddys_topping.zip", "freddys_projects") as target:
+        project_topping.load_files(target)
+    ```
+
+    :param str archive: the path of the archive or a binary file object (e.g. a stream that is not seekable with "tar").
+    :param str archive_format: "zip" or "tar". If None, it's taken from the extension of the path (tar for .tar, .tar.gz, .tgz etc.), otherwise zip.
+    :param str compression: for zip "deflated", "bzip2" or "lzma", for tar "gz", "bz2" or "xz". None to store the files uncompressed.
+    """
+
+    INDEX_FILENAME = "index.yaml"
+
+    ZIP_COMPRESSIONS = {
+        None: zipfile.ZIP_STORED,
+        "deflated": zipfile.ZIP_DEFLATED,
+        "bzip2": zipfile.ZIP_BZIP2,
+        "lzma": zipfile.ZIP_LZMA,
+    }
+    TAR_COMPRESSIONS = {None: "", "gz": "gz", "bz2": "bz2", "xz": "xz"}
+
+    def __init__(
+        self,
+        projectname: str = "project",
+        archive=None,
+        sub_dir: str = None,
+        path_resolver=None,
+        content_addressed: bool = False,
+        archive_format: str = None,
+        compression: str = None,
+    ):
+        super().__init__(projectname, None, sub_dir, path_resolver, content_addressed)
+        self.archive = archive
+        self.archive_format = archive_format or self._archive_format(archive)
+        self.compression = compression
+        # the stored files by their name in the archive with the size and the digest
+        self.members = {}
+
+        self._zipfile = None
+        self._tarfile = None
+        self._closed = False
+        # the archive opened to read the toppingfiles (see `read_toppingfile`)
+        self._reader = None
+        # the source paths of the stored files by their name in the archive
+        self._member_sources = {}
+
+    def filedir_path(self, file_dir):
+        # there is no absolute path (directory) in the archive
+        return None, self.relative_filedir_path(file_dir)
+
+    def toppingfile_path(self, type: str, path: str):
+        # the toppingfiles cannot be written into place
+        return None
+
+    @contextlib.contextmanager
+    def open_toppingfile(self, type: str, filename: str):
+        # buffered, since the other toppingfiles are appended to the archive while it's written
+        stream = io.StringIO()
+        yield stream
+        self._append(
+            self._member_name(type, filename), data=stream.getvalue().encode("utf-8")
+        )
+
+    def append(self, name: str, data: bytes):
+        """
+        Appends a file (not linked by a toppingfile) with the name (in the archive) and the content.
+        """
+        self._append(name, data=data)
+
+    def close(self):
+        """
+        Appends the index and completes the archive.
+        """
+        super().close()
+        if self._reader:
+            self._reader.close()
+            self._reader = None
+            if not self._zipfile and not self._tarfile:
+                # only read - it's kept as it is
+                self._closed = True
+        if self._closed:
+            return
+        if not self._zipfile and not self._tarfile:
+            self._open()
+        index = {
+            "projectname": self.projectname,
+            "files": [
+                {"path": name, "size": member["size"], "sha256": member["sha256"]}
+                for name, member in self.members.items()
+            ],
+        }
+        self._write_member(
+            ArchiveTarget.INDEX_FILENAME,
+            data=yaml.safe_dump(index, sort_keys=False).encode("utf-8"),
+        )
+        if self._zipfile:
+            self._zipfile.close()
+            self._zipfile = None
+        if self._tarfile:
+            self._tarfile.close()
+            self._tarfile = None
+        self._closed = True
+
+    def toppingfile_source(self, type: str, link: str) -> str:
+        # not stored as file
+        return None
+
+    def read_toppingfile(self, type: str, link: str) -> bytes:
+        """
+        Returns the content of a toppingfile linked in a projecttopping stored in the (completed) archive.
+        Raises an OSError if the archive cannot be read and a KeyError if the toppingfile is not in the archive.
+        """
+        if self._zipfile or self._tarfile:
+            raise OSError(
+                "The archive {} is being written and cannot be read before it's closed.".format(
+                    self.archive
+                )
+            )
+        if self._reader is None:
+            self._reader = self._open_reader()
+        name = link.replace(os.sep, "/")
+        if isinstance(self._reader, zipfile.ZipFile):
+            return self._reader.read(name)
+        member = self._reader.extractfile(name)
+        if member is None:
+            # not a file
+            raise KeyError(name)
+        return member.read()
+
+    def _store_toppingfile(self, type: str, path: str, filename: str):
+        self._append(self._member_name(type, filename), path=path)
+
+    def _has_toppingfile(self, type: str, filename: str) -> bool:
+        return self._member_name(type, filename) in self.members
+
+    def _member_name(self, type: str, filename: str) -> str:
+        # the names in the archive are separated by slashes
+        return os.path.join(self.relative_filedir_path(type), filename).replace(
+            os.sep, "/"
+        )
+
+    def _append(self, name: str, path: str = None, data: bytes = None):
+        if name in self.members:
+            if path is None or self._member_sources.get(name) != path:
+                logging.warning(
+                    "Toppingfile {} is already stored in the archive {}.".format(
+                        name, self.archive
+                    )
+                )
+            return
+        if not self._zipfile and not self._tarfile:
+            self._open()
+        if path is not None:
+            size = os.path.getsize(path)
+            digest = self.file_digests.get(path) or file_digest(path)
+            self._member_sources[name] = path
+        else:
+            size = len(data)
+            digest = hashlib.sha256(data).hexdigest()
+        self._write_member(name, path, data)
+        self.members[name] = {"size": size, "sha256": digest}
+
+    def _write_member(self, name: str, path: str = None, data: bytes = None):
+        if self._zipfile:
+            if path is not None:
+                self._zipfile.write(path, name)
+            else:
+                self._zipfile.writestr(name, data)
+        else:
+            if path is not None:
+                self._tarfile.add(path, name)
+            else:
+                tarinfo = tarfile.TarInfo(name)
+                tarinfo.size = len(data)
+                self._tarfile.addfile(tarinfo, io.BytesIO(data))
+
+    def _open(self):
+        if self.archive_format == "tar":
+            # stream mode (|), so it can be written to streams that are not seekable
+            mode = "w|{}".format(ArchiveTarget.TAR_COMPRESSIONS[self.compression])
+            if isinstance(self.archive, (str, os.PathLike)):
+                self._tarfile = tarfile.open(self.archive, mode)
+            else:
+                self._tarfile = tarfile.open(fileobj=self.archive, mode=mode)
+        else:
+            self._zipfile = zipfile.ZipFile(
+                self.archive,
+                "w",
+                compression=ArchiveTarget.ZIP_COMPRESSIONS[self.compression],
+            )
+
+    def _open_reader(self):
+        is_path = isinstance(self.archive, (str, os.PathLike))
+        if not is_path:
+            self.archive.seek(0)
+        try:
+            if self.archive_format == "tar":
+                if is_path:
+                    return tarfile.open(self.archive, "r:*")
+                return tarfile.open(fileobj=self.archive, mode="r:*")
+            return zipfile.ZipFile(self.archive, "r")
+        except (zipfile.BadZipFile, tarfile.TarError) as exception:
+            raise OSError(
+                "The archive {} cannot be read: {}".format(self.archive, exception)
+            ) from exception
+
+    @staticmethod
+    def _archive_format(archive) -> str:
+        if isinstance(archive, (str, os.PathLike)):
+            name = os.fspath(archive).lower()
+            if name.endswith((".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")):
+                return "tar"
+        return "zip"
@@ -0,0 +1,105 @@
+"""
+/***************************************************************************
+                              -------------------
+        git sha              : :%H$
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import hashlib
+from collections import OrderedDict
+
+from qgis.PyQt.QtXml import QDomDocument
+
+
+class DocumentCache:
+    """
+    Keeps the parsed documents of the toppingfiles (QML styles, QLR definitions and QPT templates) applied when generating a project.
+
+    Every file (by path) is read once and every distinct content is parsed once, so the layers linking the same file or a file with identical content share the document.
+    The documents are kept by the sha256 digest of their content. When there are more than max_size, the least recently used one is evicted.
+
+    The hits (document reused), misses (content parsed) and evictions are counted for tuning the size.
+
+    The documents are shared: They must not be modified by the caller (copy them with `cloneNode` if needed).
+    A file that cannot be parsed raises a `DocumentCache.ParseError` and is not cached.
+    """
+
+    class ParseError(Exception):
+        """
+        Raised when the content of a file is not a valid XML document.
+        """
+
+        def __init__(self, path: str, message: str, line: int, column: int):
+            super().__init__(f"{path}:{line}:{column}: {message}")
+            self.path = path
+            self.message = message
+            self.line = line
+            self.column = column
+
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # the digests of the content by path
+        self._digests = {}
+        self._documents = OrderedDict()
+
+    def document(self, path: str) -> QDomDocument:
+        """
+        Returns the parsed document of the file.
+
+        :raises DocumentCache.ParseError: if the content is not a valid XML document.
+        """
+        content = None
+        digest = self._digests.get(path)
+        if digest is None:
+            content = self._read(path)
+            digest = hashlib.sha256(content).hexdigest()
+            self._digests[path] = digest
+
+        document = self._documents.get(digest)
+        if document is not None:
+            self.hits += 1
+            self._documents.move_to_end(digest)
+            return document
+
+        self.misses += 1
+        if content is None:
+            # read before, but evicted since
+            content = self._read(path)
+        document = QDomDocument()
+        result, message, line, column = document.setContent(content)
+        if not result:
+            raise DocumentCache.ParseError(path, message, line, column)
+        self._documents[digest] = document
+        if len(self._documents) > self.max_size:
+            self._documents.popitem(last=False)
+            self.evictions += 1
+        return document
+
+    def statistics(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "documents": len(self._documents),
+        }
+
+    def clear(self):
+        self._digests = {}
+        self._documents = OrderedDict()
+
+    @staticmethod
+    def _read(path: str) -> bytes:
+        with open(path, "rb") as file:
+            return file.read()
@@ -0,0 +1,139 @@
+"""
+/***************************************************************************
+                              -------------------
+        git sha              : :%H$
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import json
+import logging
+import os
+import shutil
+import threading
+
+from .memorytarget import MemoryToppingfile
+
+
+class ExportCache:
+    """
+    A persistent cache of the toppingfiles exported on parsing a QGIS project.
+
+    It's a directory (e.g. next to the target) containing a manifest and the files of the previous export:
+    <cache_dir>
+    ├── manifest.json
+    └── files
+       ├── layerstyle
+       │  └── <layername>.qml
+       └── layouttemplate
+          └── <layoutname>.qpt
+
+    The manifest stores a fingerprint per toppingfile (by its filename relative to its type, like "layerstyle/<layername>.qml"). When the fingerprint of an item is unchanged since the last run, the file is reused from the cache instead of exporting it again.
+    The fingerprint of a style is made of its (stored) style XML and the categories, so a cached style does not need to be applied to the layer to be exported.
+    For the other toppingfiles it's the digest of the serialized content. They need to be exported anyway and are only compared with the previous run.
+
+    The `hits` are the files taken from the cache (not exported), the `misses` the exported files that changed (or are new) since the last run.
+    The exported files with the same content as on the last run are counted separately as `unchanged` (they are no hits, the export was not saved).
+    """
+
+    MANIFEST_FILENAME = "manifest.json"
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.unchanged = 0
+        self.misses = 0
+
+        self._files_dir = os.path.join(cache_dir, "files")
+        self._manifest_path = os.path.join(cache_dir, ExportCache.MANIFEST_FILENAME)
+        self._manifest = {}
+        self._lock = threading.Lock()
+
+        if os.path.exists(self._manifest_path):
+            try:
+                with open(self._manifest_path) as manifest_file:
+                    self._manifest = json.load(manifest_file)
+            except (OSError, ValueError) as exception:
+                logging.warning(
+                    "Could not read the export cache manifest {}: {}".format(
+                        self._manifest_path, exception
+                    )
+                )
+
+    def is_fresh(self, key: str, fingerprint: str) -> bool:
+        """
+        Returns True (a hit) if the fingerprint is unchanged since the last run.
+        """
+        with self._lock:
+            fresh = self._manifest.get(key) == fingerprint
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return fresh
+
+    def is_unchanged(self, key: str, digest: str) -> bool:
+        """
+        Returns True if the digest of an exported file is unchanged since the last run (counted as unchanged, not as a hit).
+        """
+        with self._lock:
+            unchanged = self._manifest.get(key) == digest
+            if unchanged:
+                self.unchanged += 1
+            else:
+                self.misses += 1
+        return unchanged
+
+    def fetch(self, key: str, fingerprint: str, path: str) -> bool:
+        """
+        Copies the cached file to the path (or writes it into the MemoryTarget of a MemoryToppingfile) if the fingerprint is unchanged.
+        Returns False (a miss) if it needs to be exported.
+        """
+        cached_path = os.path.join(self._files_dir, key)
+        if not os.path.exists(cached_path):
+            with self._lock:
+                self.misses += 1
+            return False
+        if not self.is_fresh(key, fingerprint):
+            return False
+        if isinstance(path, MemoryToppingfile):
+            with open(cached_path, "rb") as cached_file:
+                path.write(cached_file.read())
+        else:
+            shutil.copyfile(cached_path, path)
+        return True
+
+    def store(self, key: str, fingerprint: str, path: str = None):
+        """
+        Stores the fingerprint the file has been exported with.
+        If the path is passed, a copy of the file is kept to fetch it on the next run.
+        """
+        if path:
+            cached_path = os.path.join(self._files_dir, key)
+            os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+            if isinstance(path, MemoryToppingfile):
+                with open(cached_path, "wb") as cached_file:
+                    cached_file.write(path.read())
+            else:
+                shutil.copyfile(path, cached_path)
+        with self._lock:
+            self._manifest[key] = fingerprint
+
+    def save(self):
+        """
+        Writes the manifest for the next run.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with self._lock:
+            with open(self._manifest_path, "w") as manifest_file:
+                json.dump(self._manifest, manifest_file, indent=2, sort_keys=True)
+
+    def statistics(self) -> dict:
+        return {"hits": self.hits, "unchanged": self.unchanged, "misses": self.misses}
@@ -0,0 +1,256 @@
+"""
+/***************************************************************************
+                              -------------------
+        git sha              : :%H$
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .exportcache import ExportCache
+from .memorytarget import MemoryToppingfile
+from .metrics import Metrics
+from .target import Target
+from .utils import file_digest
+
+
+class ExportPool:
+    """
+    Writes the toppingfiles exported while parsing a QGIS project.
+
+    The QGIS bound part (building the document of a style, definition etc.) stays on the owning thread of the caller.
+    What is handed over to the pool is a serializer (a callable returning the content as str or bytes) and the path to write it to.
+    The serialization, the writing of the file and the hashing of the content are done by a bounded pool of worker threads.
+
+    With max_workers None (or lower than 2) no threads are used and every file is written immediately in the calling thread.
+    This results in the same files as with the pool.
+
+    The sha256 digests of the written contents are kept in `digests` with the path as key.
+
+    With an ExportCache the files with an unchanged fingerprint are taken from the cache instead of being written.
+
+    With a Target the files are written directly into place in the target (if it allows it) instead of a temporary directory.
+    A MemoryTarget receives the serialized content directly (the path is a MemoryToppingfile then).
+    Files already existing there with the same content are not written again.
+
+    With lazy the toppingfiles are not exported on parsing. The exports are deferred (see `deferred`) until the files are linked.
+
+    With Metrics the written (and the cached) files and bytes are counted.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = None,
+        export_cache: ExportCache = None,
+        target: Target = None,
+        lazy: bool = False,
+        metrics: Metrics = None,
+    ):
+        self.max_workers = max_workers
+        self.export_cache = export_cache
+        self.target = target
+        self.lazy = lazy
+        self.metrics = metrics
+        self.digests = {}
+        self.failures = {}
+        # the types of the toppingfiles by path (see `toppingfile_path`), so the ones with the same filename are not mixed up in the ExportCache
+        self._toppingfile_types = {}
+
+        self._executor = None
+        if max_workers and max_workers > 1:
+            self._executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="toppingmaker_export"
+            )
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def toppingfile_path(self, type: str, temporary_dir: str, filename: str) -> str:
+        """
+        Returns the path to write a toppingfile to.
+        It's the path (or the MemoryToppingfile) in the target if it allows to write into place, otherwise the path in the temporary directory.
+        """
+        path = None
+        if self.target:
+            path = self.target.toppingfile_path(type, filename)
+        if not path:
+            os.makedirs(temporary_dir, exist_ok=True)
+            path = os.path.join(temporary_dir, filename)
+        self._toppingfile_types[path] = type
+        return path
+
+    def write(self, path: str, serializer, fingerprint: str = None) -> str:
+        """
+        Writes the content returned by the serializer to the path (in a worker thread if there is a pool).
+        Returns the path immediately.
+
+        :param str path: the path of the file to write.
+        :param serializer: a callable returning the content as str or bytes.
+        :param str fingerprint: the fingerprint to store the file with in the ExportCache (to fetch it on the next run). If None, the digest of the content is used as fingerprint.
+        """
+        if not self._executor:
+            self._write(path, serializer, fingerprint)
+            return path
+
+        # the same file is written again (e.g. a layer multiple times in the tree) - keep the order of the writes
+        self.wait_for(path)
+        self._futures[path] = self._executor.submit(
+            self._write, path, serializer, fingerprint
+        )
+        return path
+
+    def deferred(self, path: str, exporter):
+        """
+        Exports the toppingfile by calling the exporter (returning the path of the written file).
+        If the pool is lazy, a DeferredToppingfile is returned instead, calling the exporter when its path is needed.
+        """
+        if self.lazy:
+            return DeferredToppingfile(path, exporter, self)
+        return exporter()
+
+    def fetch(self, path: str, fingerprint: str) -> bool:
+        """
+        Takes the file from the ExportCache if the fingerprint is unchanged.
+        Returns False if there is no cache or the file needs to be exported.
+        """
+        if not self.export_cache:
+            return False
+        self.wait_for(path)
+        fetched = self.export_cache.fetch(self._cache_key(path), fingerprint, path)
+        if fetched and self.metrics:
+            self.metrics.count("cached_files")
+        return fetched
+
+    def wait(self) -> bool:
+        """
+        Waits until all the submitted files are written.
+        Returns False if any of the files could not be written (see `failures`).
+        """
+        futures = list(self._futures.values())
+        self._futures = {}
+        for future in futures:
+            future.result()
+        return not self.failures
+
+    def close(self) -> bool:
+        """
+        Waits until all the submitted files are written and shuts the pool down.
+        Returns False if any of the files could not be written (see `failures`).
+        """
+        result = self.wait()
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        return result
+
+    def wait_for(self, path: str):
+        """
+        Waits until the file of the path is written (if it has been submitted), not for the other ones.
+        """
+        pending_future = self._futures.get(path)
+        if pending_future:
+            pending_future.result()
+
+    def _cache_key(self, path) -> str:
+        # the filename relative to the type of the toppingfile (like "layerstyle/layer_one.qml")
+        if isinstance(path, MemoryToppingfile):
+            filename = os.path.basename(path.link)
+        else:
+            filename = os.path.basename(path)
+        type = self._toppingfile_types.get(path)
+        return f"{type}/{filename}" if type else filename
+
+    def _has_content(self, path, data: bytes, digest: str) -> bool:
+        # the file exists already in the target with the same content
+        if isinstance(path, MemoryToppingfile):
+            return path.exists() and path.read() == data
+        return (
+            self.target is not None
+            and os.path.exists(path)
+            and file_digest(path) == digest
+        )
+
+    def _write(self, path, serializer, fingerprint=None):
+        try:
+            content = serializer()
+            data = (
+                content.encode("utf-8") if isinstance(content, str) else bytes(content)
+            )
+            digest = hashlib.sha256(data).hexdigest()
+            if not self._has_content(path, data, digest):
+                if isinstance(path, MemoryToppingfile):
+                    # received directly by the MemoryTarget
+                    path.write(data)
+                else:
+                    with open(path, "wb") as toppingfile:
+                        toppingfile.write(data)
+                if self.metrics:
+                    self.metrics.count("written_files")
+                    self.metrics.count("written_bytes", len(data))
+            if self.export_cache:
+                key = self._cache_key(path)
+                if fingerprint:
+                    self.export_cache.store(key, fingerprint, path)
+                elif not self.export_cache.is_unchanged(key, digest):
+                    self.export_cache.store(key, digest)
+            with self._lock:
+                self.digests[path] = digest
+        except Exception as exception:
+            logging.warning(
+                "Could not write toppingfile {}: {}".format(path, exception)
+            )
+            with self._lock:
+                self.failures[path] = str(exception)
+
+
+class DeferredToppingfile(os.PathLike):
+    """
+    The handle of a toppingfile that is exported only when its path is needed (see `os.fspath`), what happens when it's linked in a Target.
+    Until then `path` is the path the file will be written to.
+
+    The exporter accesses the QGIS objects (layers, nodes, layouts) of the parsed project, so the project needs to be kept until the files are generated.
+    """
+
+    def __init__(self, path: str, exporter, export_pool: ExportPool):
+        self.path = path
+        self._exporter = exporter
+        self._export_pool = export_pool
+
+    def is_realized(self) -> bool:
+        return self._exporter is None
+
+    def realize(self) -> str:
+        """
+        Exports the toppingfile (once) and returns its path.
+        """
+        if self._exporter is not None:
+            self.path = self._exporter()
+            self._exporter = None
+            # the file is needed right away (e.g. to copy it) - the others are written meanwhile
+            self._export_pool.wait_for(self.path)
+        return self.path
+
+    def __fspath__(self) -> str:
+        return os.fspath(self.realize())
+
+    def __repr__(self):
+        return "DeferredToppingfile({!r}{})".format(
+            self.path, "" if self.is_realized() else ", deferred"
+        )
@@ -16,10 +16,13 @@
  *                                                                         *
  ***************************************************************************/
 """
+import copy
+import fnmatch
+import re
 from enum import Enum
 from typing import Union
 
-from qgis.core import QgsLayerTreeGroup, QgsLayerTreeLayer
+from qgis.core import QgsLayerTreeGroup, QgsLayerTreeLayer, QgsProject, QgsVectorLayer
 
 
 class ExportSettings:
@@ -60,6 +63,18 @@ class ExportSettings:
         ("Node2","robot"): { export: True, categories: <QgsMapLayer.StyleCategories> }
     }
 
+    # Rules:
+
+    Instead of listing every node, settings can be defined by rules (see `add_rule`) matching the nodes by:
+    - the name of the node
+    - the path of the groups containing the node (like "Big Group/Medium Group")
+    - the name of the provider of the layer (like "postgres")
+    - the geometry type of the layer ("Point", "Line", "Polygon", "Unknown" or "Null")
+
+    The patterns are globs (or regular expressions). A setting of a node or name in the dicts above is always preferred to the rules.
+    Of the matching rules the one with the highest priority is taken (with the same priority the first added).
+    The rules are compiled when added. The facts of a node they are matched with are made once per ExportPlan (see `export_plan`), so they are not kept longer than the parse of a project.
+
     # Mapthemes:
 
     The map themes to export are a simple list of map theme names stored in `mapthemes`.
@@ -72,6 +87,11 @@ class ExportSettings:
 
     The print layouts to export are a simple list of layout names stored in `layouts`.
 
+    # Export Plan:
+
+    To not look up the settings again and again while parsing, they can be resolved against a project once with `export_plan`.
+    The resulting ExportPlan contains a NodePlan per node of the layertree with the settings of every type and style of the node.
+
     """
 
     class ToppingType(Enum):
@@ -79,6 +99,166 @@ class ExportSettings:
         DEFINITION = 2
         SOURCE = 3
 
+    class Rule:
+        """
+        A rule defining the setting (export, categories) of all the nodes it matches.
+        The patterns not passed (None) are not considered. For QMLSTYLE the style_name pattern defines the styles it's for (if None only the default style).
+        """
+
+        GEOMETRY_TYPE_NAMES = {
+            0: "Point",
+            1: "Line",
+            2: "Polygon",
+            3: "Unknown",
+            4: "Null",
+        }
+
+        def __init__(
+            self,
+            type: "ExportSettings.ToppingType",
+            export=True,
+            categories=None,
+            style_name: str = None,
+            name: str = None,
+            group_path: str = None,
+            provider: str = None,
+            geometry_type: str = None,
+            regex: bool = False,
+            priority: int = 0,
+        ):
+            self.type = type
+            self.export = export
+            self.categories = categories
+            self.priority = priority
+
+            # compiled matchers of the passed patterns by the fact of the node they are matched with
+            self._matchers = {}
+            for fact, pattern in [
+                ("style_name", style_name),
+                ("name", name),
+                ("group_path", group_path),
+                ("provider", provider),
+                ("geometry_type", geometry_type),
+            ]:
+                if pattern is not None:
+                    if regex:
+                        self._matchers[fact] = re.compile(pattern).search
+                    else:
+                        self._matchers[fact] = re.compile(
+                            fnmatch.translate(pattern)
+                        ).match
+
+        def matches(self, facts: dict) -> bool:
+            if "style_name" not in self._matchers and facts.get("style_name"):
+                # without style_name pattern it's only for the default style
+                return False
+            for fact, matcher in self._matchers.items():
+                value = facts.get(fact)
+                if value is None or not matcher(value):
+                    return False
+            return True
+
+        def setting(self) -> dict:
+            setting = {"export": self.export}
+            if self.categories:
+                setting["categories"] = self.categories
+            return setting
+
+    class NodePlan:
+        """
+        The resolved settings of a node: The definition and source setting and the qmlstyle settings by style name (including "default").
+        """
+
+        def __init__(
+            self,
+            export_settings: "ExportSettings",
+            node: Union[QgsLayerTreeLayer, QgsLayerTreeGroup],
+            style_names: list = None,
+            node_facts: dict = None,
+        ):
+            self._export_settings = export_settings
+            self._node = node
+            # the facts of the nodes made for the rules (shared by the NodePlans of an ExportPlan)
+            self._node_facts = node_facts
+            self.definition = export_settings._resolve_setting(
+                ExportSettings.ToppingType.DEFINITION,
+                node,
+                node.name(),
+                node_facts=node_facts,
+            )
+            self.source = export_settings._resolve_setting(
+                ExportSettings.ToppingType.SOURCE,
+                node,
+                node.name(),
+                node_facts=node_facts,
+            )
+            self.qmlstyles = {}
+            for style_name in ["default"] + list(style_names or []):
+                self.qmlstyle(style_name)
+
+        def qmlstyle(self, style_name: str = "default") -> dict:
+            """
+            Returns the qmlstyle setting of the style (resolved on the first request if it was not known on compiling).
+            """
+            setting = self.qmlstyles.get(style_name)
+            if setting is None:
+                setting = self._export_settings._resolve_setting(
+                    ExportSettings.ToppingType.QMLSTYLE,
+                    self._node,
+                    self._node.name(),
+                    style_name,
+                    self._node_facts,
+                )
+                self.qmlstyles[style_name] = setting
+            return setting
+
+    class ExportPlan:
+        """
+        The ExportSettings resolved against a project: a flat dict of NodePlans by node.
+        Nodes not known on compiling are resolved on the first request.
+        The layertree independent settings (mapthemes, variables etc.) are taken from the ExportSettings.
+        """
+
+        def __init__(self, export_settings: "ExportSettings"):
+            self.export_settings = export_settings
+            self.node_plans = {}
+            # the facts of the nodes matched by the rules
+            self.node_facts = {}
+
+        def node_plan(
+            self, node: Union[QgsLayerTreeLayer, QgsLayerTreeGroup]
+        ) -> "ExportSettings.NodePlan":
+            node_plan = self.node_plans.get(node)
+            if node_plan is None:
+                node_plan = ExportSettings.NodePlan(
+                    self.export_settings, node, node_facts=self.node_facts
+                )
+                self.node_plans[node] = node_plan
+            return node_plan
+
+        def get_setting(
+            self,
+            type: "ExportSettings.ToppingType",
+            node: Union[QgsLayerTreeLayer, QgsLayerTreeGroup] = None,
+            name: str = None,
+            style_name: str = None,
+        ) -> dict():
+            """
+            Returns the setting like ExportSettings.get_setting does.
+            """
+            if node is None:
+                return self.export_settings.get_setting(type, node, name, style_name)
+            node_plan = self.node_plan(node)
+            if type == ExportSettings.ToppingType.DEFINITION:
+                return node_plan.definition
+            if type == ExportSettings.ToppingType.SOURCE:
+                return node_plan.source
+            return node_plan.qmlstyle(style_name or "default")
+
+        def __getattr__(self, name):
+            # mapthemes, variables, path_variables, layouts etc. of the ExportSettings
+            return getattr(self.export_settings, name)
+
     def __init__(self):
         # layertree settings per layer / group and type of export
         self.qmlstyle_setting_nodes = {}
@@ -86,12 +266,107 @@ class ExportSettings:
         self.source_setting_nodes = {}
         # names of mapthemes to be exported
         self.mapthemes = []
+        # if the mapthemes are written as differences to a common base state (see ProjectTopping.MapThemes)
+        self.mapthemes_delta = False
         # keys of custom variables to be exported
         self.variables = []
         # list of variable keys that are defined as paths and should be resolved
         self.path_variables = []
         # names of layouts
         self.layouts = []
+        # rules defining the settings of the nodes not in the setting dicts (see add_rule)
+        self.rules = []
+
+    def export_plan(self, project: QgsProject) -> "ExportSettings.ExportPlan":
+        """
+        Resolves the settings of every node (and style) in the layertree of the project once.
+        Changes of the settings afterwards are not considered by the plan.
+        """
+        export_plan = ExportSettings.ExportPlan(self)
+        root = project.layerTreeRoot()
+        if not root:
+            return export_plan
+        nodes = list(root.children())
+        while nodes:
+            node = nodes.pop()
+            style_names = []
+            if isinstance(node, QgsLayerTreeLayer):
+                if node.layer():
+                    style_names = node.layer().styleManager().styles()
+            elif isinstance(node, QgsLayerTreeGroup):
+                nodes.extend(node.children())
+            export_plan.node_plans[node] = ExportSettings.NodePlan(
+                self, node, style_names, export_plan.node_facts
+            )
+        return export_plan
+
+    def node_locators(self) -> dict:
+        """
+        Returns the locators of the nodes used as keys in the setting dicts by node: the path of the group names, the name, the layer id (of layer nodes) and the occurrence of such a node in its group.
+        They are plain values, so they can be made in the thread of the project and used with `relocated` in another one.
+        """
+        nodes = []
+        for setting_nodes in [
+            self.qmlstyle_setting_nodes,
+            self.definition_setting_nodes,
+            self.source_setting_nodes,
+        ]:
+            nodes.extend(
+                key
+                for key in setting_nodes.keys()
+                if isinstance(key, (QgsLayerTreeLayer, QgsLayerTreeGroup))
+            )
+        located_nodes = {}
+        for node in nodes:
+            if node not in located_nodes:
+                root = node
+                while root.parent() is not None:
+                    root = root.parent()
+                located_nodes.update(self._located_nodes(root))
+        return {node: located_nodes.get(node) for node in nodes}
+
+    def relocated(self, project: QgsProject, node_locators: dict) -> "ExportSettings":
+        """
+        Returns a copy of the settings with the nodes used as keys replaced by the nodes of the project at the same place.
+        It's used when the project is read again (like in the ProjectToppingTask) and so the nodes are other objects.
+
+        :param QgsProject project: the project containing the nodes to use as keys.
+        :param dict node_locators: the locators of the nodes used as keys made by `node_locators` (with the project the settings have been made for).
+        :raises ValueError: if nodes are not found in the project.
+        """
+        nodes = {
+            locator: node
+            for node, locator in self._located_nodes(project.layerTreeRoot()).items()
+        }
+        export_settings = copy.copy(self)
+        unlocated_names = []
+        for attribute in [
+            "qmlstyle_setting_nodes",
+            "definition_setting_nodes",
+            "source_setting_nodes",
+        ]:
+            setting_nodes = {}
+            for key, setting in getattr(self, attribute).items():
+                if isinstance(key, (QgsLayerTreeLayer, QgsLayerTreeGroup)):
+                    node = nodes.get(node_locators.get(key))
+                    if node is None:
+                        unlocated_names.append(key.name())
+                        continue
+                    key = node
+                setting_nodes[key] = dict(setting)
+            setattr(export_settings, attribute, setting_nodes)
+        if unlocated_names:
+            raise ValueError(
+                "The nodes {} of the export settings are not in the project.".format(
+                    ", ".join(unlocated_names)
+                )
+            )
+        export_settings.mapthemes = list(self.mapthemes)
+        export_settings.variables = list(self.variables)
+        export_settings.path_variables = list(self.path_variables)
+        export_settings.layouts = list(self.layouts)
+        export_settings.rules = list(self.rules)
+        return export_settings
 
     def set_setting_values(
         self,
@@ -120,10 +395,55 @@ class ExportSettings:
         style_name: str = None,
     ) -> dict():
         """
-        Returns an existing or an empty setting dict
+        Returns an existing or an empty setting dict.
+        If there is none for the node or name, the one resulting from the rules.
         """
+        return self._resolve_setting(type, node, name, style_name)
+
+    def _resolve_setting(
+        self, type, node=None, name=None, style_name=None, node_facts: dict = None
+    ):
+        # the node_facts (by node) are the facts already made for the rules, e.g. in the same ExportPlan
         setting_nodes = self._setting_nodes(type)
-        return self._get_setting(setting_nodes, node, name, style_name)
+        setting = self._get_setting(setting_nodes, node, name, style_name)
+        if not setting and self.rules:
+            setting = self._get_rule_setting(type, node, name, style_name, node_facts)
+        return setting
+
+    def add_rule(
+        self,
+        type: ToppingType,
+        export=True,
+        categories=None,
+        style_name: str = None,
+        name: str = None,
+        group_path: str = None,
+        provider: str = None,
+        geometry_type: str = None,
+        regex: bool = False,
+        priority: int = 0,
+    ) -> "ExportSettings.Rule":
+        """
+        Adds a rule defining the setting (export, categories) of all the nodes matching the patterns (globs or if regex, regular expressions).
+        E.g. all postgres layers export the source:
+        add_rule(ExportSettings.ToppingType.SOURCE, provider="postgres")
+        """
+        rule = ExportSettings.Rule(
+            type,
+            export,
+            categories,
+            style_name,
+            name,
+            group_path,
+            provider,
+            geometry_type,
+            regex,
+            priority,
+        )
+        self.rules.append(rule)
+        # the highest priority first (and with the same priority the first added)
+        self.rules.sort(key=lambda rule: -rule.priority)
+        return rule
 
     def _setting_nodes(self, type: ToppingType):
         if type == ExportSettings.ToppingType.QMLSTYLE:
@@ -152,6 +472,68 @@ class ExportSettings:
             return True
         return False
 
+    def _get_rule_setting(
+        self, type, node=None, name=None, style_name=None, node_facts: dict = None
+    ):
+        style_name = style_name if style_name != "default" else None
+        facts = dict(self._facts(node, name, node_facts))
+        facts["style_name"] = style_name
+        for rule in self.rules:
+            if rule.type == type and rule.matches(facts):
+                return rule.setting()
+        return {}
+
+    def _facts(self, node=None, name=None, node_facts: dict = None):
+        # the facts of the node (or only the name) the rules are matched with
+        if node is None:
+            return {"name": name}
+        facts = node_facts.get(node) if node_facts is not None else None
+        if facts is None:
+            group_names = []
+            parent = node.parent()
+            while parent is not None and parent.parent() is not None:
+                group_names.insert(0, parent.name())
+                parent = parent.parent()
+            facts = {"name": node.name(), "group_path": "/".join(group_names)}
+            if isinstance(node, QgsLayerTreeLayer) and node.layer():
+                layer = node.layer()
+                if layer.dataProvider():
+                    facts["provider"] = layer.dataProvider().name()
+                if isinstance(layer, QgsVectorLayer):
+                    geometry_type = layer.geometryType()
+                    facts[
+                        "geometry_type"
+                    ] = ExportSettings.Rule.GEOMETRY_TYPE_NAMES.get(
+                        int(getattr(geometry_type, "value", geometry_type))
+                    )
+            if node_facts is not None:
+                node_facts[node] = facts
+        return facts
+
+    @staticmethod
+    def _located_nodes(root: QgsLayerTreeGroup) -> dict:
+        # the locators of all the nodes in the tree of the root by node
+        located_nodes = {}
+        stack = [((), root)]
+        while stack:
+            group_path, group = stack.pop()
+            occurrences = {}
+            for node in group.children():
+                layer_id = (
+                    node.layerId() if isinstance(node, QgsLayerTreeLayer) else None
+                )
+                occurrence_key = (node.name(), layer_id)
+                occurrences[occurrence_key] = occurrences.get(occurrence_key, 0) + 1
+                located_nodes[node] = (
+                    group_path,
+                    node.name(),
+                    layer_id,
+                    occurrences[occurrence_key],
+                )
+                if isinstance(node, QgsLayerTreeGroup):
+                    stack.append((group_path + (node.name(),), node))
+        return located_nodes
+
     def _node_key(self, node=None, style_name=None):
         # creates a key according to the available node.
         if node:
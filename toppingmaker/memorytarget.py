@@ -0,0 +1,162 @@
+"""
+/***************************************************************************
+                              -------------------
+        git sha              : :%H$
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import contextlib
+import io
+import os
+
+from .archivetarget import ArchiveTarget
+from .target import LinkedToppingfile, Target
+
+
+class MemoryTarget(Target):
+    """
+    A target keeping the toppingfiles in memory (as bytes by their relative path) instead of writing them to directories.
+    No directories are created and nothing is copied, the links (and the path_resolver) are the same as with the Target.
+
+    Passed on parsing the project, the ExportPool writes the serialized toppingfiles directly into the target (see `toppingfile_path`), so they are not written to a temporary directory and read again.
+
+    The files can be written as zip or tar archive to a (binary) stream (like the response of a web service):
+
+    ```py
+    target = MemoryTarget("freddys", "freddys_projects")
+    project_topping.generate_files(target)
+    target.write_archive(response_stream)
+    ```
+    """
+
+    def __init__(
+        self,
+        projectname: str = "project",
+        sub_dir: str = None,
+        path_resolver=None,
+        content_addressed: bool = False,
+    ):
+        super().__init__(projectname, None, sub_dir, path_resolver, content_addressed)
+        # the content of the stored files by their relative path
+        self.files = {}
+
+    def filedir_path(self, file_dir):
+        # there is no absolute path (directory) in memory
+        return None, self.relative_filedir_path(file_dir)
+
+    def toppingfile_path(self, type: str, path: str):
+        """
+        Returns the handle (a MemoryToppingfile) the ExportPool writes the content of the toppingfile of the given (source) path to.
+        Returns None when content_addressed (the name is known only after writing).
+        """
+        if self.content_addressed:
+            return None
+        return MemoryToppingfile(
+            self, type, self._file_key(type, self._toppingfile_name(path))
+        )
+
+    def file(self, relative_path: str) -> bytes:
+        """
+        Returns the content of the file with the relative path (like it's linked in the projecttopping).
+        """
+        return self.files[self._relative_path_key(relative_path)]
+
+    @contextlib.contextmanager
+    def open_toppingfile(self, type: str, filename: str):
+        stream = io.StringIO()
+        yield stream
+        self.files[self._file_key(type, filename)] = stream.getvalue().encode("utf-8")
+
+    def write_archive(
+        self, stream, archive_format: str = "zip", compression: str = None
+    ):
+        """
+        Writes all the files as archive (see ArchiveTarget) to the binary stream.
+        """
+        with ArchiveTarget(
+            self.projectname,
+            stream,
+            archive_format=archive_format,
+            compression=compression,
+        ) as archive_target:
+            for name, data in self.files.items():
+                archive_target.append(name, data)
+
+    def _in_place_filename(self, type: str, path: str) -> str:
+        if (
+            isinstance(path, MemoryToppingfile)
+            and path.target is self
+            and path.type == type
+        ):
+            # written by the ExportPool (see toppingfile_path)
+            return os.path.basename(path.link)
+        return None
+
+    def _store_toppingfile(self, type: str, path: str, filename: str):
+        with open(path, "rb") as toppingfile:
+            self.files[self._file_key(type, filename)] = toppingfile.read()
+
+    def _has_toppingfile(self, type: str, filename: str) -> bool:
+        return self._file_key(type, filename) in self.files
+
+    def toppingfile_source(self, type: str, link: str) -> str:
+        # not stored as file
+        return None
+
+    def read_toppingfile(self, type: str, link: str) -> bytes:
+        return self.file(link)
+
+    def _file_key(self, type: str, filename: str) -> str:
+        return self._relative_path_key(
+            os.path.join(self.relative_filedir_path(type), filename)
+        )
+
+    @staticmethod
+    def _relative_path_key(relative_path: str) -> str:
+        # separated by slashes like in archives
+        return relative_path.replace(os.sep, "/")
+
+
+class MemoryToppingfile(LinkedToppingfile):
+    """
+    The handle of a toppingfile written into a MemoryTarget (see `MemoryTarget.toppingfile_path`).
+    The ExportPool passes the serialized content to `write` instead of writing a file.
+    Like every LinkedToppingfile it's written to a temporary file only when its path is needed (e.g. to load it in QGIS).
+    """
+
+    __slots__ = ()
+
+    def exists(self) -> bool:
+        return self.target._relative_path_key(self.link) in self.target.files
+
+    def write(self, data: bytes):
+        self.target.files[self.target._relative_path_key(self.link)] = data
+        # a temporary file with the previous content is outdated (also the one of another handle of the file)
+        self._path = None
+        if self.target._temporary_dir:
+            temporary_path = self.target.temporary_toppingfile_path(
+                self.type, self.link
+            )
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, MemoryToppingfile)
+            and other.target is self.target
+            and other.link == self.link
+        )
+
+    def __hash__(self):
+        return hash((id(self.target), self.link))
+
+    def __repr__(self):
+        return "MemoryToppingfile({!r})".format(self.link)
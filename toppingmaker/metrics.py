@@ -0,0 +1,103 @@
+"""
+/***************************************************************************
+                              -------------------
+        git sha              : :%H$
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import contextlib
+import heapq
+import json
+import threading
+import time
+
+
+class Metrics:
+    """
+    Collects where the time goes when parsing a project and generating the files of a ProjectTopping.
+    It's disabled by default and enabled by setting an instance on the ProjectTopping:
+
+    ```py
+    project_topping.metrics = Metrics()
+    project_topping.parse_project(project, export_settings)
+    project_topping.generate_files(target)
+    print(project_topping.metrics.to_json())
+    ```
+
+    - `phases`: the wall time (seconds) per phase, accumulated when a phase is passed multiple times.
+      Parsing: layertree, layerorder, mapthemes, variables, layouts, properties and export (waiting for the writing of the toppingfiles).
+      Generating: yaml_write (without the linking) and file_linking (storing the linked toppingfiles in the target - with lazy parsed toppings this includes their export).
+    - `counters`: like written_files and written_bytes (the toppingfiles written on parsing), cached_files (taken from the ExportCache), linked_files and linked_bytes (stored in the target).
+    - `layer_timings`: the seconds used to parse every layer node (including the export of its styles and definition on the calling thread) as list of (layer name, seconds).
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.counters = {}
+        self.layer_timings = []
+        # the counters are increased by the threads of the export pool as well
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """
+        Measures the wall time of the block as phase with the name.
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start_time)
+
+    def add_time(self, name: str, seconds: float):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_layer_time(self, name: str, seconds: float):
+        with self._lock:
+            self.layer_timings.append((name, seconds))
+
+    def slowest_layers(self, count: int = 10) -> list:
+        """
+        Returns the (layer name, seconds) of the slowest layers, the slowest first.
+        """
+        return heapq.nlargest(count, self.layer_timings, key=lambda timing: timing[1])
+
+    def as_dict(self, top: int = 10) -> dict:
+        return {
+            "phases": dict(self.phases),
+            "counters": dict(self.counters),
+            "layers": len(self.layer_timings),
+            "slowest_layers": [
+                {"name": name, "seconds": seconds}
+                for name, seconds in self.slowest_layers(top)
+            ],
+        }
+
+    def to_json(self, path: str = None, top: int = 10) -> str:
+        """
+        Returns the metrics (see `as_dict`) as JSON and writes them to the path if passed.
+        """
+        content = json.dumps(self.as_dict(top), indent=2)
+        if path:
+            with open(path, "w") as file:
+                file.write(content)
+        return content
+
+    def reset(self):
+        with self._lock:
+            self.phases = {}
+            self.counters = {}
+            self.layer_timings = []
@@ -0,0 +1,506 @@
+"""
+/***************************************************************************
+                              -------------------
+        git sha              : :%H$
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from qgis.core import (
+    Qgis,
+    QgsLayerDefinition,
+    QgsLayerTreeGroup,
+    QgsLayerTreeLayer,
+    QgsMapLayer,
+    QgsMapLayerStyle,
+    QgsMapThemeCollection,
+    QgsMeshLayer,
+    QgsPathResolver,
+    QgsPrintLayout,
+    QgsProject,
+    QgsRasterLayer,
+    QgsReadWriteContext,
+    QgsVectorLayer,
+    QgsVectorTileLayer,
+)
+from qgis.PyQt.QtCore import QThread
+
+try:
+    # QGIS >= 3.18
+    from qgis.core import QgsPointCloudLayer
+except ImportError:
+    QgsPointCloudLayer = None
+
+from .documentcache import DocumentCache
+
+
+class ProjectGenerator:
+    """
+    Generates a QGIS project from a (parsed or loaded) ProjectTopping.
+
+    To avoid the signals and the relayout of the layer tree per layer, it's done in passes:
+    - all the layers are created (with their styles) and the layer tree is built detached from the project
+    - the layers are registered in the project in one batch (addMapLayers)
+    - the layer tree is inserted into the project at once
+    - the layer order, the map themes, the variables, the properties and the layouts are applied at the end
+
+    Layers occurring multiple times in the layertree (with the same source, definition and styles) are created once.
+    Layers with neither a definition nor a source (only the table name) cannot be created and are skipped.
+    Layers with a source are created as raster, mesh, point cloud or vector tile layer by their provider (see `LAYER_CLASSES` and `VECTOR_TILE_PROVIDERS`), otherwise as vector layer (not valid if the provider is unknown).
+
+    With max_workers (greater than 1) the layers with a source are created concurrently by a pool of worker threads, since opening and validating their data sources is the slowest part.
+    The created layers are moved to the thread of the caller (what QGIS requires before registering them) and styled there.
+    With a timeout (seconds) the layers not created until then are skipped. Their creation cannot be interrupted, it's only not waited for.
+    The layers that failed (not valid, timed out or with an error) are reported in `failures` by their name (and through the stdout of the ProjectTopping).
+
+    The styles, definitions and layout templates are parsed once per distinct content (see DocumentCache) and applied to all the layers linking them.
+    A document cache can be passed to share it between generations (or to set its size). Its statistics are reported through stdout.
+    """
+
+    # the providers of layers other than vector layers
+    LAYER_CLASSES = {
+        "gdal": QgsRasterLayer,
+        "wms": QgsRasterLayer,
+        "wcs": QgsRasterLayer,
+        "arcgismapserver": QgsRasterLayer,
+        "postgresraster": QgsRasterLayer,
+        "mdal": QgsMeshLayer,
+        "mesh_memory": QgsMeshLayer,
+    }
+    if QgsPointCloudLayer is not None:
+        LAYER_CLASSES.update(
+            {
+                "pdal": QgsPointCloudLayer,
+                "ept": QgsPointCloudLayer,
+                "copc": QgsPointCloudLayer,
+            }
+        )
+    # the providers of vector tile layers (created without provider, it's defined by the uri)
+    VECTOR_TILE_PROVIDERS = {
+        "vectortile",
+        "xyzvectortiles",
+        "mbtilesvectortiles",
+        "arcgisvectortileservice",
+        "vtpkvectortiles",
+    }
+
+    def __init__(
+        self,
+        project_topping,
+        max_workers: int = None,
+        timeout: float = None,
+        document_cache: DocumentCache = None,
+    ):
+        self.project_topping = project_topping
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.document_cache = document_cache or DocumentCache()
+        # the created layers by the name of their (first) item
+        self.layers = {}
+        # the reasons of the failed layers by their name
+        self.failures = {}
+
+        self._layers_by_key = {}
+        # the futures of the layers created concurrently by their key
+        self._layer_futures = {}
+
+    def generate(self, project: QgsProject = None) -> QgsProject:
+        """
+        Generates the project.
+
+        :param QgsProject project: the project to generate into. If None, a new project is created.
+        """
+        if project is None:
+            project = QgsProject()
+        self.layers = {}
+        self.failures = {}
+        self._layers_by_key = {}
+
+        if self.max_workers and self.max_workers > 1:
+            self._create_source_layers()
+        tree = QgsLayerTreeGroup()
+        new_layers = self._make_tree(project, tree)
+        self._layer_futures = {}
+        project.addMapLayers(new_layers, False)
+        root = project.layerTreeRoot()
+        root.insertChildNodes(
+            len(root.children()), [node.clone() for node in tree.children()]
+        )
+
+        self._make_layerorder(root)
+        self._make_mapthemes(project)
+        self._make_variables(project)
+        self._make_properties(project)
+        self._make_layouts(project)
+        self._info(
+            self.project_topping.tr("QGIS project generated with {} layers.").format(
+                len(project.mapLayers())
+            )
+        )
+        self._info(
+            self.project_topping.tr(
+                "Document cache: {hits} hits, {misses} misses, {evictions} evictions."
+            ).format(**self.document_cache.statistics())
+        )
+        return project
+
+    def _make_tree(self, project: QgsProject, tree: QgsLayerTreeGroup) -> list:
+        """
+        Builds the layer tree into the detached tree and returns the new layers to register.
+        """
+        new_layers = []
+        mutually_exclusive_groups = []
+        # explicit stack instead of recursion (for deep trees)
+        stack = [
+            (tree, item) for item in reversed(self.project_topping.layertree.items)
+        ]
+        while stack:
+            parent, item = stack.pop()
+            properties = item.properties
+            if properties.group:
+                if properties.definitionfile:
+                    # the group with all its child nodes is in the definition
+                    self._load_group_definition(project, parent, item)
+                    continue
+                group = parent.addGroup(item.name)
+                group.setItemVisibilityChecked(properties.checked)
+                group.setExpanded(properties.expanded)
+                if properties.mutually_exclusive:
+                    # when the child nodes are added
+                    mutually_exclusive_groups.append(
+                        (group, properties.mutually_exclusive_child)
+                    )
+                stack.extend((group, child_item) for child_item in reversed(item.items))
+            else:
+                layer = self._layer(item, new_layers)
+                if layer is None:
+                    continue
+                node = QgsLayerTreeLayer(layer)
+                node.setItemVisibilityChecked(properties.checked)
+                node.setExpanded(properties.expanded)
+                if properties.featurecount:
+                    node.setCustomProperty("showFeatureCount", True)
+                parent.addChildNode(node)
+
+        for group, child_index in mutually_exclusive_groups:
+            group.setIsMutuallyExclusive(True, child_index)
+        return new_layers
+
+    def _create_source_layers(self):
+        """
+        Creates the layers with a source concurrently and waits until they are created (or the timeout is reached).
+        """
+        thread = QThread.currentThread()
+        executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="toppingmaker_layer"
+        )
+        self._layer_futures = {}
+        stack = list(self.project_topping.layertree.items)
+        while stack:
+            item = stack.pop()
+            properties = item.properties
+            if properties.group:
+                if not properties.definitionfile:
+                    stack.extend(item.items)
+                continue
+            if properties.definitionfile or not (
+                properties.provider and properties.uri
+            ):
+                continue
+            key = self._layer_key(item)
+            if key not in self._layer_futures:
+                self._layer_futures[key] = executor.submit(
+                    self._source_layer,
+                    item.name,
+                    properties.provider,
+                    # resolved in this thread
+                    QgsProject.instance().pathResolver().readPath(properties.uri),
+                    thread,
+                )
+        _, not_done = wait(self._layer_futures.values(), timeout=self.timeout)
+        for future in not_done:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+    @staticmethod
+    def _source_layer(name: str, provider: str, uri: str, thread: QThread):
+        layer = ProjectGenerator._new_layer(uri, name, provider)
+        # it can only be moved by the thread it belongs to
+        layer.moveToThread(thread)
+        return layer
+
+    @staticmethod
+    def _new_layer(uri: str, name: str, provider: str) -> QgsMapLayer:
+        # the layer of the class of the provider (a vector layer if it's none of the others)
+        if provider in ProjectGenerator.VECTOR_TILE_PROVIDERS:
+            return QgsVectorTileLayer(uri, name)
+        return ProjectGenerator.LAYER_CLASSES.get(provider, QgsVectorLayer)(
+            uri, name, provider
+        )
+
+    def _layer(self, item, new_layers: list) -> QgsMapLayer:
+        # the same layer for items with the same source, definition and styles
+        key = self._layer_key(item)
+        layer = self._layers_by_key.get(key)
+        if layer is None:
+            layer = self._create_layer(item, key)
+            if layer is None:
+                return None
+            self._layers_by_key[key] = layer
+            self.layers.setdefault(item.name, layer)
+            new_layers.append(layer)
+        return layer
+
+    def _layer_key(self, item) -> tuple:
+        properties = item.properties
+        return (
+            item.name,
+            properties.provider,
+            properties.uri,
+            self._toppingfile_key(properties.definitionfile),
+            self._toppingfile_key(properties.qmlstylefile),
+            tuple(
+                (style_name, self._toppingfile_key(style_item.qmlstylefile))
+                for style_name, style_item in (
+                    properties.styles.items() if properties.has_styles() else []
+                )
+            ),
+        )
+
+    def _create_layer(self, item, key: tuple) -> QgsMapLayer:
+        properties = item.properties
+        layer = None
+        if key in self._layer_futures:
+            future = self._layer_futures[key]
+            if not future.done() or future.cancelled():
+                self._failed(
+                    item.name,
+                    self.project_topping.tr("Layer {} timed out.").format(item.name),
+                )
+                return None
+            if future.exception():
+                self._failed(
+                    item.name,
+                    self.project_topping.tr("Layer {} failed: {}").format(
+                        item.name, future.exception()
+                    ),
+                )
+                return None
+            layer = future.result()
+        elif properties.definitionfile:
+            document, context = self._document(properties.definitionfile)
+            definition_layers = (
+                QgsLayerDefinition.loadLayerDefinitionLayers(document, context)
+                if document is not None
+                else None
+            )
+            if definition_layers:
+                layer = definition_layers[0]
+                layer.setName(item.name)
+        elif properties.provider and properties.uri:
+            layer = self._new_layer(
+                QgsProject.instance().pathResolver().readPath(properties.uri),
+                item.name,
+                properties.provider,
+            )
+        if layer is None:
+            self._warning(
+                self.project_topping.tr(
+                    "Layer {} cannot be created without definition or source."
+                ).format(item.name)
+            )
+            return None
+        if not layer.isValid():
+            # added anyway (like QGIS keeps invalid layers to fix their source)
+            self._failed(
+                item.name,
+                self.project_topping.tr("Layer {} is not valid.").format(item.name),
+            )
+
+        if properties.qmlstylefile:
+            self._import_style(layer, properties.qmlstylefile)
+        if properties.has_styles():
+            self._add_styles(layer, properties.styles)
+        return layer
+
+    def _add_styles(self, layer: QgsMapLayer, styles: dict):
+        style_manager = layer.styleManager()
+        # the named styles are added from the layer - afterwards it gets its current style back
+        current_style = QgsMapLayerStyle()
+        current_style.readFromLayer(layer)
+        for style_name, style_item in styles.items():
+            if style_name == style_manager.currentStyle():
+                continue
+            if style_item.qmlstylefile:
+                self._import_style(layer, style_item.qmlstylefile)
+            style_manager.addStyleFromLayer(style_name)
+        current_style.writeToLayer(layer)
+
+    def _import_style(self, layer: QgsMapLayer, qmlstylefile):
+        document, _ = self._document(qmlstylefile)
+        if document is None:
+            return
+        result, message = layer.importNamedStyle(document)
+        if not result:
+            self._warning(
+                self.project_topping.tr(
+                    "Could not apply style {} to layer {}: {}"
+                ).format(os.fspath(qmlstylefile), layer.name(), message)
+            )
+
+    def _load_group_definition(self, project, parent: QgsLayerTreeGroup, item):
+        document, context = self._document(item.properties.definitionfile)
+        if document is None:
+            return
+        # loaded into a detached group and moved to the parent, since the layers are registered by the definition itself
+        definition_tree = QgsLayerTreeGroup()
+        result, message = QgsLayerDefinition.loadLayerDefinition(
+            document, project, definition_tree, context
+        )
+        if not result:
+            self._warning(
+                self.project_topping.tr(
+                    "Could not load the definition of group {}: {}"
+                ).format(item.name, message)
+            )
+            return
+        for node in definition_tree.children():
+            parent.addChildNode(node.clone())
+
+    def _make_layerorder(self, root):
+        layerorder_layers = [
+            self.layers[name]
+            for name in self.project_topping.layerorder
+            if name in self.layers
+        ]
+        if layerorder_layers:
+            root.setHasCustomLayerOrder(True)
+            root.setCustomLayerOrder(layerorder_layers)
+
+    def _make_mapthemes(self, project: QgsProject):
+        maptheme_collection = project.mapThemeCollection()
+        for name, maptheme_item in self.project_topping.mapthemes.items():
+            maptheme_record = QgsMapThemeCollection.MapThemeRecord()
+            expanded_groupnodes = []
+            checked_groupnodes = []
+            for node_name, node_item in (maptheme_item or {}).items():
+                if node_item.get("group"):
+                    if node_item.get("expanded"):
+                        expanded_groupnodes.append(node_name)
+                    if node_item.get("checked"):
+                        checked_groupnodes.append(node_name)
+                    continue
+                layer = self.layers.get(node_name)
+                if layer is None:
+                    continue
+                layerrecord = QgsMapThemeCollection.MapThemeLayerRecord(layer)
+                if node_item.get("style"):
+                    layerrecord.usingCurrentStyle = True
+                    layerrecord.currentStyle = node_item["style"]
+                layerrecord.isVisible = node_item.get("visible", True)
+                layerrecord.expandedLayerNode = node_item.get("expanded", False)
+                if node_item.get("expanded_items"):
+                    layerrecord.expandedLegendItems = set(node_item["expanded_items"])
+                if "checked_items" in node_item:
+                    layerrecord.usingLegendItems = True
+                    layerrecord.checkedLegendItems = set(node_item["checked_items"])
+                maptheme_record.addLayerRecord(layerrecord)
+            if expanded_groupnodes:
+                maptheme_record.setHasExpandedStateInfo(True)
+                maptheme_record.setExpandedGroupNodes(set(expanded_groupnodes))
+            if checked_groupnodes and Qgis.QGIS_VERSION_INT >= 33000:
+                maptheme_record.setHasCheckedStateInfo(True)
+                maptheme_record.setCheckedGroupNodes(set(checked_groupnodes))
+            maptheme_collection.insert(name, maptheme_record)
+
+    def _make_variables(self, project: QgsProject):
+        if self.project_topping.variables:
+            # all at once
+            custom_variables = project.customVariables()
+            for variable_key, variable_item in self.project_topping.variables.items():
+                value = (variable_item or {}).get("value")
+                if value and (variable_item or {}).get("ispath"):
+                    # the path of the (loaded) file
+                    value = os.fspath(value)
+                custom_variables[variable_key] = value
+            project.setCustomVariables(custom_variables)
+
+    def _make_properties(self, project: QgsProject):
+        transaction_mode = self.project_topping.properties.get("transaction_mode")
+        if transaction_mode is None:
+            return
+        if Qgis.QGIS_VERSION_INT < 32600:
+            project.setAutoTransaction(bool(transaction_mode))
+        else:
+            project.setTransactionMode(
+                getattr(Qgis.TransactionMode, str(transaction_mode))
+            )
+
+    def _make_layouts(self, project: QgsProject):
+        for layout_name, layout_item in self.project_topping.layouts.items():
+            if not layout_item.get("templatefile"):
+                continue
+            document, context = self._document(layout_item["templatefile"])
+            if document is None:
+                continue
+            layout = QgsPrintLayout(project)
+            _, result = layout.loadFromTemplate(document, context)
+            if not result:
+                self._warning(
+                    self.project_topping.tr("Could not load layout {}.").format(
+                        layout_name
+                    )
+                )
+                continue
+            layout.setName(layout_name)
+            project.layoutManager().addLayout(layout)
+
+    def _document(self, toppingfile) -> tuple:
+        # the document of the toppingfile and the context to resolve the paths relative to it (None and None if it cannot be parsed)
+        path = os.fspath(toppingfile)
+        try:
+            document = self.document_cache.document(path)
+        except DocumentCache.ParseError as exception:
+            self._warning(
+                self.project_topping.tr(
+                    "Could not parse {} (line {}, column {}): {}"
+                ).format(
+                    exception.path, exception.line, exception.column, exception.message
+                )
+            )
+            return None, None
+        # the documents are shared, but changed when loaded (e.g. the layer ids of definitions and templates or older styles upgraded by importNamedStyle)
+        document = document.cloneNode(True).toDocument()
+        context = QgsReadWriteContext()
+        context.setPathResolver(QgsPathResolver(path))
+        return document, context
+
+    @staticmethod
+    def _toppingfile_key(toppingfile):
+        # without exporting or reading a deferred or linked toppingfile
+        if toppingfile is None:
+            return None
+        return getattr(toppingfile, "link", None) or getattr(
+            toppingfile, "path", toppingfile
+        )
+
+    def _failed(self, name: str, message: str):
+        self.failures[name] = message
+        self._warning(message)
+
+    def _info(self, message: str):
+        # through the stdout of the ProjectTopping
+        self.project_topping.stdout.emit(message, Qgis.Info)
+
+    def _warning(self, message: str):
+        self.project_topping.stdout.emit(message, Qgis.Warning)
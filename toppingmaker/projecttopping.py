@@ -17,29 +17,54 @@
  ***************************************************************************/
 """
 
+import contextlib
+import copy
+import functools
+import hashlib
+import json
 import logging
 import os
+import shutil
 import tempfile
+import time
 from typing import Union
 
 import yaml
 from qgis.core import (
     Qgis,
-    QgsDataSourceUri,
     QgsExpressionContextUtils,
+    QgsFeedback,
     QgsLayerDefinition,
+    QgsLayerTree,
     QgsLayerTreeGroup,
     QgsLayerTreeLayer,
     QgsLayerTreeNode,
     QgsMapLayer,
+    QgsPathResolver,
+    QgsPrintLayout,
     QgsProject,
     QgsReadWriteContext,
 )
 from qgis.PyQt.QtCore import QObject, pyqtSignal
+from qgis.PyQt.QtXml import QDomDocument, QDomImplementation
 
+from .documentcache import DocumentCache
+from .exportcache import ExportCache
+from .exportpool import ExportPool
 from .exportsettings import ExportSettings
-from .target import Target
+from .memorytarget import MemoryToppingfile
+from .metrics import Metrics
+from .projectgenerator import ProjectGenerator
+from .providers import provider_extractors
+from .target import LinkedToppingfile, Target
 from .utils import slugify
+from .yamlwriter import YamlWriter
+
+try:
+    # the libyaml C loader if available
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 
 class ProjectTopping(QObject):
@@ -56,6 +81,8 @@ class ProjectTopping(QObject):
     """
 
     stdout = pyqtSignal(str, int)
+    # the phase ("parse" or "generate"), the number of done items (nodes etc.) and the total number of items
+    progress = pyqtSignal(str, int, int)
 
     PROJECTTOPPING_TYPE = "projecttopping"
     LAYERDEFINITION_TYPE = "layerdefinition"
@@ -74,10 +101,29 @@ class ProjectTopping(QObject):
             Currently it's only a qmlstylefile. Maybe in future here a style can be defined.
             """
 
+            __slots__ = ("qmlstylefile",)
+
             def __init__(self):
                 # the style file - if None then not requested
                 self.qmlstylefile = None
 
+        # no instance dicts - there is one per node and a tree can have a lot of nodes
+        __slots__ = (
+            "group",
+            "checked",
+            "expanded",
+            "featurecount",
+            "mutually_exclusive",
+            "mutually_exclusive_child",
+            "provider",
+            "uri",
+            "qmlstylefile",
+            "definitionfile",
+            "tablename",
+            "geometrycolumn",
+            "_styles",
+        )
+
         def __init__(self):
             # if the node is a group
             self.group = False
@@ -103,38 +149,185 @@ class ProjectTopping(QObject):
             self.tablename = None
             # the geometry column (if no source available)
             self.geometrycolumn = None
-            # the styles can contain multiple style items with StyleItemProperties
-            self.styles = {}
+            # the styles can contain multiple style items with StyleItemProperties (created on first access)
+            self._styles = None
+
+        @property
+        def styles(self) -> dict:
+            if self._styles is None:
+                self._styles = {}
+            return self._styles
+
+        @styles.setter
+        def styles(self, styles: dict):
+            self._styles = styles
+
+        def has_styles(self) -> bool:
+            """
+            Returns True if there are style items (without creating the dict).
+            """
+            return bool(self._styles)
+
+    class Canceled(Exception):
+        """
+        Raised when parsing or generating is canceled by the feedback.
+        """
+
+    class Progress:
+        """
+        Counts the done items of a phase (like the parsed nodes or the written items) and reports it through the progress signal and the feedback.
+        The cancellation of the feedback is checked on every step, so parsing and generating is stopped between two items.
+
+        The feedback can be a QgsFeedback or anything else with isCanceled() and setProgress(float) (like a QgsTask).
+        """
+
+        def __init__(
+            self,
+            project_topping: "ProjectTopping",
+            phase: str,
+            total: int,
+            feedback: QgsFeedback = None,
+        ):
+            self.project_topping = project_topping
+            self.phase = phase
+            self.total = max(total, 1)
+            self.feedback = feedback
+            self.done = 0
+            self._reported_percent = -1
+
+        def step(self, count: int = 1):
+            if self.feedback and self.feedback.isCanceled():
+                raise ProjectTopping.Canceled()
+            self.done = min(self.done + count, self.total)
+            self._report()
+
+        def finish(self):
+            # e.g. child nodes of groups exported as definition are not counted
+            self.done = self.total
+            self._report()
+
+        def _report(self):
+            percent = 100 * self.done // self.total
+            # reported only when the percentage changes (not for every of maybe thousands of items)
+            if percent != self._reported_percent:
+                self._reported_percent = percent
+                self.project_topping.progress.emit(self.phase, self.done, self.total)
+                if self.feedback:
+                    self.feedback.setProgress(percent)
+
+    class LayerIndex:
+        """
+        An index of the layers of a project by layer id and by name.
+        It's built once (on the first lookup) instead of scanning the layers of the project for every lookup.
+        """
+
+        def __init__(self, project: QgsProject):
+            self.project = project
+            self._layers_by_id = None
+            self._layers_by_name = None
+
+        def layer(self, layer_id: str = None, name: str = None) -> QgsMapLayer:
+            """
+            Returns the layer by id (preferred, since the names can be duplicated) or the first layer with the name.
+            """
+            if self._layers_by_id is None:
+                self._layers_by_id = self.project.mapLayers()
+                self._layers_by_name = {}
+                for layer in self._layers_by_id.values():
+                    self._layers_by_name.setdefault(layer.name(), []).append(layer)
+            layer = self._layers_by_id.get(layer_id) if layer_id else None
+            if layer is None and name in self._layers_by_name:
+                layer = self._layers_by_name[name][0]
+            return layer
 
     class LayerTreeItem:
         """
         A tree item of the layer tree. Every item contains the properties of a layer and according the ExportSettings passed on parsing the QGIS project.
         """
 
+        __slots__ = ("items", "name", "properties", "_temporary_toppingfile_dir")
+
         def __init__(self, temporary_toppingfile_dir=None):
             self.items = []
             self.name = None
             self.properties = ProjectTopping.TreeItemProperties()
-            self.temporary_toppingfile_dir = temporary_toppingfile_dir
-            if not self.temporary_toppingfile_dir:
-                self.temporary_toppingfile_dir = tempfile.mkdtemp()
+            self._temporary_toppingfile_dir = temporary_toppingfile_dir
+
+        @property
+        def temporary_toppingfile_dir(self) -> str:
+            # created when the first toppingfile is written, not for every item
+            if not self._temporary_toppingfile_dir:
+                self._temporary_toppingfile_dir = tempfile.mkdtemp()
+            return self._temporary_toppingfile_dir
+
+        @temporary_toppingfile_dir.setter
+        def temporary_toppingfile_dir(self, temporary_toppingfile_dir: str):
+            self._temporary_toppingfile_dir = temporary_toppingfile_dir
 
         def make_item(
             self,
             project: QgsProject,
             node: Union[QgsLayerTreeLayer, QgsLayerTreeGroup],
-            export_settings: ExportSettings,
+            export_settings: Union[ExportSettings, ExportSettings.ExportPlan],
+            export_pool: ExportPool = None,
+            layer_index: "ProjectTopping.LayerIndex" = None,
+            progress: "ProjectTopping.Progress" = None,
         ):
+            if export_pool is None:
+                # without a pool the toppingfiles are written immediately
+                export_pool = ExportPool()
+            if layer_index is None:
+                layer_index = ProjectTopping.LayerIndex(project)
+            if isinstance(export_settings, ExportSettings):
+                # resolve the settings once for the whole tree
+                export_settings = export_settings.export_plan(project)
+
+            # explicit stack instead of recursion (for deep trees) - the nodes are made in the same order (pre-order) as recursively
+            stack = [(self, node)]
+            while stack:
+                if progress:
+                    progress.step()
+                item, node = stack.pop()
+                start_time = time.perf_counter()
+                child_nodes = item._make_node(
+                    project, node, export_settings, export_pool, layer_index
+                )
+                if export_pool.metrics and QgsLayerTree.isLayer(node):
+                    export_pool.metrics.add_layer_time(
+                        item.name, time.perf_counter() - start_time
+                    )
+                if child_nodes:
+                    for child in child_nodes:
+                        item.items.append(
+                            ProjectTopping.LayerTreeItem(self.temporary_toppingfile_dir)
+                        )
+                    stack.extend(zip(reversed(item.items), reversed(child_nodes)))
+
+        def _make_node(
+            self,
+            project: QgsProject,
+            node: Union[QgsLayerTreeLayer, QgsLayerTreeGroup],
+            export_plan: ExportSettings.ExportPlan,
+            export_pool: ExportPool,
+            layer_index: "ProjectTopping.LayerIndex",
+        ) -> list:
+            """
+            Makes the properties of this item (without the child items).
+            Returns the child nodes to make the child items of.
+            """
+            child_nodes = []
+            node_plan = export_plan.node_plan(node)
+
             # properties for every kind of nodes
             self.name = node.name()
             self.properties.checked = node.itemVisibilityChecked()
             self.properties.expanded = node.isExpanded()
 
-            definition_setting = export_settings.get_setting(
-                ExportSettings.ToppingType.DEFINITION, node, node.name()
-            )
+            definition_setting = node_plan.definition
             if definition_setting.get("export", False):
-                self.properties.definitionfile = self._temporary_definitionfile(node)
+                self.properties.definitionfile = self._temporary_definitionfile(
+                    project, node, export_pool
+                )
 
             if isinstance(node, QgsLayerTreeGroup):
                 # it's a group
@@ -143,38 +336,26 @@ class ProjectTopping(QObject):
 
                 if not definition_setting.get("export", False):
                     # only consider children, when the group is not exported as DEFINITION
-                    index = 0
-                    for child in node.children():
-                        item = ProjectTopping.LayerTreeItem(
-                            self.temporary_toppingfile_dir
-                        )
-                        item.make_item(project, child, export_settings)
+                    child_nodes = node.children()
+                    if self.properties.mutually_exclusive:
                         # set the first checked item as mutually exclusive child
-                        if (
-                            self.properties.mutually_exclusive
-                            and self.properties.mutually_exclusive_child == -1
-                        ):
-                            if item.properties.checked:
+                        for index, child in enumerate(child_nodes):
+                            if child.itemVisibilityChecked():
                                 self.properties.mutually_exclusive_child = index
-                        self.items.append(item)
-                        index += 1
+                                break
             else:
                 if isinstance(node, QgsLayerTreeLayer):
                     layer = node.layer()
                 else:
                     # must be not recognized as QgsLayerTreeLayer (but QgsLayerTreeNode instead)
-                    layer = self._layer_of_node(project, node)
+                    layer = self._layer_of_node(layer_index, node)
                 self.properties.featurecount = node.customProperty("showFeatureCount")
-                source_setting = export_settings.get_setting(
-                    ExportSettings.ToppingType.SOURCE, node, node.name()
-                )
+                source_setting = node_plan.source
                 if source_setting.get("export", False):
                     if layer.dataProvider():
                         self.properties.provider = layer.dataProvider().name()
-                        self.properties.uri = (
-                            QgsProject.instance()
-                            .pathResolver()
-                            .writePath(layer.publicSource())
+                        self.properties.uri = project.pathResolver().writePath(
+                            layer.publicSource()
                         )
 
                 # if neither a definition file nor the source should be exported we store the tablename (and the geometry column)
@@ -183,32 +364,19 @@ class ProjectTopping(QObject):
                 ) and not source_setting.get("export", False):
                     provider = layer.dataProvider()
                     if provider:
-                        # supported providers are postgres, mssql and GPKG (ogr)
-                        if provider.name() == "postgres" or provider.name() == "mssql":
-                            self.properties.tablename = QgsDataSourceUri(
-                                provider.dataSourceUri()
-                            ).table()
-                            self.properties.geometrycolumn = QgsDataSourceUri(
-                                provider.dataSourceUri()
-                            ).geometryColumn()
-                        elif (
-                            provider.name() == "ogr"
-                            and provider.storageType() == "GPKG"
-                        ):
-                            self.properties.tablename = (
-                                provider.dataSourceUri().split("layername=")[1].strip()
-                            )
+                        # see providers.ProviderExtractors for the supported providers
+                        (
+                            self.properties.tablename,
+                            self.properties.geometrycolumn,
+                        ) = provider_extractors.extract(provider)
 
                 # get the default style
-                qml_default_setting = export_settings.get_setting(
-                    ExportSettings.ToppingType.QMLSTYLE, node, node.name()
-                ) or export_settings.get_setting(
-                    ExportSettings.ToppingType.QMLSTYLE, node, node.name(), "default"
-                )
+                qml_default_setting = node_plan.qmlstyle("default")
 
                 if qml_default_setting.get("export", False):
                     self.properties.qmlstylefile = self._temporary_qmlstylefile(
                         layer,
+                        export_pool,
                         QgsMapLayer.StyleCategory(
                             qml_default_setting.get(
                                 "categories",
@@ -218,93 +386,404 @@ class ProjectTopping(QObject):
                     )
 
                 # get all the other styles
-                current_style = layer.styleManager().currentStyle()
-                for style_name in layer.styleManager().styles():
-                    # we skip the 'default' style because it's handled above
-                    if style_name == "default":
-                        continue
-
-                    qml_style_setting = export_settings.get_setting(
-                        ExportSettings.ToppingType.QMLSTYLE,
-                        node,
-                        node.name(),
-                        style_name,
-                    )
-                    if qml_style_setting.get("export", False):
-                        style_properties = (
-                            ProjectTopping.TreeItemProperties.StyleItemProperties()
-                        )
-                        style_properties.qmlstylefile = self._temporary_qmlstylefile(
-                            layer,
-                            QgsMapLayer.StyleCategory(
-                                qml_style_setting.get(
-                                    "categories",
-                                    QgsMapLayer.StyleCategory.AllStyleCategories,
-                                )
-                            ),
-                            style_name,
-                        )
-                        self.properties.styles[style_name] = style_properties
-                # reset the style of the project layer
-                layer.styleManager().setCurrentStyle(current_style)
+                with self._current_style_kept(layer):
+                    for style_name in layer.styleManager().styles():
+                        # we skip the 'default' style because it's handled above
+                        if style_name == "default":
+                            continue
+
+                        qml_style_setting = node_plan.qmlstyle(style_name)
+                        if qml_style_setting.get("export", False):
+                            style_properties = (
+                                ProjectTopping.TreeItemProperties.StyleItemProperties()
+                            )
+                            style_properties.qmlstylefile = self._temporary_qmlstylefile(
+                                layer,
+                                export_pool,
+                                QgsMapLayer.StyleCategory(
+                                    qml_style_setting.get(
+                                        "categories",
+                                        QgsMapLayer.StyleCategory.AllStyleCategories,
+                                    )
+                                ),
+                                style_name,
+                            )
+                            self.properties.styles[style_name] = style_properties
+            return child_nodes
 
         def _layer_of_node(
             self,
-            project: QgsProject,
+            layer_index: "ProjectTopping.LayerIndex",
             node: QgsLayerTreeNode,
-        ) -> QgsLayerTreeLayer:
+        ) -> QgsMapLayer:
             # workaround when layer has not been detected as QgsLayerTreeLayer.
             # See https://github.com/opengisch/QgisModelBaker/pull/514
-            return project.mapLayersByName(node.name())[0]
+            layer_id = None
+            if QgsLayerTree.isLayer(node):
+                layer_id = QgsLayerTree.toLayer(node).layerId()
+            return layer_index.layer(layer_id, node.name())
 
         def _temporary_definitionfile(
-            self, node: Union[QgsLayerTreeLayer, QgsLayerTreeGroup]
+            self,
+            project: QgsProject,
+            node: Union[QgsLayerTreeLayer, QgsLayerTreeGroup],
+            export_pool: ExportPool,
         ):
             filename_slug = f"{slugify(self.name)}.qlr"
-            os.makedirs(self.temporary_toppingfile_dir, exist_ok=True)
-            temporary_toppingfile_path = os.path.join(
-                self.temporary_toppingfile_dir, filename_slug
+            toppingfile_path = export_pool.toppingfile_path(
+                ProjectTopping.LAYERDEFINITION_TYPE,
+                self.temporary_toppingfile_dir,
+                filename_slug,
             )
+            return export_pool.deferred(
+                toppingfile_path,
+                functools.partial(
+                    self._export_definitionfile,
+                    node,
+                    export_pool,
+                    toppingfile_path,
+                    # decided now, the project is not needed anymore when the export is deferred
+                    self._absolute_paths(project),
+                ),
+            )
+
+        def _export_definitionfile(
+            self,
+            node: Union[QgsLayerTreeLayer, QgsLayerTreeGroup],
+            export_pool: ExportPool,
+            toppingfile_path: str,
+            absolute_paths: bool,
+        ):
+            # the document is built here (on the owning thread) and only serialized and written by the pool
+            resolver_path = toppingfile_path
+            if isinstance(toppingfile_path, MemoryToppingfile):
+                # there is no location in memory - the paths are relative to the temporary directory like of the files not written into place
+                resolver_path = os.path.join(
+                    self.temporary_toppingfile_dir, toppingfile_path.name
+                )
+            context = QgsReadWriteContext()
+            context.setPathResolver(
+                QgsPathResolver("" if absolute_paths else resolver_path)
+            )
+            document = QDomDocument("qgis-layer-definition")
             result, result_message = QgsLayerDefinition.exportLayerDefinition(
-                temporary_toppingfile_path, [node]
+                document, [node], context
             )
             if not result:
                 logging.warning(
                     "Could not export definitionfile of {} to {}: {}".format(
-                        node.name(), temporary_toppingfile_path, result_message
+                        node.name(), toppingfile_path, result_message
                     )
                 )
-            return temporary_toppingfile_path
+                return toppingfile_path
+            return export_pool.write(toppingfile_path, lambda: document.toString(2))
 
         def _temporary_qmlstylefile(
             self,
             layer: QgsMapLayer,
+            export_pool: ExportPool,
             categories: QgsMapLayer.StyleCategories = QgsMapLayer.StyleCategory.AllStyleCategories,
             style_name: str = None,
         ):
             filename_slug = f"{slugify(self.name)}{f'_{slugify(style_name)}' if style_name else ''}.qml"
-            os.makedirs(self.temporary_toppingfile_dir, exist_ok=True)
-            temporary_toppingfile_path = os.path.join(
-                self.temporary_toppingfile_dir, filename_slug
+            toppingfile_path = export_pool.toppingfile_path(
+                ProjectTopping.LAYERSTYLE_TYPE,
+                self.temporary_toppingfile_dir,
+                filename_slug,
             )
-            if style_name:
-                layer.styleManager().setCurrentStyle(style_name)
-            result_message, result = layer.saveNamedStyle(
-                temporary_toppingfile_path, categories
+            exporter = functools.partial(
+                self._export_qmlstylefile,
+                layer,
+                export_pool,
+                toppingfile_path,
+                categories,
+                style_name,
             )
-            if not result:
+            if export_pool.lazy and style_name:
+                # exported later (not while parsing the layer), so it needs to reset the current style itself
+                exporter = functools.partial(
+                    self._export_with_current_style_kept, layer, exporter
+                )
+            return export_pool.deferred(toppingfile_path, exporter)
+
+        @staticmethod
+        @contextlib.contextmanager
+        def _current_style_kept(layer: QgsMapLayer):
+            """
+            Resets the current style of the layer after exporting styles.
+            The signals of the layer and its style manager are blocked meanwhile, since nobody needs to be notified (rerender, repaint etc.) about the styles switched for the export.
+            """
+            style_manager = layer.styleManager()
+            current_style = style_manager.currentStyle()
+            layer_signals_blocked = layer.blockSignals(True)
+            style_manager_signals_blocked = style_manager.blockSignals(True)
+            try:
+                yield
+            finally:
+                style_manager.setCurrentStyle(current_style)
+                style_manager.blockSignals(style_manager_signals_blocked)
+                layer.blockSignals(layer_signals_blocked)
+
+        def _export_with_current_style_kept(self, layer: QgsMapLayer, exporter):
+            with self._current_style_kept(layer):
+                return exporter()
+
+        def _export_qmlstylefile(
+            self,
+            layer: QgsMapLayer,
+            export_pool: ExportPool,
+            toppingfile_path: str,
+            categories: QgsMapLayer.StyleCategories,
+            style_name: str = None,
+        ):
+            fingerprint = None
+            if export_pool.export_cache:
+                fingerprint = self._style_fingerprint(layer, categories, style_name)
+                if export_pool.fetch(toppingfile_path, fingerprint):
+                    # unchanged since the last run - no need to apply and export the style
+                    return toppingfile_path
+            # the document is built here (on the owning thread) and only serialized and written by the pool
+            document = None
+            result_message = None
+            if (
+                style_name
+                and style_name != layer.styleManager().currentStyle()
+                and int(categories) == int(QgsMapLayer.StyleCategory.AllStyleCategories)
+            ):
+                # no need to apply the style to the layer - it's stored completely in the style manager
+                document = self._stored_style_document(layer, style_name)
+            if document is None:
+                if style_name:
+                    # the categories can only be filtered by exporting the applied style
+                    layer.styleManager().setCurrentStyle(style_name)
+                document = QDomDocument()
+                result_message = layer.exportNamedStyle(
+                    document, QgsReadWriteContext(), categories
+                )
+            if result_message:
                 logging.warning(
                     "Could not export qmlstylefile of {} ({}) to {}: {}".format(
                         layer.name(),
                         style_name,
-                        temporary_toppingfile_path,
+                        toppingfile_path,
                         result_message,
                     )
                 )
-            return temporary_toppingfile_path
+                return toppingfile_path
+            return export_pool.write(
+                toppingfile_path, lambda: document.toString(2), fingerprint
+            )
+
+        def _stored_style_document(
+            self, layer: QgsMapLayer, style_name: str
+        ) -> QDomDocument:
+            """
+            Returns the same document as exportNamedStyle with all categories does (after applying the style), but made of the XML stored in the style manager.
+            Returns None if there is no stored XML.
+            """
+            stored_document = QDomDocument()
+            stored_document.setContent(layer.styleManager().style(style_name).xmlData())
+            if stored_document.documentElement().isNull():
+                return None
+            document = QDomDocument(
+                QDomImplementation().createDocumentType(
+                    "qgis", "http://mrcc.com/qgis.dtd", "SYSTEM"
+                )
+            )
+            document.appendChild(
+                document.importNode(stored_document.documentElement(), True)
+            )
+            return document
+
+        def _style_fingerprint(
+            self,
+            layer: QgsMapLayer,
+            categories: QgsMapLayer.StyleCategories,
+            style_name: str = None,
+        ) -> str:
+            # the stored XML of a style (or the one read from the layer if it's the current style) is what would be exported
+            style_manager = layer.styleManager()
+            style = style_manager.style(style_name or style_manager.currentStyle())
+            fingerprint_data = (
+                f"{Qgis.QGIS_VERSION_INT}\n{int(categories)}\n{style.xmlData()}"
+            )
+            return hashlib.sha256(fingerprint_data.encode("utf-8")).hexdigest()
+
+        def _absolute_paths(self, project: QgsProject) -> bool:
+            # the same decision about absolute or relative paths as QgsLayerDefinition.exportLayerDefinition does when writing to a file
+            if Qgis.QGIS_VERSION_INT < 32200:
+                absolute, _ = project.readBoolEntry("Paths", "/Absolute", False)
+                return absolute
+            return project.filePathStorage() == Qgis.FilePathType.Absolute
+
+        def load_items(self, items_list: list, target: Target):
+            """
+            Loads the child items from the items list of a projecttopping stored in the target (the reverse of `items_list`).
+            The linked toppingfiles are LinkedToppingfile handles (not read until needed).
+            """
+            self.items = []
+            # explicit stack instead of recursion (for deep trees)
+            stack = [(self, items_list)]
+            while stack:
+                item, item_dicts = stack.pop()
+                for item_dict in item_dicts or []:
+                    child_item = ProjectTopping.LayerTreeItem(
+                        self._temporary_toppingfile_dir
+                    )
+                    child_item_dicts = child_item._load_node(item_dict, target)
+                    item.items.append(child_item)
+                    if child_item_dicts:
+                        stack.append((child_item, child_item_dicts))
+
+        def _load_node(self, item_dict: dict, target: Target) -> list:
+            """
+            Loads the properties of this item from the item dict (like it's written by `_write_node`).
+            Returns the dicts of the child items to load.
+            """
+            self.name, item_properties_dict = next(iter(item_dict.items()))
+            item_properties_dict = item_properties_dict or {}
+            properties = self.properties
+
+            properties.group = item_properties_dict.get("group", False)
+            properties.mutually_exclusive = item_properties_dict.get(
+                "mutually-exclusive", False
+            )
+            properties.mutually_exclusive_child = item_properties_dict.get(
+                "mutually-exclusive-child", -1
+            )
+            properties.tablename = item_properties_dict.get("tablename")
+            properties.geometrycolumn = item_properties_dict.get("geometrycolumn")
+            properties.featurecount = item_properties_dict.get("featurecount", False)
+            properties.provider = item_properties_dict.get("provider")
+            properties.uri = item_properties_dict.get("uri")
+            properties.checked = item_properties_dict.get("checked", True)
+            properties.expanded = item_properties_dict.get("expanded", True)
+
+            if item_properties_dict.get("qmlstylefile"):
+                properties.qmlstylefile = LinkedToppingfile(
+                    target,
+                    ProjectTopping.LAYERSTYLE_TYPE,
+                    item_properties_dict["qmlstylefile"],
+                )
+            for style_name, style_dict in (
+                item_properties_dict.get("styles") or {}
+            ).items():
+                style_item_properties = (
+                    ProjectTopping.TreeItemProperties.StyleItemProperties()
+                )
+                if style_dict and style_dict.get("qmlstylefile"):
+                    style_item_properties.qmlstylefile = LinkedToppingfile(
+                        target,
+                        ProjectTopping.LAYERSTYLE_TYPE,
+                        style_dict["qmlstylefile"],
+                    )
+                properties.styles[style_name] = style_item_properties
+            if item_properties_dict.get("definitionfile"):
+                properties.definitionfile = LinkedToppingfile(
+                    target,
+                    ProjectTopping.LAYERDEFINITION_TYPE,
+                    item_properties_dict["definitionfile"],
+                )
+            return item_properties_dict.get("child-nodes")
 
         def item_dict(self, target: Target):
             item_dict = {}
+            self._fill_item_dicts([(self, item_dict)], target)
+            return item_dict
+
+        def items_list(self, target: Target):
+            item_list = [{} for _ in self.items]
+            self._fill_item_dicts(zip(self.items, item_list), target)
+            return item_list
+
+        @staticmethod
+        def _fill_item_dicts(items_and_dicts, target: Target):
+            # explicit stack instead of recursion (for deep trees) - pre-order like recursively, so the toppingfiles are linked in the same order
+            stack = list(items_and_dicts)
+            stack.reverse()
+            while stack:
+                item, item_dict = stack.pop()
+                item_properties_dict = item._item_properties_dict(target)
+                if item.items:
+                    child_item_dicts = [{} for _ in item.items]
+                    item_properties_dict["child-nodes"] = child_item_dicts
+                    stack.extend(zip(reversed(item.items), reversed(child_item_dicts)))
+                item_dict[item.name] = item_properties_dict
+
+        def write_item(
+            self,
+            writer: YamlWriter,
+            target: Target,
+            progress: "ProjectTopping.Progress" = None,
+        ):
+            """
+            Streams the item (and its child items) to the writer. It's the same as writing the item_dict.
+            """
+            if progress:
+                progress.step()
+            # explicit stack of the open items instead of recursion (for deep trees)
+            stack = [self._write_node(writer, target)]
+            while stack:
+                child_item = next(stack[-1], None)
+                if child_item is None:
+                    # the item is completely written
+                    stack.pop()
+                else:
+                    if progress:
+                        progress.step()
+                    stack.append(child_item._write_node(writer, target))
+
+        def item_count(self) -> int:
+            """
+            Returns the number of the items in the tree (including this one).
+            """
+            count = 0
+            stack = [self]
+            while stack:
+                item = stack.pop()
+                count += 1
+                stack.extend(item.items)
+            return count
+
+        def _write_node(self, writer: YamlWriter, target: Target):
+            """
+            Writes the item and yields its child items when reaching them. They need to be written completely before continuing.
+            """
+            item_properties_dict = self._item_properties_dict(target)
+            keys = list(item_properties_dict.keys())
+            if self.items:
+                keys.append("child-nodes")
+
+            writer.start_mapping()
+            writer.write(self.name)
+            writer.start_mapping()
+            for key in sorted(keys):
+                writer.write(key)
+                if key == "child-nodes":
+                    writer.start_sequence()
+                    yield from self.items
+                    writer.end_sequence()
+                else:
+                    writer.write(item_properties_dict[key])
+            writer.end_mapping()
+            writer.end_mapping()
+
+        def write_items(
+            self,
+            writer: YamlWriter,
+            target: Target,
+            progress: "ProjectTopping.Progress" = None,
+        ):
+            """
+            Streams the child items to the writer. It's the same as writing the items_list.
+            """
+            writer.start_sequence()
+            for item in self.items:
+                item.write_item(writer, target, progress)
+            writer.end_sequence()
+
+        def _item_properties_dict(self, target: Target):
+            # the properties of the item without the child items
             item_properties_dict = {}
 
             if self.properties.group:
@@ -327,7 +806,7 @@ class ProjectTopping(QObject):
                     item_properties_dict["qmlstylefile"] = target.toppingfile_link(
                         ProjectTopping.LAYERSTYLE_TYPE, self.properties.qmlstylefile
                     )
-                if self.properties.styles:
+                if self.properties.has_styles():
                     item_properties_dict["styles"] = {}
                     for style_name in self.properties.styles.keys():
                         item_properties_dict["styles"][style_name] = {}
@@ -349,32 +828,26 @@ class ProjectTopping(QObject):
                     ProjectTopping.LAYERDEFINITION_TYPE,
                     self.properties.definitionfile,
                 )
-
-            if self.items:
-                child_item_dict_list = self.items_list(target)
-                item_properties_dict["child-nodes"] = child_item_dict_list
-
-            item_dict[self.name] = item_properties_dict
-            return item_dict
-
-        def items_list(self, target: Target):
-            item_list = []
-            for item in self.items:
-                item_dict = item.item_dict(target)
-                item_list.append(item_dict)
-            return item_list
+            return item_properties_dict
 
     class MapThemes(dict):
         """
         A dict object of dict items describing a MapThemeRecord according to the maptheme names listed in the ExportSettings passed on parsing the QGIS project.
+
+        With `mapthemes_delta` in the ExportSettings the map themes are written delta encoded (see `delta_encoded`): A base state (the most common state of every node in the map themes) is written once as "mapthemes-base" and every map theme contains only the nodes differing from it.
         """
 
+        def __init__(self):
+            super().__init__()
+            self.delta = False
+
         def make_items(
             self,
             project: QgsProject,
             export_settings: ExportSettings,
         ):
             self.clear()
+            self.delta = export_settings.mapthemes_delta
 
             maptheme_collection = project.mapThemeCollection()
             for name in export_settings.mapthemes:
@@ -412,6 +885,79 @@ class ProjectTopping(QObject):
 
                 self[name] = maptheme_item
 
+        def delta_encoded(self) -> tuple:
+            """
+            Returns the tuple (base, deltas) of the map themes.
+            The base contains the state of every node occurring equally in more than one map theme (the most common one).
+            The deltas contain per map theme the nodes with a different state than in the base and the nodes of the base missing in the map theme (with None).
+            """
+            # count the equal states of the nodes
+            state_counts = {}
+            states = {}
+            for maptheme_item in self.values():
+                for node_name, node_item in maptheme_item.items():
+                    key = (node_name, json.dumps(node_item, sort_keys=True))
+                    state_counts[key] = state_counts.get(key, 0) + 1
+                    states[key] = node_item
+
+            base = {}
+            base_counts = {}
+            for key, count in state_counts.items():
+                node_name = key[0]
+                if count > 1 and count > base_counts.get(node_name, 0):
+                    base_counts[node_name] = count
+                    base[node_name] = copy.deepcopy(states[key])
+
+            deltas = {}
+            for name, maptheme_item in self.items():
+                delta = {}
+                for node_name, node_item in maptheme_item.items():
+                    if base.get(node_name) != node_item:
+                        delta[node_name] = node_item
+                for node_name in base.keys():
+                    if node_name not in maptheme_item:
+                        delta[node_name] = None
+                deltas[name] = delta
+            return base, deltas
+
+        @staticmethod
+        def expanded(deltas: dict, base: dict = None) -> dict:
+            """
+            Returns the complete map themes of the delta encoded ones (the reverse of `delta_encoded`).
+            """
+            mapthemes = {}
+            for name, delta in deltas.items():
+                maptheme_item = copy.deepcopy(base) if base else {}
+                for node_name, node_item in (delta or {}).items():
+                    if node_item is None:
+                        maptheme_item.pop(node_name, None)
+                    else:
+                        maptheme_item[node_name] = node_item
+                mapthemes[name] = maptheme_item
+            return mapthemes
+
+        def load_items(self, mapthemes_dict: dict, base: dict = None):
+            """
+            Loads the map themes of a projecttopping. If delta encoded (with the "mapthemes-base"), they are expanded.
+            """
+            self.clear()
+            self.delta = base is not None
+            if self.delta:
+                self.update(
+                    ProjectTopping.MapThemes.expanded(mapthemes_dict or {}, base)
+                )
+            else:
+                self.update(mapthemes_dict or {})
+
+        def resolved_dict(self) -> dict:
+            """
+            Returns the sections of the projecttopping: "mapthemes" and (when delta encoded) "mapthemes-base".
+            """
+            if not self.delta:
+                return {"mapthemes": dict(self)}
+            base, deltas = self.delta_encoded()
+            return {"mapthemes": deltas, "mapthemes-base": base}
+
     class Variables(dict):
         """
         A dict object of dict items describing a variable according to the variable keys listed in the ExportSettings passed on parsing the QGIS project.
@@ -448,6 +994,32 @@ class ProjectTopping(QObject):
 
                 self[variable_key] = variable_item or None
 
+        def load_items(self, variables_dict: dict, target: Target = None):
+            """
+            Loads the variables of a projecttopping stored in the target.
+            The values linking a file in the directory of the generic toppingfiles of the target (like the path variables linked with the default path_resolver) are loaded as path variables with a LinkedToppingfile handle, so the file is linked again when generated.
+            """
+            self.clear()
+            generic_filedir = None
+            if target is not None:
+                generic_filedir = target.relative_filedir_path(
+                    ProjectTopping.GENERIC_TYPE
+                ).replace(os.sep, "/")
+            for variable_key, value in (variables_dict or {}).items():
+                if (
+                    generic_filedir
+                    and isinstance(value, str)
+                    and os.path.dirname(value.replace(os.sep, "/")) == generic_filedir
+                ):
+                    self[variable_key] = {
+                        "value": LinkedToppingfile(
+                            target, ProjectTopping.GENERIC_TYPE, value
+                        ),
+                        "ispath": True,
+                    }
+                else:
+                    self[variable_key] = {"value": value}
+
         def resolved_dict(self, target: Target):
             resolved_items = {}
             for variable_key in self.keys():
@@ -477,48 +1049,90 @@ class ProjectTopping(QObject):
         """
         A dict object of dict items describing a layout with templatefile according to the layout names listed in the ExportSettings passed on parsing the QGIS project.
         Such a dict item contains only one key at the moment: "templatefile"
+
+        The documents of the layouts are built one after the other (QGIS objects are bound to their thread), their serialization and writing is done by the export pool (concurrently if it has workers).
+        The seconds used to export (build and serialize) the template of every layout are kept in `timings` by the layout name.
         """
 
         def __init__(self, temporary_toppingfile_dir=None):
             self.temporary_toppingfile_dir = temporary_toppingfile_dir
             if not self.temporary_toppingfile_dir:
                 self.temporary_toppingfile_dir = tempfile.mkdtemp()
+            self.timings = {}
 
         def make_items(
             self,
             project: QgsProject,
             export_settings: ExportSettings,
+            export_pool: ExportPool = None,
         ):
             self.clear()
+            self.timings = {}
+            if export_pool is None:
+                # without a pool the template files are written immediately
+                export_pool = ExportPool()
+
+            layout_names = set(export_settings.layouts)
+            # one context for all the layouts
+            context = QgsReadWriteContext()
 
             # go through all the print layouts in the project and export the requested ones
             for layout in project.layoutManager().printLayouts():
-                if layout.name() in export_settings.layouts:
+                if layout.name() in layout_names:
                     self[layout.name()] = {}
 
                     filename_slug = f"{slugify(layout.name())}.qpt"
-                    os.makedirs(self.temporary_toppingfile_dir, exist_ok=True)
-                    temporary_toppingfile_path = os.path.join(
-                        self.temporary_toppingfile_dir, filename_slug
+                    toppingfile_path = export_pool.toppingfile_path(
+                        ProjectTopping.LAYOUTTEMPLATE_TYPE,
+                        self.temporary_toppingfile_dir,
+                        filename_slug,
+                    )
+                    self[layout.name()]["templatefile"] = export_pool.deferred(
+                        toppingfile_path,
+                        functools.partial(
+                            self._export_templatefile,
+                            layout,
+                            export_pool,
+                            toppingfile_path,
+                            context,
+                        ),
+                    )
+
+        def _export_templatefile(
+            self,
+            layout: QgsPrintLayout,
+            export_pool: ExportPool,
+            toppingfile_path: str,
+            context: QgsReadWriteContext,
+        ):
+            layout_name = layout.name()
+            start_time = time.perf_counter()
+            # the same document as QgsLayout.saveAsTemplate writes, but serialized and written by the pool
+            document = QDomDocument()
+            document.appendChild(layout.writeXml(document, context))
+            self.timings[layout_name] = time.perf_counter() - start_time
+
+            def serializer():
+                start_time = time.perf_counter()
+                content = document.toByteArray()
+                self.timings[layout_name] += time.perf_counter() - start_time
+                return content
+
+            return export_pool.write(toppingfile_path, serializer)
+
+        def load_items(self, layouts_dict: dict, target: Target):
+            """
+            Loads the layouts of a projecttopping stored in the target. The template files are LinkedToppingfile handles (not read until needed).
+            """
+            self.clear()
+            for layout_name, layout_dict in (layouts_dict or {}).items():
+                self[layout_name] = {}
+                if layout_dict and layout_dict.get("templatefile"):
+                    self[layout_name]["templatefile"] = LinkedToppingfile(
+                        target,
+                        ProjectTopping.LAYOUTTEMPLATE_TYPE,
+                        layout_dict["templatefile"],
                     )
-                    context = QgsReadWriteContext()
-                    result = layout.saveAsTemplate(temporary_toppingfile_path, context)
-                    if not result:
-                        result_message = ", ".join(
-                            [
-                                message.message()
-                                for message in context.takeMessages()
-                                if message.level == Qgis.MessageLevel.Warning
-                            ]
-                        )
-                        logging.warning(
-                            "Could not export layout template of {} to {}: {}".format(
-                                layout.name(),
-                                temporary_toppingfile_path,
-                                result_message,
-                            )
-                        )
-                    self[layout.name()]["templatefile"] = temporary_toppingfile_path
 
         def item_dict(self, target: Target):
             resolved_items = {}
@@ -536,6 +1150,8 @@ class ProjectTopping(QObject):
         temporary_toppingfile_dir = tempfile.mkdtemp(
             prefix="toppingmaker_temporary_files_"
         )
+        # the directory the toppingfiles are exported to when they are not written into place
+        self.temporary_toppingfile_dir = temporary_toppingfile_dir
 
         self.layertree = self.LayerTreeItem(temporary_toppingfile_dir)
         self.mapthemes = self.MapThemes()
@@ -543,96 +1159,349 @@ class ProjectTopping(QObject):
         self.variables = self.Variables()
         self.properties = self.Properties()
         self.layouts = self.Layouts(temporary_toppingfile_dir)
+        # sha256 digests of the written toppingfiles by path
+        self.toppingfile_digests = {}
+        # the export pool of the deferred toppingfiles (when parsed lazy)
+        self._deferred_export_pool = None
+        # set a Metrics instance to collect the timings and counters of parsing and generating
+        self.metrics: Metrics = None
 
     def parse_project(
-        self, project: QgsProject, export_settings: ExportSettings = ExportSettings()
+        self,
+        project: QgsProject,
+        export_settings: ExportSettings = ExportSettings(),
+        max_workers: int = None,
+        export_cache: ExportCache = None,
+        target: Target = None,
+        lazy: bool = False,
+        feedback: QgsFeedback = None,
     ):
         """
         Parses a project into the ProjectTopping structure. Means the LayerTreeNodes are loaded into the layertree variable and append the ExportSettings to each node. The CustomLayerOrder is loaded into the layerorder. The project is not keeped as member variable.
 
         :param QgsProject project: the project to parse.
         :param ExportSettings settings: defining if the node needs a source or style / definitionfiles.
+        :param int max_workers: the number of worker threads serializing and writing the style, definition and layout template files. With None (or lower than 2) they are written one after the other.
+        :param ExportCache export_cache: the persistent cache to reuse the toppingfiles unchanged since the last run. The hits, the files unchanged after export and the misses are reported through stdout.
+        :param Target target: if the target is already known, the toppingfiles are written directly into place (instead of a temporary directory), so they don't need to be copied on generating the files.
+        :param bool lazy: if True, the style, definition and layout template files are not exported now but when they are linked on generating the files (only the linked ones). The toppingfiles are DeferredToppingfile handles until then and the project needs to be kept until the files are generated. The worker threads are released by generate_files or by close.
+        :param QgsFeedback feedback: to cancel the parsing (between two nodes) and to get the progress. Additionally the progress is reported through the progress signal.
+        :return: False if it could not be parsed, has been canceled or toppingfiles could not be written (reported through stdout).
         """
         root = project.layerTreeRoot()
         if root:
-            # make layertree
-            self.layertree.make_item(project, project.layerTreeRoot(), export_settings)
+            export_pool = ExportPool(
+                max_workers, export_cache, target, lazy, self.metrics
+            )
+            layer_index = ProjectTopping.LayerIndex(project)
+            export_plan = export_settings.export_plan(project)
+            # the nodes (and the root) and the other parts (layerorder, mapthemes, variables, layouts and properties)
+            progress = ProjectTopping.Progress(
+                self, "parse", len(export_plan.node_plans) + 1 + 5, feedback
+            )
+            try:
+                self._parse_project(
+                    project, export_plan, export_pool, layer_index, progress
+                )
+            except ProjectTopping.Canceled:
+                export_pool.close()
+                self.stdout.emit(
+                    self.tr("Parsing of the QGIS project canceled."), Qgis.Warning
+                )
+                return False
+
+            if lazy:
+                # the toppingfiles are exported on generating the files
+                self._deferred_export_pool = export_pool
+            elif not self._finish_export(export_pool):
+                return False
+            progress.finish()
+        else:
             self.stdout.emit(
-                self.tr("QGIS project layertree parsed with export settings."),
-                Qgis.Info,
+                self.tr("Could not parse the QGIS project..."), Qgis.Warning
             )
-            # make layerorder
+            return False
+        return True
+
+    def _parse_project(
+        self,
+        project: QgsProject,
+        export_plan: ExportSettings.ExportPlan,
+        export_pool: ExportPool,
+        layer_index: "ProjectTopping.LayerIndex",
+        progress: "ProjectTopping.Progress",
+    ):
+        root = project.layerTreeRoot()
+        # make layertree
+        with self._phase("layertree"):
+            self.layertree.make_item(
+                project,
+                root,
+                export_plan,
+                export_pool,
+                layer_index,
+                progress,
+            )
+        self.stdout.emit(
+            self.tr("QGIS project layertree parsed with export settings."),
+            Qgis.Info,
+        )
+        # make layerorder
+        progress.step()
+        with self._phase("layerorder"):
             layerorder_layers = (
                 root.customLayerOrder() if root.hasCustomLayerOrder() else []
             )
             if layerorder_layers:
                 self.layerorder = [layer.name() for layer in layerorder_layers]
-            self.stdout.emit(self.tr("QGIS project layerorder parsed."), Qgis.Info)
-            # make mapthemes
-            self.mapthemes.make_items(project, export_settings)
-            # make variables
-            self.variables.make_items(project, export_settings)
-            # make print layouts
-            self.layouts.make_items(project, export_settings)
-            # make properties
+        self.stdout.emit(self.tr("QGIS project layerorder parsed."), Qgis.Info)
+        # make mapthemes
+        progress.step()
+        with self._phase("mapthemes"):
+            self.mapthemes.make_items(project, export_plan)
+        self.stdout.emit(
+            self.tr("QGIS project map themes parsed with export settings."),
+            Qgis.Info,
+        )
+        # make variables
+        progress.step()
+        with self._phase("variables"):
+            self.variables.make_items(project, export_plan)
+        # make print layouts
+        progress.step()
+        with self._phase("layouts"):
+            self.layouts.make_items(project, export_plan, export_pool)
+        # make properties
+        progress.step()
+        with self._phase("properties"):
             self.properties.make_items(project)
 
-            self.stdout.emit(
-                self.tr("QGIS project map themes parsed with export settings."),
-                Qgis.Info,
-            )
+    @contextlib.contextmanager
+    def _phase(self, name: str):
+        # measures the phase if the metrics are enabled
+        if self.metrics:
+            with self.metrics.phase(name):
+                yield
         else:
-            self.stdout.emit(
-                self.tr("Could not parse the QGIS project..."), Qgis.Warning
-            )
-            return False
-        return True
+            yield
 
-    def generate_files(self, target: Target) -> str:
+    def generate_files(self, target: Target, feedback: QgsFeedback = None) -> str:
         """
         Generates all files according to the passed Target.
 
         :param Target target: the target object containing the paths where to create the files and the path_resolver defining the structure of the link.
+        :param QgsFeedback feedback: to cancel the generating (between two items) and to get the progress. Additionally the progress is reported through the progress signal.
+        :return: the link of the projecttopping file or None if it has been canceled.
         """
-        # generate projecttopping as a dict
-        projecttopping_dict = self._projecttopping_dict(target)
+        # the digests of the written toppingfiles are already known
+        target.file_digests.update(self.toppingfile_digests)
+
+        # the items of the layertree (without the root) and the other sections
+        progress = ProjectTopping.Progress(
+            self, "generate", self.layertree.item_count() - 1 + 1, feedback
+        )
+
+        # the linking is measured by the target only while generating
+        previous_target_metrics = target.metrics
+        if self.metrics:
+            target.metrics = self.metrics
+            linking_time = self.metrics.phases.get("file_linking", 0.0)
+            start_time = time.perf_counter()
 
         # write the yaml
         projecttopping_slug = f"{slugify(target.projectname)}.yaml"
-        absolute_filedir_path, relative_filedir_path = target.filedir_path(
-            ProjectTopping.PROJECTTOPPING_TYPE
-        )
-        with open(
-            os.path.join(absolute_filedir_path, projecttopping_slug), "w"
-        ) as projecttopping_yamlfile:
-            yaml.dump(projecttopping_dict, projecttopping_yamlfile)
+        try:
+            with target.open_toppingfile(
+                ProjectTopping.PROJECTTOPPING_TYPE, projecttopping_slug
+            ) as projecttopping_yamlfile:
+                self._write_projecttopping(projecttopping_yamlfile, target, progress)
+            if self.metrics:
+                # the linking is measured separately (by the target)
+                linking_time = (
+                    self.metrics.phases.get("file_linking", 0.0) - linking_time
+                )
+                self.metrics.add_time(
+                    "yaml_write", time.perf_counter() - start_time - linking_time
+                )
+            if self._deferred_export_pool:
+                # the linked deferred toppingfiles have been exported now
+                self._finish_export(self._deferred_export_pool)
+                self._deferred_export_pool = None
+        except ProjectTopping.Canceled:
             self.stdout.emit(
-                self.tr("Project Topping written to YAML file: {}").format(
-                    projecttopping_yamlfile
-                ),
-                Qgis.Info,
+                self.tr("Generating of the Project Topping canceled."), Qgis.Warning
             )
+            return None
+        finally:
+            target.metrics = previous_target_metrics
+            if self._deferred_export_pool:
+                # not finished (canceled or failed) - the workers are shut down, the rest is exported without them when generated again
+                self._deferred_export_pool.close()
+            else:
+                self._remove_unused_temporary_toppingfile_dir()
+        progress.finish()
+        self.stdout.emit(
+            self.tr("Project Topping written to YAML file: {}").format(
+                projecttopping_yamlfile
+            ),
+            Qgis.Info,
+        )
         return target.path_resolver(
             target, projecttopping_slug, ProjectTopping.PROJECTTOPPING_TYPE
         )
 
-    def load_files(self, target: Target):
+    def close(self):
+        """
+        Releases what is kept to generate the files: the worker threads of the export pool of a project parsed lazy and the temporary directory of the exported toppingfiles.
+        Afterwards the files cannot be generated anymore (except of the toppingfiles written into place in a target or loaded from one).
+        It's called when leaving the ProjectTopping used as context manager.
+        """
+        if self._deferred_export_pool:
+            self._deferred_export_pool.close()
+            self._deferred_export_pool = None
+        shutil.rmtree(self.temporary_toppingfile_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _remove_unused_temporary_toppingfile_dir(self):
+        # nothing has been exported to it (e.g. written into place or received by a MemoryTarget)
+        try:
+            os.rmdir(self.temporary_toppingfile_dir)
+        except OSError:
+            # not empty (still needed to generate the files again) or already removed
+            pass
+
+    def _finish_export(self, export_pool: ExportPool) -> bool:
+        # wait until all the toppingfiles are written
+        with self._phase("export"):
+            result = export_pool.close()
+        for path, message in export_pool.failures.items():
+            self.stdout.emit(
+                self.tr("Could not write toppingfile {}: {}").format(path, message),
+                Qgis.Warning,
+            )
+        self.toppingfile_digests.update(export_pool.digests)
+        if export_pool.export_cache:
+            export_pool.export_cache.save()
+            self.stdout.emit(
+                self.tr(
+                    "Export cache used with {hits} hits, {unchanged} unchanged after export and {misses} misses."
+                ).format(**export_pool.export_cache.statistics()),
+                Qgis.Info,
+            )
+        return result
+
+    def load_files(self, target: Target) -> bool:
+        """
+        Loads the ProjectTopping structure from the files generated to the target (the reverse of generate_files).
+        The YAML is read with the libyaml C loader if available.
+        The linked style, definition and layout template files are not read, they are LinkedToppingfile handles resolved when their path or content is needed.
+        So the loaded ProjectTopping can be generated to another target again.
+
+        :param Target target: the target object containing the paths where the files have been generated (with the default path_resolver).
+        :return: False if the projecttopping file could not be read.
+        """
+        projecttopping_link = os.path.join(
+            target.relative_filedir_path(ProjectTopping.PROJECTTOPPING_TYPE),
+            f"{slugify(target.projectname)}.yaml",
+        )
+        try:
+            content = target.read_toppingfile(
+                ProjectTopping.PROJECTTOPPING_TYPE, projecttopping_link
+            )
+        except (OSError, KeyError) as exception:
+            self.stdout.emit(
+                self.tr("Could not read the Project Topping {}: {}").format(
+                    projecttopping_link, exception
+                ),
+                Qgis.Warning,
+            )
+            return False
+        projecttopping_dict = yaml.load(content, Loader=SafeLoader) or {}
+
+        self.layertree.load_items(projecttopping_dict.get("layertree"), target)
+        self.layerorder = list(projecttopping_dict.get("layerorder") or [])
+        self.mapthemes.load_items(
+            projecttopping_dict.get("mapthemes"),
+            projecttopping_dict.get("mapthemes-base"),
+        )
+        self.variables.load_items(projecttopping_dict.get("variables"), target)
+        self.properties.clear()
+        self.properties.update(projecttopping_dict.get("properties") or {})
+        self.layouts.load_items(projecttopping_dict.get("layouts"), target)
+        self.stdout.emit(
+            self.tr("Project Topping loaded from YAML file: {}").format(
+                projecttopping_link
+            ),
+            Qgis.Info,
+        )
+        return True
+
+    def generate_project(
+        self,
+        target: Target = None,
+        project: QgsProject = None,
+        max_workers: int = None,
+        timeout: float = None,
+        document_cache: DocumentCache = None,
+    ) -> QgsProject:
         """
-        - [ ] Not yet implemented.
+        Generates a QGIS project from the ProjectTopping (parsed or loaded), see ProjectGenerator.
+        The layers are created first and registered in one batch, the layer tree is built in one pass and the layer order, map themes, variables, properties and layouts are applied at the end.
+
+        :param Target target: if passed, the ProjectTopping is loaded from the files generated to this target first (see load_files).
+        :param QgsProject project: the project to generate into. If None, a new project is created.
+        :param int max_workers: the number of worker threads creating (and validating) the layers with a source concurrently. With None (or lower than 2) they are created one after the other.
+        :param float timeout: the seconds to wait for the layers created concurrently. The ones not created until then are skipped.
+        :param DocumentCache document_cache: the cache of the parsed styles, definitions and layout templates (to share it between generations). If None, a new one is used.
+        :return: the generated project or None if it could not be loaded from the target.
         """
-        raise NotImplementedError
+        if target is not None and not self.load_files(target):
+            return None
+        return ProjectGenerator(self, max_workers, timeout, document_cache).generate(
+            project
+        )
 
-    def generate_project(self, target: Target) -> QgsProject:
+    def _write_projecttopping(
+        self, stream, target: Target, progress: "ProjectTopping.Progress" = None
+    ):
         """
-        - [ ] Not yet implemented.
+        Streams the projecttopping to the YAML stream section by section and node by node while the layertree is traversed.
+        The result is the same as dumping the _projecttopping_dict (the sections are sorted like yaml.dump does).
+        And the toppingfiles are generated and stored in the same order.
         """
-        return QgsProject()
+        with YamlWriter(stream) as writer:
+            writer.start_mapping()
+            if self.layerorder:
+                writer.write("layerorder")
+                writer.write(self.layerorder)
+            if self.layertree.items:
+                writer.write("layertree")
+                self.layertree.write_items(writer, target, progress)
+            if progress:
+                progress.step()
+
+            # the toppingfiles of the variables and layouts are stored after the ones of the layertree
+            sections = {}
+            sections["variables"] = self.variables.resolved_dict(target)
+            sections["layouts"] = self.layouts.item_dict(target)
+            sections.update(self.mapthemes.resolved_dict())
+            sections["properties"] = dict(self.properties)
+            for key in sorted(sections.keys()):
+                if sections[key]:
+                    writer.write(key)
+                    writer.write(sections[key])
+            writer.end_mapping()
 
     def _projecttopping_dict(self, target: Target):
         """
         Gets the layertree as a list of dicts.
         Gets the layerorder as a list.
-        Gets the mapthemes as a dict.
+        Gets the mapthemes as a dict (and the mapthemes-base if delta encoded).
         Gets the variables as a dict.
         Gets the properties as a dict.
         Gets the layouts as a dict.
@@ -642,9 +1511,9 @@ class ProjectTopping(QObject):
         layertree_items_list = self.layertree.items_list(target)
         if layertree_items_list:
             projecttopping_dict["layertree"] = layertree_items_list
-        mapthemes_dict = dict(self.mapthemes)
-        if mapthemes_dict:
-            projecttopping_dict["mapthemes"] = mapthemes_dict
+        for key, mapthemes_dict in self.mapthemes.resolved_dict().items():
+            if mapthemes_dict:
+                projecttopping_dict[key] = mapthemes_dict
         variables_resolved_dict = self.variables.resolved_dict(target)
         if variables_resolved_dict:
             projecttopping_dict["variables"] = variables_resolved_dict
@@ -0,0 +1,130 @@
+"""
+/***************************************************************************
+                              -------------------
+        git sha              : :%H$
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import functools
+import threading
+
+from qgis.core import QgsDataProvider, QgsDataSourceUri, QgsProviderRegistry
+
+
+class ProviderExtractors:
+    """
+    A registry of the extractors getting the table name and the geometry column of a layer out of its data source uri.
+    They are used when neither the definition nor the source of a layer is exported.
+
+    An extractor is a callable taking the data source uri (str) and the storage type of the provider (str) and returning a tuple (tablename, geometrycolumn). Any of them can be None.
+    It's registered by the provider name:
+
+    ```py
+    provider_extractors.register("oracle", lambda uri, storage_type: (QgsDataSourceUri(uri).table(), None))
+    ```
+
+    The results are memoized per provider, storage type and uri, so layers using the same data source (e.g. a layer multiple times in the tree) are parsed only once.
+    """
+
+    def __init__(self, cache_size: int = 4096):
+        self._extractors = {}
+        self._lock = threading.Lock()
+        self._extract = functools.lru_cache(maxsize=cache_size)(self._extract_uncached)
+
+    def register(self, provider_name: str, extractor):
+        """
+        Registers (or replaces) the extractor of a provider.
+        """
+        with self._lock:
+            self._extractors[provider_name] = extractor
+            self._extract.cache_clear()
+
+    def unregister(self, provider_name: str):
+        with self._lock:
+            self._extractors.pop(provider_name, None)
+            self._extract.cache_clear()
+
+    def providers(self) -> list:
+        return list(self._extractors.keys())
+
+    def extract(self, provider: QgsDataProvider) -> tuple:
+        """
+        Returns the tuple (tablename, geometrycolumn) of the data provider.
+        It's (None, None) if there is no extractor for the provider.
+        """
+        if provider.name() not in self._extractors:
+            return None, None
+        return self._extract(
+            provider.name(), provider.storageType(), provider.dataSourceUri()
+        )
+
+    def cache_info(self):
+        return self._extract.cache_info()
+
+    def _extract_uncached(self, provider_name, storage_type, uri):
+        extractor = self._extractors.get(provider_name)
+        if not extractor:
+            return None, None
+        return extractor(uri, storage_type)
+
+
+def database_table_extractor(uri: str, storage_type: str) -> tuple:
+    """
+    Database providers with a uri in the QgsDataSourceUri format (postgres, mssql, spatialite).
+    """
+    data_source_uri = QgsDataSourceUri(uri)
+    return data_source_uri.table() or None, data_source_uri.geometryColumn() or None
+
+
+def ogr_extractor(uri: str, storage_type: str) -> tuple:
+    """
+    Layers of a GeoPackage (opened by ogr).
+    """
+    if storage_type != "GPKG":
+        return None, None
+    layername = QgsProviderRegistry.instance().decodeUri("ogr", uri).get("layerName")
+    return layername or None, None
+
+
+def wfs_extractor(uri: str, storage_type: str) -> tuple:
+    """
+    The feature type of a WFS layer.
+    """
+    return QgsDataSourceUri(uri).param("typename") or None, None
+
+
+def gdal_extractor(uri: str, storage_type: str) -> tuple:
+    """
+    Raster tables of a GeoPackage (opened by gdal).
+    """
+    decoded_uri = QgsProviderRegistry.instance().decodeUri("gdal", uri)
+    if not decoded_uri.get("path", "").lower().endswith(".gpkg"):
+        return None, None
+    return decoded_uri.get("layerName") or None, None
+
+
+def wms_extractor(uri: str, storage_type: str) -> tuple:
+    """
+    The layers of a WMS/WMTS raster layer.
+    """
+    data_source_uri = QgsDataSourceUri()
+    data_source_uri.setEncodedUri(uri)
+    return data_source_uri.param("layers") or None, None
+
+
+provider_extractors = ProviderExtractors()
+provider_extractors.register("postgres", database_table_extractor)
+provider_extractors.register("mssql", database_table_extractor)
+provider_extractors.register("spatialite", database_table_extractor)
+provider_extractors.register("ogr", ogr_extractor)
+provider_extractors.register("WFS", wfs_extractor)
+provider_extractors.register("gdal", gdal_extractor)
+provider_extractors.register("wms", wms_extractor)
@@ -16,10 +16,13 @@
  *                                                                         *
  ***************************************************************************/
 """
+import contextlib
 import os
 import shutil
+import tempfile
+import time
 
-from .utils import slugify
+from .utils import file_digest, slugify
 
 
 class Target:
@@ -46,6 +49,18 @@ class Target:
     │  │  └── <projectname>_<layername>.qml
     │  └── layerdefinition
     │  │  └── <projectname>_<layername>.qlr
+
+    The toppingfiles can be written directly into place (see `toppingfile_path`) by passing the target on parsing the project.
+    Otherwise they are copied from the temporary directory when they are linked.
+
+    With content_addressed the toppingfiles are stored by the sha256 digest of their content (<digest>.qml etc.).
+    Every file is written only once and all the links to files with the same content point to this shared file.
+
+    The path of a linked toppingfile can be a path-like object (e.g. a DeferredToppingfile exported only when linked).
+
+    When `metrics` (a Metrics instance) is set, the time used for linking and the number and size of the linked files are collected (see `ProjectTopping.metrics`).
+
+    Where the files are stored is defined by `_store_toppingfile`, `_has_toppingfile` and `open_toppingfile` - subclasses (like the ArchiveTarget) store them elsewhere than in the directories.
     """
 
     def __init__(
@@ -54,32 +69,188 @@ class Target:
         main_dir: str = None,
         sub_dir: str = None,
         path_resolver=None,
+        content_addressed: bool = False,
     ):
         self.projectname = projectname
         self.main_dir = main_dir
         self.sub_dir = sub_dir
         self.path_resolver = path_resolver
+        self.content_addressed = content_addressed
 
         if not path_resolver:
             self.path_resolver = self.default_path_resolver
 
         self.toppingfileinfo_list = []
 
+        # already known sha256 digests of the source files (by path) - the others are calculated when linking
+        self.file_digests = {}
+        # links of the stored files by type and digest when content_addressed
+        self._content_links = {}
+        # a Metrics instance collecting the linking (None to disable)
+        self.metrics = None
+        # the directory of the temporary files of linked toppingfiles not stored as file (created when needed, see `temporary_toppingfile_path`)
+        self._temporary_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Removes the temporary files written for the linked toppingfiles not stored as file (see `LinkedToppingfile.path`).
+        """
+        if self._temporary_dir:
+            shutil.rmtree(self._temporary_dir, ignore_errors=True)
+            self._temporary_dir = None
+
+    def temporary_toppingfile_path(self, type: str, link: str) -> str:
+        """
+        Returns the path to write a temporary file of a linked toppingfile not stored as file to (when its path is needed).
+        All of them are in one temporary directory of the target, removed on `close`.
+        """
+        if self._temporary_dir is None:
+            self._temporary_dir = tempfile.mkdtemp(prefix="toppingmaker_linked_")
+        temporary_filedir_path = os.path.join(self._temporary_dir, type)
+        os.makedirs(temporary_filedir_path, exist_ok=True)
+        return os.path.join(temporary_filedir_path, os.path.basename(link))
+
     def filedir_path(self, file_dir):
-        relative_path = os.path.join(self.sub_dir, file_dir)
+        relative_path = self.relative_filedir_path(file_dir)
         absolute_path = os.path.join(self.main_dir, relative_path)
         if not os.path.exists(absolute_path):
             os.makedirs(absolute_path)
         return absolute_path, relative_path
 
+    def relative_filedir_path(self, file_dir):
+        return os.path.join(self.sub_dir or "", file_dir)
+
+    def toppingfile_path(self, type: str, path: str):
+        """
+        Returns the absolute path where the toppingfile of the given (source) path is stored in the target.
+        It's used to write the toppingfiles directly into place, so they don't need to be copied when linking.
+        Returns None if they cannot be written directly (when content_addressed the name is known only after writing).
+        """
+        if self.content_addressed:
+            return None
+        absolute_filedir_path, _ = self.filedir_path(type)
+        return os.path.join(absolute_filedir_path, self._toppingfile_name(path))
+
     def toppingfile_link(self, type: str, path: str):
-        filename_slug = f"{slugify(self.projectname)}_{os.path.basename(path)}"
-        absolute_filedir_path, relative_filedir_path = self.filedir_path(type)
-        shutil.copy(
-            path,
-            os.path.join(absolute_filedir_path, filename_slug),
-        )
-        return self.path_resolver(self, filename_slug, type)
+        if not self.metrics:
+            return self._toppingfile_link(type, path)
+        start_time = time.perf_counter()
+        link = self._toppingfile_link(type, path)
+        self.metrics.add_time("file_linking", time.perf_counter() - start_time)
+        self.metrics.count("linked_files")
+        self.metrics.count("linked_bytes", self._toppingfile_size(path))
+        return link
+
+    def _toppingfile_link(self, type: str, path: str):
+        if hasattr(path, "realize"):
+            # a deferred toppingfile is exported now
+            path = path.realize()
+        if self.content_addressed:
+            return self._content_addressed_link(type, os.fspath(path))
+
+        filename = self._in_place_filename(type, path)
+        if filename is None:
+            # a loaded toppingfile keeps its name (without the projectname of the target it's loaded from)
+            filename = self._toppingfile_name(getattr(path, "name", None) or path)
+            self._store_toppingfile(type, os.fspath(path), filename)
+        return self.path_resolver(self, filename, type)
+
+    def _toppingfile_name(self, path: str) -> str:
+        return f"{slugify(self.projectname)}_{os.path.basename(path)}"
+
+    def _in_place_filename(self, type: str, path: str) -> str:
+        """
+        Returns the filename if the file has been written directly into place (see `toppingfile_path`), so it's named already and nothing needs to be copied.
+        Returns None if it needs to be stored in the target.
+        """
+        if getattr(path, "name", None) is not None:
+            # a loaded toppingfile
+            return None
+        absolute_filedir_path, _ = self.filedir_path(type)
+        if absolute_filedir_path is None:
+            return None
+        path = os.fspath(path)
+        if os.path.dirname(os.path.abspath(path)) != os.path.abspath(
+            absolute_filedir_path
+        ):
+            return None
+        return os.path.basename(path)
+
+    @staticmethod
+    def _toppingfile_size(path) -> int:
+        if hasattr(path, "realize"):
+            path = path.realize()
+        if isinstance(path, LinkedToppingfile):
+            return path.size()
+        return os.path.getsize(path)
+
+    @contextlib.contextmanager
+    def open_toppingfile(self, type: str, filename: str):
+        """
+        Opens a (text) stream to write a toppingfile generated by the caller (like the projecttopping YAML) into the target.
+        It's written to a temporary file replacing the toppingfile when completed, so an incomplete one (e.g. when canceled) does not replace a previous one.
+        """
+        absolute_filedir_path, _ = self.filedir_path(type)
+        path = os.path.join(absolute_filedir_path, filename)
+        temporary_path = f"{path}.part"
+        try:
+            with open(temporary_path, "w") as toppingfile:
+                yield toppingfile
+            os.replace(temporary_path, path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    def _store_toppingfile(self, type: str, path: str, filename: str):
+        # stores the file of the path in the target with the filename
+        absolute_filedir_path, _ = self.filedir_path(type)
+        absolute_path = os.path.join(absolute_filedir_path, filename)
+        # when written directly into place there is nothing to copy
+        if os.path.abspath(path) != os.path.abspath(absolute_path):
+            shutil.copy(path, absolute_path)
+
+    def _has_toppingfile(self, type: str, filename: str) -> bool:
+        absolute_filedir_path, _ = self.filedir_path(type)
+        return os.path.exists(os.path.join(absolute_filedir_path, filename))
+
+    def toppingfile_source(self, type: str, link: str) -> str:
+        """
+        Returns the absolute path of a toppingfile linked in a projecttopping stored in the target (the reverse of the default_path_resolver).
+        Returns None if it's not stored as a file (then it can only be read by `read_toppingfile`).
+        """
+        if not self.main_dir:
+            return None
+        return os.path.join(self.main_dir, link)
+
+    def read_toppingfile(self, type: str, link: str) -> bytes:
+        """
+        Returns the content of a toppingfile linked in a projecttopping stored in the target.
+        """
+        source = self.toppingfile_source(type, link)
+        if source is None:
+            raise OSError(
+                "The toppingfile {} cannot be read without main directory.".format(link)
+            )
+        with open(source, "rb") as toppingfile:
+            return toppingfile.read()
+
+    def _content_addressed_link(self, type: str, path: str):
+        digest = self.file_digests.get(path) or file_digest(path)
+        link = self._content_links.get((type, digest))
+        if link is None:
+            filename = f"{digest}{os.path.splitext(path)[1]}"
+            # when it exists, it's the same content (e.g. from a previous export)
+            if not self._has_toppingfile(type, filename):
+                self._store_toppingfile(type, path, filename)
+            link = self.path_resolver(self, filename, type)
+            self._content_links[(type, digest)] = link
+        return link
 
     @staticmethod
     def default_path_resolver(target, name, type):
@@ -89,3 +260,64 @@ class Target:
         target.toppingfileinfo_list.append(toppingfile)
 
         return os.path.join(relative_filedir_path, name)
+
+
+class LinkedToppingfile(os.PathLike):
+    """
+    The handle of a toppingfile linked in a projecttopping loaded from a Target (see `ProjectTopping.load_files`).
+    The link is resolved only when the path (see `os.fspath`) or the content is needed, and the content is not kept.
+
+    The `name` is the name of the file without the projectname of the target, so it's named by the projectname of the target it's linked in again.
+    If the target does not store it as file (like the MemoryTarget), it's written to a temporary file of the target when the path is needed. They are removed by closing the target.
+    """
+
+    __slots__ = ("target", "type", "link", "name", "_path")
+
+    def __init__(self, target: Target, type: str, link: str):
+        self.target = target
+        self.type = type
+        self.link = link
+        self.name = os.path.basename(link)
+        prefix = f"{slugify(target.projectname)}_"
+        if self.name.startswith(prefix):
+            self.name = self.name[len(prefix) :]
+        self._path = None
+
+    @property
+    def path(self) -> str:
+        if self._path is None or not os.path.exists(self._path):
+            path = self.target.toppingfile_source(self.type, self.link)
+            if path is None:
+                # not stored as file (e.g. in memory) - written to a temporary file when the path is needed
+                path = self.target.temporary_toppingfile_path(self.type, self.link)
+                content = self.target.read_toppingfile(self.type, self.link)
+                with open(path, "wb") as toppingfile:
+                    toppingfile.write(content)
+            self._path = path
+        return self._path
+
+    def size(self) -> int:
+        """
+        Returns the size of the toppingfile (without writing a temporary file).
+        """
+        source = self._path
+        if source is None or not os.path.exists(source):
+            source = self.target.toppingfile_source(self.type, self.link)
+        if source is not None:
+            return os.path.getsize(source)
+        return len(self.read())
+
+    def read(self) -> bytes:
+        """
+        Returns the content of the toppingfile.
+        """
+        if self._path is not None and os.path.exists(self._path):
+            with open(self._path, "rb") as toppingfile:
+                return toppingfile.read()
+        return self.target.read_toppingfile(self.type, self.link)
+
+    def __fspath__(self) -> str:
+        return self.path
+
+    def __repr__(self):
+        return "LinkedToppingfile({!r})".format(self.link)
@@ -0,0 +1,670 @@
+"""
+/***************************************************************************
+                              -------------------
+        git sha              : :%H$
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import base64
+import copy
+import hashlib
+import os
+import tempfile
+
+from .projecttopping import ProjectTopping
+from .target import LinkedToppingfile, Target
+from .utils import file_digest
+
+
+class ToppingDiff:
+    """
+    The structural diff between two ProjectToppings (parsed or loaded, see `from_targets` to compare generated topping files) and the patch bringing the old one to the new one.
+
+    The nodes of the layertree are identified by their path of names (like ["Big Group", "Medium Group", "Layer Two"]), the nodes with the same name in the same group by their occurrence ("Layer Two[2]" for the second one).
+    A node removed in one group and added in another one with the same name (and both groups or both layers) is moved.
+    The toppingfiles (styles, definitions and layout templates) are compared by the sha256 digest of their content.
+
+    The `operations` are the differences in the order they are applied (the paths are the ones in the layertree at the time the operation is applied):
+    - layertree: add (the node with its state), move (to another group), remove, order (the new order of the children of a node) and change (the changed and removed properties of a node)
+    - layerorder: set
+    - mapthemes: add, remove and change (the changed and removed nodes of the map theme)
+    - variables, properties and layouts: add, remove and change
+
+    The states of the nodes are flat dicts with the keys of the projecttopping (like "checked" or "qmlstylefile") and a key "styles/<style name>" per named style, the toppingfiles are referenced by their digest.
+    The values of the path variables are the digests of the files as well.
+
+    The `patch` contains the operations and the content of the toppingfiles they reference, so it can be applied (see `apply_patch`) without the new ProjectTopping. It's serializable as JSON and YAML.
+    """
+
+    PATCH_FORMAT = "toppingpatch"
+    PATCH_VERSION = 1
+
+    # the properties of the nodes by their key with the attribute of the TreeItemProperties and the default value
+    NODE_PROPERTIES = {
+        "group": ("group", False),
+        "checked": ("checked", True),
+        "expanded": ("expanded", True),
+        "featurecount": ("featurecount", False),
+        "mutually-exclusive": ("mutually_exclusive", False),
+        "mutually-exclusive-child": ("mutually_exclusive_child", -1),
+        "provider": ("provider", None),
+        "uri": ("uri", None),
+        "tablename": ("tablename", None),
+        "geometrycolumn": ("geometrycolumn", None),
+    }
+    NODE_TOPPINGFILES = ["qmlstylefile", "definitionfile"]
+    STYLE_PREFIX = "styles/"
+
+    class _Node:
+        """
+        A node of the layertree the operations are simulated on (to get their paths).
+        """
+
+        __slots__ = ("name", "parent", "children", "_child_segments")
+
+        def __init__(self, name: str = None, parent: "ToppingDiff._Node" = None):
+            self.name = name
+            self.parent = None
+            self.children = []
+            # the segments of the children by their id (computed on demand, reset when the children change)
+            self._child_segments = None
+            self.attach(parent)
+
+        def attach(self, parent: "ToppingDiff._Node"):
+            # detaches the node from its parent and appends it to the new one (if any)
+            if self.parent is not None:
+                self.parent.children.remove(self)
+                self.parent._child_segments = None
+            self.parent = parent
+            if parent is not None:
+                parent.children.append(self)
+                parent._child_segments = None
+
+        def order(self, children: list):
+            self.children = children
+            self._child_segments = None
+
+        def child_segments(self) -> dict:
+            # the segments of the children by their id (like ToppingDiff._segments)
+            if self._child_segments is None:
+                self._child_segments = {
+                    id(child): segment
+                    for child, segment in zip(
+                        self.children, ToppingDiff._segments(self.children)
+                    )
+                }
+            return self._child_segments
+
+        def path(self) -> list:
+            path = []
+            node = self
+            while node.parent is not None:
+                path.append(node.parent.child_segments()[id(node)])
+                node = node.parent
+            path.reverse()
+            return path
+
+    def __init__(self, old_topping: ProjectTopping, new_topping: ProjectTopping):
+        # the digests of the toppingfiles by path (or LinkedToppingfile)
+        self._digests = {}
+        # the toppingfiles of the new ProjectTopping by digest (their content is in the patch)
+        self._toppingfiles = {}
+
+        old_state = self._topping_state(old_topping)
+        new_state = self._topping_state(new_topping, self._toppingfiles)
+
+        self.operations = self._layertree_operations(
+            old_state["layertree"], new_state["layertree"]
+        )
+        if old_state["layerorder"] != new_state["layerorder"]:
+            self.operations.append(
+                {
+                    "op": "set",
+                    "section": "layerorder",
+                    "value": new_state["layerorder"],
+                }
+            )
+        self.operations.extend(
+            self._mapthemes_operations(old_state["mapthemes"], new_state["mapthemes"])
+        )
+        for section in ["variables", "properties", "layouts"]:
+            self.operations.extend(
+                self._item_operations(section, old_state[section], new_state[section])
+            )
+
+    @classmethod
+    def from_targets(cls, old_target: Target, new_target: Target) -> "ToppingDiff":
+        """
+        Returns the diff between the topping files generated to the targets (see `ProjectTopping.load_files`).
+        The linked toppingfiles are only read to get their digest.
+
+        :return: the diff or None if one of the projecttoppings could not be loaded.
+        """
+        project_toppings = []
+        for target in [old_target, new_target]:
+            project_topping = ProjectTopping()
+            if not project_topping.load_files(target):
+                return None
+            project_toppings.append(project_topping)
+        return cls(*project_toppings)
+
+    def is_empty(self) -> bool:
+        return not self.operations
+
+    def summary(self) -> dict:
+        """
+        Returns the number of operations per section and operation (like {"layertree": {"add": 2, "move": 1}}).
+        """
+        summary = {}
+        for operation in self.operations:
+            counts = summary.setdefault(operation["section"], {})
+            counts[operation["op"]] = counts.get(operation["op"], 0) + 1
+        return summary
+
+    def patch(self) -> dict:
+        """
+        Returns the patch: the operations and the toppingfiles they reference by digest (with the file name and the content).
+        The content is text, the one of files that are not UTF-8 (like binary files of path variables) is base64 encoded ("base64" instead of "content").
+        """
+        files = {}
+        for digest in self._referenced_digests():
+            toppingfile = self._toppingfiles[digest]
+            files[digest] = {
+                "name": getattr(toppingfile, "name", None)
+                or os.path.basename(os.fspath(toppingfile))
+            }
+            content = self._read(toppingfile)
+            try:
+                files[digest]["content"] = content.decode("utf-8")
+            except UnicodeDecodeError:
+                files[digest]["base64"] = base64.b64encode(content).decode("ascii")
+        return {
+            "format": self.PATCH_FORMAT,
+            "version": self.PATCH_VERSION,
+            "operations": copy.deepcopy(self.operations),
+            "files": files,
+        }
+
+    @staticmethod
+    def apply_patch(project_topping: ProjectTopping, patch: dict):
+        """
+        Applies the patch to the ProjectTopping (in place), what brings the old ProjectTopping of the diff to the new one.
+        The toppingfiles of the patch are written to a temporary directory (once per digest), so the ProjectTopping can be generated (see `generate_files`) afterwards.
+
+        :param ProjectTopping project_topping: the ProjectTopping the diff has been made from (or an equal one).
+        :param dict patch: the patch (see `patch`).
+        """
+        if (
+            patch.get("format") != ToppingDiff.PATCH_FORMAT
+            or patch.get("version", 0) > ToppingDiff.PATCH_VERSION
+        ):
+            raise ValueError(
+                "Unsupported patch format: {} {}".format(
+                    patch.get("format"), patch.get("version")
+                )
+            )
+
+        files = patch.get("files") or {}
+        toppingfile_paths = {}
+        patch_dir = None
+
+        def toppingfile(digest):
+            nonlocal patch_dir
+            if digest is None:
+                return None
+            path = toppingfile_paths.get(digest)
+            if path is None:
+                if patch_dir is None:
+                    patch_dir = tempfile.mkdtemp(prefix="toppingmaker_patch_")
+                os.makedirs(os.path.join(patch_dir, digest))
+                path = os.path.join(patch_dir, digest, files[digest]["name"])
+                with open(path, "wb") as file:
+                    if "base64" in files[digest]:
+                        file.write(base64.b64decode(files[digest]["base64"]))
+                    else:
+                        file.write(files[digest]["content"].encode("utf-8"))
+                toppingfile_paths[digest] = path
+            return path
+
+        for operation in patch.get("operations") or []:
+            section = operation["section"]
+            if section == "layertree":
+                ToppingDiff._apply_layertree_operation(
+                    project_topping.layertree, operation, toppingfile
+                )
+            elif section == "layerorder":
+                project_topping.layerorder = list(operation["value"])
+            elif section == "mapthemes":
+                ToppingDiff._apply_maptheme_operation(
+                    project_topping.mapthemes, operation
+                )
+            else:
+                items = getattr(project_topping, section)
+                if operation["op"] == "remove":
+                    items.pop(operation["name"], None)
+                    continue
+                value = copy.deepcopy(operation["value"])
+                if section == "layouts":
+                    value["templatefile"] = toppingfile(value.get("templatefile"))
+                elif value.get("ispath") and value.get("value") in files:
+                    value["value"] = toppingfile(value["value"])
+                items[operation["name"]] = value
+
+    def _topping_state(
+        self, project_topping: ProjectTopping, toppingfiles: dict = None
+    ) -> dict:
+        # the comparable state of every section with the toppingfiles as digests
+        self._digests.update(project_topping.toppingfile_digests)
+        return {
+            "layertree": self._layertree_state(project_topping.layertree, toppingfiles),
+            "layerorder": list(project_topping.layerorder),
+            "mapthemes": copy.deepcopy(dict(project_topping.mapthemes)),
+            "variables": {
+                variable_key: self._variable_state(variable_item, toppingfiles)
+                for variable_key, variable_item in project_topping.variables.items()
+            },
+            "properties": copy.deepcopy(dict(project_topping.properties)),
+            "layouts": {
+                layout_name: {
+                    "templatefile": self._digest(
+                        (layout_item or {}).get("templatefile"), toppingfiles
+                    )
+                }
+                for layout_name, layout_item in project_topping.layouts.items()
+            },
+        }
+
+    def _layertree_state(
+        self, layertree: ProjectTopping.LayerTreeItem, toppingfiles: dict
+    ) -> tuple:
+        """
+        Returns the nodes (name and state) by path in pre-order and the segments of the children by the path of their parent.
+        """
+        nodes = {}
+        children = {}
+        # explicit stack instead of recursion (for deep trees)
+        stack = [((), layertree)]
+        while stack:
+            path, item = stack.pop()
+            if path:
+                nodes[path] = {
+                    "name": item.name,
+                    "state": self._node_state(item, toppingfiles),
+                }
+            segments = self._segments(item.items)
+            children[path] = segments
+            stack.extend(
+                (path + (segment,), child_item)
+                for segment, child_item in reversed(list(zip(segments, item.items)))
+            )
+        return nodes, children
+
+    def _node_state(
+        self, item: ProjectTopping.LayerTreeItem, toppingfiles: dict
+    ) -> dict:
+        properties = item.properties
+        state = {}
+        for key, (attribute, default) in self.NODE_PROPERTIES.items():
+            value = getattr(properties, attribute)
+            if value != default:
+                state[key] = value
+        for key in self.NODE_TOPPINGFILES:
+            if getattr(properties, key):
+                state[key] = self._digest(getattr(properties, key), toppingfiles)
+        if properties.has_styles():
+            for style_name, style_item_properties in properties.styles.items():
+                state[f"{self.STYLE_PREFIX}{style_name}"] = self._digest(
+                    style_item_properties.qmlstylefile, toppingfiles
+                )
+        return state
+
+    def _layertree_operations(self, old_layertree: tuple, new_layertree: tuple) -> list:
+        old_nodes, _ = old_layertree
+        new_nodes, new_children = new_layertree
+
+        # the moves: a removed node with the same name and kind (group or layer) as an added node
+        removed = {path for path in old_nodes if path not in new_nodes}
+        candidates = {}
+        for path in old_nodes:
+            if path in removed:
+                candidates.setdefault(self._node_key(old_nodes[path]), []).append(path)
+        moves = {}
+        destinations = set()
+        for path in new_nodes:
+            if path in old_nodes or any(
+                path[:length] in destinations for length in range(1, len(path))
+            ):
+                # not added or moved along with its parent
+                continue
+            paths = candidates.get(self._node_key(new_nodes[path]))
+            if paths:
+                moves[paths.pop(0)] = path
+                destinations.add(path)
+        # a node in a moved group is moved along with it
+        for source in list(moves.keys()):
+            if any(source[:length] in moves for length in range(1, len(source))):
+                destinations.discard(moves.pop(source))
+
+        def remapped(path):
+            # the path of the node after the moves
+            for length in range(len(path), 0, -1):
+                destination = moves.get(path[:length])
+                if destination is not None:
+                    return destination + path[length:]
+            return path
+
+        # the old paths by the path after the moves
+        old_paths = {remapped(path): path for path in old_nodes.keys()}
+        sources = {destination: source for source, destination in moves.items()}
+
+        # the operations are simulated on a tree of the old nodes, so the paths are the ones of the layertree when the operation is applied
+        # (the occurrence of the nodes with the same name changes while nodes are added, moved and removed)
+        old_tree = {(): ToppingDiff._Node()}
+        for path, node in old_nodes.items():
+            old_tree[path] = ToppingDiff._Node(node["name"], old_tree[path[:-1]])
+        # the nodes of the simulated tree by their new path
+        tree = {(): old_tree[()]}
+
+        operations = []
+        for path, node in new_nodes.items():
+            if path in sources:
+                tree_node = old_tree[sources[path]]
+                source_path = tree_node.path()
+                tree_node.attach(tree[path[:-1]])
+                operations.append(
+                    {
+                        "op": "move",
+                        "section": "layertree",
+                        "path": source_path,
+                        "to": tree_node.path(),
+                    }
+                )
+            elif path not in old_paths:
+                tree_node = ToppingDiff._Node(node["name"], tree[path[:-1]])
+                operations.append(
+                    {
+                        "op": "add",
+                        "section": "layertree",
+                        "path": tree_node.path(),
+                        "name": node["name"],
+                        "state": copy.deepcopy(node["state"]),
+                    }
+                )
+            else:
+                tree_node = old_tree[old_paths[path]]
+            tree[path] = tree_node
+
+        # the removed nodes (not the ones in removed groups) in reversed pre-order
+        removed = {path for path in old_paths.keys() if path not in new_nodes}
+        for path in reversed(list(old_paths.keys())):
+            if path in removed and path[:-1] not in removed:
+                tree_node = old_tree[old_paths[path]]
+                operations.append(
+                    {"op": "remove", "section": "layertree", "path": tree_node.path()}
+                )
+                tree_node.attach(None)
+
+        for path, segments in new_children.items():
+            tree_node = tree[path]
+            children = [tree[path + (segment,)] for segment in segments]
+            if tree_node.children != children:
+                current_segments = tree_node.child_segments()
+                operations.append(
+                    {
+                        "op": "order",
+                        "section": "layertree",
+                        "path": tree_node.path(),
+                        "children": [current_segments[id(child)] for child in children],
+                    }
+                )
+                tree_node.order(children)
+
+        for path, node in new_nodes.items():
+            old_node = old_nodes.get(old_paths.get(path))
+            if old_node is None or old_node["state"] == node["state"]:
+                continue
+            changes, removed_keys = self._changes(old_node["state"], node["state"])
+            operations.append(
+                {
+                    "op": "change",
+                    "section": "layertree",
+                    "path": list(path),
+                    "changes": changes,
+                    "removed": removed_keys,
+                }
+            )
+        return operations
+
+    def _mapthemes_operations(self, old_mapthemes: dict, new_mapthemes: dict) -> list:
+        operations = []
+        for name in old_mapthemes.keys():
+            if name not in new_mapthemes:
+                operations.append(
+                    {"op": "remove", "section": "mapthemes", "name": name}
+                )
+        for name, maptheme_item in new_mapthemes.items():
+            if name not in old_mapthemes:
+                operations.append(
+                    {
+                        "op": "add",
+                        "section": "mapthemes",
+                        "name": name,
+                        "value": maptheme_item,
+                    }
+                )
+            elif old_mapthemes[name] != maptheme_item:
+                changes, removed_nodes = self._changes(
+                    old_mapthemes[name], maptheme_item
+                )
+                operations.append(
+                    {
+                        "op": "change",
+                        "section": "mapthemes",
+                        "name": name,
+                        "changes": changes,
+                        "removed": removed_nodes,
+                    }
+                )
+        return operations
+
+    @staticmethod
+    def _item_operations(section: str, old_items: dict, new_items: dict) -> list:
+        operations = []
+        for name in old_items.keys():
+            if name not in new_items:
+                operations.append({"op": "remove", "section": section, "name": name})
+        for name, value in new_items.items():
+            if name not in old_items or old_items[name] != value:
+                operations.append(
+                    {
+                        "op": "add" if name not in old_items else "change",
+                        "section": section,
+                        "name": name,
+                        "value": value,
+                    }
+                )
+        return operations
+
+    @staticmethod
+    def _changes(old_dict: dict, new_dict: dict) -> tuple:
+        # the changed (and added) items and the keys of the removed ones
+        changes = {
+            key: copy.deepcopy(value)
+            for key, value in new_dict.items()
+            if key not in old_dict or old_dict[key] != value
+        }
+        removed_keys = [key for key in old_dict.keys() if key not in new_dict]
+        return changes, removed_keys
+
+    @staticmethod
+    def _node_key(node: dict) -> tuple:
+        return node["name"], node["state"].get("group", False)
+
+    @staticmethod
+    def _segments(items: list) -> list:
+        # the names of the items with the occurrence of the ones with the same name
+        counts = {}
+        segments = []
+        for item in items:
+            counts[item.name] = counts.get(item.name, 0) + 1
+            if counts[item.name] == 1:
+                segments.append(item.name)
+            else:
+                segments.append(f"{item.name}[{counts[item.name]}]")
+        return segments
+
+    def _referenced_digests(self) -> list:
+        # the digests of the toppingfiles referenced by the operations
+        digests = []
+        for operation in self.operations:
+            if operation["section"] == "layertree":
+                node_state = operation.get("state") or operation.get("changes") or {}
+                for key, value in node_state.items():
+                    if value and self._is_toppingfile_key(key):
+                        digests.append(value)
+            elif operation["section"] == "layouts" and operation["op"] != "remove":
+                if operation["value"].get("templatefile"):
+                    digests.append(operation["value"]["templatefile"])
+            elif operation["section"] == "variables" and operation["op"] != "remove":
+                if (
+                    operation["value"].get("ispath")
+                    and operation["value"].get("value") in self._toppingfiles
+                ):
+                    digests.append(operation["value"]["value"])
+        return list(dict.fromkeys(digests))
+
+    def _variable_state(self, variable_item: dict, toppingfiles: dict) -> dict:
+        variable_state = dict(variable_item or {})
+        value = variable_state.get("value")
+        if (
+            variable_state.get("ispath")
+            and value
+            and (isinstance(value, LinkedToppingfile) or os.path.isfile(value))
+        ):
+            variable_state["value"] = self._digest(value, toppingfiles)
+        return variable_state
+
+    def _is_toppingfile_key(self, key: str) -> bool:
+        return key in self.NODE_TOPPINGFILES or key.startswith(self.STYLE_PREFIX)
+
+    def _digest(self, toppingfile, toppingfiles: dict = None) -> str:
+        if not toppingfile:
+            return None
+        # the handles of loaded toppingfiles are read (not copied to a temporary file if they are not stored as file)
+        if isinstance(toppingfile, LinkedToppingfile):
+            key = toppingfile
+        else:
+            key = os.fspath(toppingfile)
+        digest = self._digests.get(key)
+        if digest is None:
+            if isinstance(toppingfile, LinkedToppingfile):
+                digest = hashlib.sha256(toppingfile.read()).hexdigest()
+            else:
+                digest = file_digest(key)
+            self._digests[key] = digest
+        if toppingfiles is not None:
+            toppingfiles.setdefault(digest, toppingfile)
+        return digest
+
+    @staticmethod
+    def _read(toppingfile) -> bytes:
+        if isinstance(toppingfile, LinkedToppingfile):
+            return toppingfile.read()
+        with open(os.fspath(toppingfile), "rb") as file:
+            return file.read()
+
+    @staticmethod
+    def _resolve(
+        layertree: ProjectTopping.LayerTreeItem, path: list
+    ) -> ProjectTopping.LayerTreeItem:
+        item = layertree
+        for segment in path:
+            segments = ToppingDiff._segments(item.items)
+            if segment not in segments:
+                raise ValueError(
+                    "The node {} is not in the layertree".format("/".join(path))
+                )
+            item = item.items[segments.index(segment)]
+        return item
+
+    @staticmethod
+    def _apply_layertree_operation(
+        layertree: ProjectTopping.LayerTreeItem, operation: dict, toppingfile
+    ):
+        path = operation["path"]
+        if operation["op"] == "add":
+            item = ProjectTopping.LayerTreeItem(layertree.temporary_toppingfile_dir)
+            item.name = operation["name"]
+            for key, value in operation["state"].items():
+                ToppingDiff._set_node_property(item.properties, key, value, toppingfile)
+            ToppingDiff._resolve(layertree, path[:-1]).items.append(item)
+        elif operation["op"] == "move":
+            item = ToppingDiff._resolve(layertree, path)
+            ToppingDiff._resolve(layertree, path[:-1]).items.remove(item)
+            ToppingDiff._resolve(layertree, operation["to"][:-1]).items.append(item)
+        elif operation["op"] == "remove":
+            item = ToppingDiff._resolve(layertree, path)
+            ToppingDiff._resolve(layertree, path[:-1]).items.remove(item)
+        elif operation["op"] == "order":
+            item = ToppingDiff._resolve(layertree, path)
+            child_items = dict(zip(ToppingDiff._segments(item.items), item.items))
+            ordered_items = [
+                child_items.pop(segment)
+                for segment in operation["children"]
+                if segment in child_items
+            ]
+            item.items = ordered_items + list(child_items.values())
+        elif operation["op"] == "change":
+            properties = ToppingDiff._resolve(layertree, path).properties
+            for key, value in operation["changes"].items():
+                ToppingDiff._set_node_property(properties, key, value, toppingfile)
+            for key in operation["removed"]:
+                ToppingDiff._reset_node_property(properties, key)
+
+    @staticmethod
+    def _set_node_property(
+        properties: ProjectTopping.TreeItemProperties, key: str, value, toppingfile
+    ):
+        if key in ToppingDiff.NODE_PROPERTIES:
+            setattr(properties, ToppingDiff.NODE_PROPERTIES[key][0], value)
+        elif key in ToppingDiff.NODE_TOPPINGFILES:
+            setattr(properties, key, toppingfile(value))
+        elif key.startswith(ToppingDiff.STYLE_PREFIX):
+            style_item_properties = (
+                ProjectTopping.TreeItemProperties.StyleItemProperties()
+            )
+            style_item_properties.qmlstylefile = toppingfile(value)
+            properties.styles[
+                key[len(ToppingDiff.STYLE_PREFIX) :]
+            ] = style_item_properties
+
+    @staticmethod
+    def _reset_node_property(properties: ProjectTopping.TreeItemProperties, key: str):
+        if key in ToppingDiff.NODE_PROPERTIES:
+            attribute, default = ToppingDiff.NODE_PROPERTIES[key]
+            setattr(properties, attribute, default)
+        elif key in ToppingDiff.NODE_TOPPINGFILES:
+            setattr(properties, key, None)
+        elif key.startswith(ToppingDiff.STYLE_PREFIX) and properties.has_styles():
+            properties.styles.pop(key[len(ToppingDiff.STYLE_PREFIX) :], None)
+
+    @staticmethod
+    def _apply_maptheme_operation(mapthemes: ProjectTopping.MapThemes, operation: dict):
+        name = operation["name"]
+        if operation["op"] == "remove":
+            mapthemes.pop(name, None)
+        elif operation["op"] == "add":
+            mapthemes[name] = copy.deepcopy(operation["value"])
+        elif operation["op"] == "change":
+            maptheme_item = mapthemes[name]
+            maptheme_item.update(copy.deepcopy(operation["changes"]))
+            for node_name in operation["removed"]:
+                maptheme_item.pop(node_name, None)
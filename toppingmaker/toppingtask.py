@@ -0,0 +1,102 @@
+"""
+/***************************************************************************
+                              -------------------
+        git sha              : :%H$
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import logging
+
+from qgis.core import QgsProject, QgsTask
+
+from .exportsettings import ExportSettings
+from .projecttopping import ProjectTopping
+from .target import Target
+
+
+class ProjectToppingTask(QgsTask):
+    """
+    A task parsing a QGIS project and generating the files of the ProjectTopping in the background (by the QgsTaskManager), so the GUI is not blocked.
+
+    Since the objects of a project (layers, layouts etc.) belong to the thread they are created in, the project is not passed but read from the project file in the task (into its own QgsProject).
+    The nodes used as keys in the export settings are replaced by the ones of the read project at the same place (see `ExportSettings.relocated`), so the project file needs to be saved with the same layertree.
+    Without a project file, an already parsed ProjectTopping is generated only. This is not possible when it has been parsed lazy, because the deferred toppingfiles are exported from the project of the main thread.
+
+    The task is canceled between two parsed nodes or written items. The progress of the task is set on the way and additionally reported through the progress signal of the ProjectTopping.
+
+    ```py
+    task = ProjectToppingTask("Export topping", project_topping, target, project.fileName(), export_settings)
+    task.taskCompleted.connect(lambda: print(task.projecttopping_link))
+    QgsApplication.taskManager().addTask(task)
+    ```
+
+    :param ProjectTopping project_topping: the ProjectTopping to fill and generate.
+    :param Target target: the target object where the files are generated.
+    :param str project_file: the path of the QGIS project to parse. If None, the project_topping is not parsed, only generated.
+    :param ExportSettings export_settings: the export settings used to parse the project.
+    :param parse_kwargs: additional parameters of parse_project (like max_workers, export_cache or lazy).
+    """
+
+    def __init__(
+        self,
+        description: str,
+        project_topping: ProjectTopping,
+        target: Target,
+        project_file: str = None,
+        export_settings: ExportSettings = ExportSettings(),
+        **parse_kwargs
+    ):
+        super().__init__(description, QgsTask.CanCancel)
+        self.project_topping = project_topping
+        self.target = target
+        self.project_file = project_file
+        self.export_settings = export_settings
+        # the nodes used as keys in the export settings are located in the thread of their project
+        self.node_locators = export_settings.node_locators()
+        self.parse_kwargs = parse_kwargs
+        # the link of the projecttopping file when the task completed
+        self.projecttopping_link = None
+        self.error = None
+
+    def run(self) -> bool:
+        if self.project_file:
+            # created in the thread of the task (and kept until generated, in case it's parsed lazy)
+            project = QgsProject()
+            if not project.read(self.project_file):
+                self.error = "Could not read the QGIS project {}: {}".format(
+                    self.project_file, project.error()
+                )
+                return False
+            try:
+                export_settings = self.export_settings.relocated(
+                    project, self.node_locators
+                )
+            except ValueError as exception:
+                self.error = "Could not use the export settings with the QGIS project {}: {}".format(
+                    self.project_file, exception
+                )
+                return False
+            if not self.project_topping.parse_project(
+                project, export_settings, feedback=self, **self.parse_kwargs
+            ):
+                return False
+        elif self.project_topping._deferred_export_pool:
+            self.error = "A lazy parsed ProjectTopping cannot be generated in a task without the project file."
+            return False
+
+        self.projecttopping_link = self.project_topping.generate_files(
+            self.target, feedback=self
+        )
+        return self.projecttopping_link is not None
+
+    def finished(self, result: bool):
+        if not result and self.error:
+            logging.warning(self.error)
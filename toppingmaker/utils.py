@@ -16,6 +16,7 @@
  *                                                                         *
  ***************************************************************************/
 """
+import hashlib
 import re
 import unicodedata
 
@@ -28,3 +29,11 @@ def slugify(text: str) -> str:
     slug = re.sub(r"[-]+", "_", slug)
     slug = slug.lower()
     return slug
+
+
+def file_digest(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
@@ -0,0 +1,114 @@
+"""
+/***************************************************************************
+                              -------------------
+        git sha              : :%H$
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from yaml.events import (
+    DocumentEndEvent,
+    DocumentStartEvent,
+    MappingEndEvent,
+    MappingStartEvent,
+    ScalarEvent,
+    SequenceEndEvent,
+    SequenceStartEvent,
+    StreamEndEvent,
+    StreamStartEvent,
+)
+from yaml.nodes import MappingNode, ScalarNode, SequenceNode
+
+try:
+    # the libyaml C emitter if available
+    from yaml import CDumper as Dumper
+except ImportError:
+    from yaml import Dumper
+
+MAPPING_TAG = "tag:yaml.org,2002:map"
+SEQUENCE_TAG = "tag:yaml.org,2002:seq"
+
+
+class YamlWriter:
+    """
+    Writes a YAML document to a stream piece by piece instead of dumping a completely materialized dict.
+
+    The mappings and sequences are opened and closed by the caller, the values in between are represented like yaml.dump does (block style).
+    Like yaml.dump the caller needs to write the keys of a mapping in sorted order to get the same output.
+    The only difference to yaml.dump is, that objects occurring multiple times are written multiple times instead of using anchors and aliases.
+
+    The libyaml C emitter is used when available.
+    """
+
+    def __init__(self, stream):
+        self._dumper = Dumper(stream, default_flow_style=False, sort_keys=True)
+
+    def __enter__(self):
+        self._dumper.emit(StreamStartEvent())
+        self._dumper.emit(DocumentStartEvent(explicit=False))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self._dumper.emit(DocumentEndEvent(explicit=False))
+            self._dumper.emit(StreamEndEvent())
+        self._dumper.dispose()
+
+    def start_mapping(self):
+        self._dumper.emit(MappingStartEvent(None, MAPPING_TAG, True, flow_style=False))
+
+    def end_mapping(self):
+        self._dumper.emit(MappingEndEvent())
+
+    def start_sequence(self):
+        self._dumper.emit(
+            SequenceStartEvent(None, SEQUENCE_TAG, True, flow_style=False)
+        )
+
+    def end_sequence(self):
+        self._dumper.emit(SequenceEndEvent())
+
+    def write(self, data):
+        """
+        Writes a key or a value (what can be any data structure yaml.dump can represent).
+        """
+        node = self._dumper.represent_data(data)
+        # the represented objects are only needed for aliases (what are not written)
+        self._dumper.represented_objects = {}
+        self._dumper.object_keeper = []
+        self._dumper.alias_key = None
+        self._emit_node(node)
+
+    def _emit_node(self, node):
+        # like yaml.serializer.Serializer.serialize_node but without anchors and aliases
+        if isinstance(node, ScalarNode):
+            detected_tag = self._dumper.resolve(ScalarNode, node.value, (True, False))
+            default_tag = self._dumper.resolve(ScalarNode, node.value, (False, True))
+            implicit = (node.tag == detected_tag), (node.tag == default_tag)
+            self._dumper.emit(
+                ScalarEvent(None, node.tag, implicit, node.value, style=node.style)
+            )
+        elif isinstance(node, SequenceNode):
+            implicit = node.tag == self._dumper.resolve(SequenceNode, node.value, True)
+            self._dumper.emit(
+                SequenceStartEvent(None, node.tag, implicit, flow_style=node.flow_style)
+            )
+            for item in node.value:
+                self._emit_node(item)
+            self._dumper.emit(SequenceEndEvent())
+        elif isinstance(node, MappingNode):
+            implicit = node.tag == self._dumper.resolve(MappingNode, node.value, True)
+            self._dumper.emit(
+                MappingStartEvent(None, node.tag, implicit, flow_style=node.flow_style)
+            )
+            for key, value in node.value:
+                self._emit_node(key)
+                self._emit_node(value)
+            self._dumper.emit(MappingEndEvent())